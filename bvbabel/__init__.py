@@ -2,21 +2,26 @@
 
 import bvbabel.dmr
 import bvbabel.dwi
+import bvbabel.fbr
 import bvbabel.fmr
 import bvbabel.glm
 import bvbabel.gtc
+import bvbabel.labels
 import bvbabel.map
 import bvbabel.msk
 import bvbabel.mtc
 import bvbabel.obj
 import bvbabel.poi
+import bvbabel.preproc
 import bvbabel.prt
+import bvbabel.resample
 import bvbabel.roi
 import bvbabel.sdm
 import bvbabel.smp
 import bvbabel.srf
 import bvbabel.ssm
 import bvbabel.stc
+import bvbabel.threshold
 import bvbabel.trf
 import bvbabel.v16
 import bvbabel.vmp
@@ -1,37 +1,19 @@
 """Read, write, create BrainVoyager DMR file format."""
 
 import os
+import copy
 import numpy as np
-from bvbabel.dwi import read_dwi
+from concurrent.futures import ThreadPoolExecutor
+from bvbabel.dwi import read_dwi, open_dwi
+from bvbabel.vmp import create_vmp, write_vmp
 from pprint import pprint
 
-# =============================================================================
-def read_dmr(filename, rearrange_data_axes=True):
-    """Read BrainVoyager DMR (and the paired DWI) file.
-
-    Parameters
-    ----------
-    filename : string
-        Path to file.
+RCOND = 1e-12  # Relative singular value cutoff of the weighted tensor fit
 
-    Returns
-    -------
-    header : dictionary
-        Pre-data and post-data headers.
-    data : 4D numpy.array, (x, y, slices, directions)
-        Image data.
-    rearrange_data_axes : bool
-        When 'False', axes are intended to follow LIP+ terminology used
-        internally in BrainVoyager (however see the notes below):
-            - 1st axis is Right to "L"eft.
-            - 2nd axis is Superior to "I"nferior.
-            - 3rd axis is Anterior to "P"osterior.
-        When 'True' axes are intended to follow nibabel RAS+ terminology:
-            - 1st axis is Left to "R"ight.
-            - 2nd axis is Posterior to "A"nterior.
-            - 3rd axis is Inferior to "S"uperior.
 
-    """
+# =============================================================================
+def _read_dmr_header(filename):
+    """Read the text header of a BrainVoyager DMR file."""
     header = dict()
     info_pos = dict()
     info_tra = dict()
@@ -223,7 +205,9 @@ def read_dmr(filename, rearrange_data_axes=True):
                         content = content.split()
                         for val in content:
                             graddirs.append(float(val))
-                    graddirs = np.reshape(np.asarray(graddirs), (4, header["NrOfVolumes"]))
+                    # NOTE: One line (X, Y, Z, b-value) per volume
+                    graddirs = np.reshape(np.asarray(graddirs),
+                                          (header["NrOfVolumes"], 4)).T
                     info_grad["Gradients"] = graddirs
                 
             # -----------------------------------------------------------------
@@ -259,10 +243,41 @@ def read_dmr(filename, rearrange_data_axes=True):
     header["Gradient information"] = info_grad
     header["Multiband information"] = info_multiband
 
+    return header
+
+
+# =============================================================================
+def read_dmr(filename, rearrange_data_axes=True):
+    """Read BrainVoyager DMR (and the paired DWI) file.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+
+    Returns
+    -------
+    header : dictionary
+        Pre-data and post-data headers.
+    data : 4D numpy.array, (x, y, slices, directions)
+        Image data.
+    rearrange_data_axes : bool
+        When 'False', axes are intended to follow LIP+ terminology used
+        internally in BrainVoyager (however see the notes below):
+            - 1st axis is Right to "L"eft.
+            - 2nd axis is Superior to "I"nferior.
+            - 3rd axis is Anterior to "P"osterior.
+        When 'True' axes are intended to follow nibabel RAS+ terminology:
+            - 1st axis is Left to "R"ight.
+            - 2nd axis is Posterior to "A"nterior.
+            - 3rd axis is Inferior to "S"uperior.
+
+    """
+    header = _read_dmr_header(filename)
+
     # -------------------------------------------------------------------------
     # Access data from the separate DWI file
-    dirname = os.path.dirname(filename)
-    filename_dwi = os.path.join(dirname, "{}.dwi".format(header["Prefix"]))
+    filename_dwi = _dwi_filename(filename, header)
 
     data_img = read_dwi(filename_dwi, nr_slices=header["NrOfSlices"],
                         nr_directions=header["NrOfVolumes"],
@@ -274,6 +289,245 @@ def read_dmr(filename, rearrange_data_axes=True):
     return header, data_img
 
 
+# =============================================================================
+def _dwi_filename(filename, header):
+    """Path of the DWI file paired with a DMR file."""
+    dirname = os.path.dirname(filename)
+    return os.path.join(dirname, "{}.dwi".format(header["Prefix"]))
+
+
+def shell_index(header, tolerance=50.):
+    """Group DMR volumes by b-value.
+
+    Parameters
+    ----------
+    header : dictionary
+        DMR header with a gradient table.
+    tolerance : float
+        b-values closer than this (s/mm^2) belong to the same shell. Volumes
+        below it are b0 volumes.
+
+    Returns
+    -------
+    shells : dictionary
+        Shell b-value (mean of its volumes, 0 for b0) to 1D numpy.array of
+        volume indices, in increasing b-value order.
+
+    """
+    info_grad = header["Gradient information"]
+    if "Gradients" not in info_grad:
+        raise ValueError("DMR header has no gradient table.")
+    bvals = np.asarray(info_grad["Gradients"][3], dtype=float)
+    order = np.argsort(bvals, kind="stable")
+    bsorted = bvals[order]
+    # A new shell starts wherever the sorted b-values jump
+    starts = np.flatnonzero(np.r_[True, np.diff(bsorted) > tolerance])
+    shells = dict()
+    for volumes in np.split(order, starts[1:]):
+        volumes = np.sort(volumes)
+        bval = float(np.mean(bvals[volumes]))
+        shells[0. if bval < tolerance else round(bval)] = volumes
+    return shells
+
+
+def open_dmr(filename, mode="r", rearrange_data_axes=True, tolerance=50.):
+    """Open BrainVoyager DMR file with its paired DWI file memory mapped.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    mode : string
+        numpy.memmap mode, "r" for reading, "r+" for modifying in place.
+    rearrange_data_axes : bool
+        Axes convention, see `bvbabel.dwi.open_dwi`.
+    tolerance : float
+        b-value tolerance of the shell index, see `shell_index`.
+
+    Returns
+    -------
+    header : dictionary
+        DMR header.
+    data : 4D numpy.memmap, (x, y, slices, directions)
+        Image data as a view on the DWI file. Only the voxels and volumes
+        that are indexed are read, e.g. data[..., shells[0]] reads the b0
+        volumes.
+    shells : dictionary
+        b-value to volume indices (see `shell_index`). Empty without a
+        gradient table.
+
+    """
+    header = _read_dmr_header(filename)
+    data_img = open_dwi(_dwi_filename(filename, header),
+                        nr_slices=header["NrOfSlices"],
+                        nr_directions=header["NrOfVolumes"],
+                        res_x=header["ResolutionX"],
+                        res_y=header["ResolutionY"],
+                        data_type=header["DataType"],
+                        storage_format=header.get("DataStorageFormat", 2),
+                        mode=mode, rearrange_data_axes=rearrange_data_axes)
+    shells = dict()
+    if "Gradients" in header["Gradient information"]:
+        shells = shell_index(header, tolerance)
+    return header, data_img, shells
+
+
+# =============================================================================
+def _tensor_design(header, tolerance=50.):
+    """Log-linear diffusion tensor design matrix, (volumes, 7).
+
+    Columns are ln(S0), Dxx, Dyy, Dzz, Dxy, Dxz, Dyz.
+    """
+    grads = np.asarray(header["Gradient information"]["Gradients"], float)
+    bvecs, bvals = grads[:3].T, grads[3]
+    norm = np.linalg.norm(bvecs, axis=1, keepdims=True)
+    bvecs = np.divide(bvecs, norm, out=np.zeros_like(bvecs), where=norm > 0)
+    bvals = np.where(bvals < tolerance, 0, bvals)
+    gx, gy, gz = bvecs.T
+    return np.stack([np.ones_like(bvals),
+                     -bvals * gx * gx, -bvals * gy * gy, -bvals * gz * gz,
+                     -2 * bvals * gx * gy, -2 * bvals * gx * gz,
+                     -2 * bvals * gy * gz], axis=1)
+
+
+def _fit_tensor_chunk(signal, design, pinv, outer):
+    """Weighted least squares tensor fit of (voxels, volumes) signals.
+
+    Returns (voxels, 7) maps: FA, MD, AD, RD and the principal eigenvector.
+    """
+    log_signal = np.log(np.maximum(signal, 1e-6))
+    # Ordinary least squares start, predicted signals give the weights
+    params = log_signal @ pinv.T
+    predicted = params @ design.T
+    # Squared predicted signals, scaled per voxel to avoid overflow
+    weights = np.exp(2 * (predicted - np.max(predicted, axis=1,
+                                             keepdims=True)))
+    # Weighted normal equations for all voxels at once
+    lhs = np.reshape(weights @ outer, (-1, 7, 7))
+    rhs = (weights * log_signal) @ design
+    # Singular or ill conditioned systems (e.g. weights that underflow) are
+    # solved per voxel by pseudo-inverse, the rest of the chunk at once.
+    # Voxels with non-finite systems keep the ordinary least squares fit.
+    good = np.all(np.isfinite(lhs), axis=(1, 2))
+    bad = np.copy(good)
+    sv = np.linalg.svd(lhs[good], compute_uv=False)
+    good[good] = sv[:, -1] > RCOND * sv[:, 0]
+    bad &= ~good
+    params[good] = np.linalg.solve(lhs[good], rhs[good, :, None])[..., 0]
+    if np.any(bad):
+        params[bad] = (np.linalg.pinv(lhs[bad], rcond=RCOND)
+                       @ rhs[bad, :, None])[..., 0]
+
+    dxx, dyy, dzz, dxy, dxz, dyz = params[:, 1:].T
+    tensors = np.stack([np.stack([dxx, dxy, dxz], axis=-1),
+                        np.stack([dxy, dyy, dyz], axis=-1),
+                        np.stack([dxz, dyz, dzz], axis=-1)], axis=-2)
+    evals, evecs = np.linalg.eigh(tensors)  # Ascending eigenvalues
+    evals = np.maximum(evals, 0)
+    l3, l2, l1 = evals.T
+    md = (l1 + l2 + l3) / 3
+    norm = np.sqrt(l1**2 + l2**2 + l3**2)
+    fa = np.sqrt(1.5 * ((l1 - md)**2 + (l2 - md)**2 + (l3 - md)**2))
+    fa = np.divide(fa, norm, out=np.zeros_like(fa), where=norm > 0)
+    return np.column_stack([fa, md, l1, (l2 + l3) / 2, evecs[:, :, 2]])
+
+
+def fit_tensor(filename, outname=None, mask=None, b0_threshold=None,
+               tolerance=50., slab_size=4, nr_threads=None):
+    """Fit diffusion tensors to DMR/DWI data and save DTI maps as a VMP.
+
+    The log-linear model is fitted by weighted least squares. The ordinary
+    least squares start uses a single pseudo-inverse of the B-matrix, the
+    weighted refit solves all voxel 7x7 systems of a chunk at once. Chunks
+    of slices are read from the memory mapped DWI file in parallel.
+
+    Parameters
+    ----------
+    filename : string
+        Path to DMR file, with gradient table.
+    outname : string
+        Output VMP path. Defaults to "<input>_bvbabel-DTI.vmp".
+    mask : 3D numpy.array
+        Voxels to fit, in `open_dmr` orientation. Defaults to voxels with a
+        mean b0 signal above `b0_threshold`.
+    b0_threshold : float
+        Defaults to 10% of the 99th percentile of the mean b0 signal.
+    tolerance : float
+        b-values below this are treated as b0 (s/mm^2).
+    slab_size : integer
+        Number of slices per chunk.
+    nr_threads : integer
+        Number of worker threads.
+
+    Returns
+    -------
+    header : dictionary
+        VMP header.
+    data : 4D numpy.array, (x, y, slices, 7)
+        FA, MD, AD, RD (mm^2/s for b-values in s/mm^2) and the X, Y, Z
+        components of the principal eigenvector, in gradient table axes.
+        The VMP is defined on the native DMR grid (bounding box starting at
+        0, resolution 1); use `bvbabel.resample` to move it into VMR space.
+
+    """
+    header, data_img, shells = open_dmr(filename, tolerance=tolerance)
+    if 0. not in shells:
+        raise ValueError("DMR has no b0 volumes.")
+    design = _tensor_design(header, tolerance)
+    pinv = np.linalg.pinv(design)
+    outer = np.reshape(design[:, :, None] * design[:, None, :], (-1, 49))
+
+    if mask is None:
+        b0 = np.mean(data_img[..., shells[0.]], axis=-1)
+        if b0_threshold is None:
+            b0_threshold = 0.1 * np.percentile(b0, 99)
+        mask = b0 > b0_threshold
+    mask = np.asarray(mask, dtype=bool)
+
+    dims = data_img.shape[:3]
+    data_dti = np.zeros(dims + (7,), dtype=np.float32)
+
+    def work(z):
+        inside = mask[:, :, z:z + slab_size]
+        if not np.any(inside):
+            return
+        signal = np.asarray(data_img[:, :, z:z + slab_size], dtype=np.float64)
+        maps = _fit_tensor_chunk(signal[inside], design, pinv, outer)
+        data_dti[:, :, z:z + slab_size][inside] = maps
+
+    with ThreadPoolExecutor(nr_threads) as pool:
+        for _ in pool.map(work, range(0, dims[2], slab_size)):
+            pass
+
+    # -------------------------------------------------------------------------
+    # VMP on the native DMR grid, see `bvbabel.vmp.write_vmp` for the axes
+    header_vmp = create_vmp()[0]
+    header_vmp["NrOfSubMaps"] = np.int32(7)
+    header_vmp["XEnd"], header_vmp["YEnd"], header_vmp["ZEnd"] = (
+        np.int32(dims[1]), np.int32(dims[2]), np.int32(dims[0]))
+    header_vmp["DimX"] = header_vmp["DimY"] = header_vmp["DimZ"] = np.int32(
+        max(dims))
+    header_vmp["NameOfVTCFile"] = os.path.basename(filename)
+    template = header_vmp["Map"][0]
+    header_vmp["Map"] = list()
+    for name, map_type, upper in [("FA", 22, 1), ("MD", 21, 0.003),
+                                  ("AD", 21, 0.003), ("RD", 21, 0.003),
+                                  ("V1 X", 15, 1), ("V1 Y", 15, 1),
+                                  ("V1 Z", 15, 1)]:
+        info = copy.deepcopy(template)
+        info["MapName"] = name
+        info["TypeOfMap"] = np.int32(map_type)
+        info["MapThreshold"] = np.float32(0)
+        info["UpperThreshold"] = np.float32(upper)
+        info["NrOfUsedVoxels"] = np.int32(np.sum(mask))
+        header_vmp["Map"].append(info)
+
+    if outname is None:
+        outname = "{}_bvbabel-DTI.vmp".format(filename.split(os.extsep, 1)[0])
+    write_vmp(outname, header_vmp, data_dti)
+    return header_vmp, data_dti
+
+
 ##FILE = "human31dir_bv214.dmr" # "case1_3_1_default.dmr"
 ##header, data = read_dmr(FILE)
 ##pprint(header)
@@ -60,3 +60,63 @@ def read_dwi(filename, nr_slices, nr_directions, res_x, res_y, data_type=2, rear
         data_img = data_img[:, ::-1, :, :]  # Flip BV axes
 
     return data_img
+
+
+# =============================================================================
+def open_dwi(filename, nr_slices, nr_directions, res_x, res_y, data_type=2,
+             storage_format=2, mode="r", rearrange_data_axes=True):
+    """Open BrainVoyager DWI file as a memory map.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    nr_slices, nr_directions, res_x, res_y, data_type :
+        Same as in `read_dwi`.
+    storage_format : integer, 2, 3 or 4
+        "DataStorageFormat" entry of the DMR file. 2: slice time courses,
+        laid out as in `read_dwi`. 3: one volume after the other. 4: all
+        directions of a voxel next to each other.
+    mode : string
+        numpy.memmap mode, "r" for reading, "r+" for modifying in place.
+    rearrange_data_axes : bool
+        When 'True', axes are the same as in `read_dwi`. When 'False', axes
+        are (res_x, res_y, slices, directions) without flips, regardless of
+        the storage format.
+
+    Returns
+    -------
+    data : 4D numpy.memmap, (x, y, slices, directions)
+        Image data as a strided view on the file. Indexing a subset of
+        directions only reads those from disk.
+
+    """
+    if data_type == 1:
+        dtype = "<H"
+    elif data_type == 2:
+        dtype = "<f"
+    else:
+        raise ValueError("Unrecognized DWI data type.")
+
+    if storage_format == 2:
+        data_img = np.memmap(filename, dtype=dtype, mode=mode,
+                             shape=(nr_slices, nr_directions, res_x, res_y))
+        data_img = np.transpose(data_img, (2, 3, 0, 1))
+    elif storage_format == 3:
+        data_img = np.memmap(filename, dtype=dtype, mode=mode,
+                             shape=(nr_directions, nr_slices, res_x, res_y))
+        data_img = np.transpose(data_img, (2, 3, 1, 0))
+    elif storage_format == 4:
+        data_img = np.memmap(filename, dtype=dtype, mode=mode,
+                             shape=(nr_slices, res_x, res_y, nr_directions))
+        data_img = np.transpose(data_img, (1, 2, 0, 3))
+    else:
+        raise ValueError("Unsupported DWI storage format {}.".format(
+            storage_format))
+
+    # Now (res_x, res_y, slices, directions), same as the reshape of read_dwi
+    if rearrange_data_axes is True:
+        data_img = np.transpose(data_img, (1, 0, 2, 3))
+        data_img = data_img[:, ::-1, :, :]  # Flip BV axes
+
+    return data_img
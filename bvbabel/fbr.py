@@ -1,6 +1,14 @@
 """Read, write BrainVoyager FBR file format (binary encoded)"""
 
+import os
+import copy
 import struct
+import queue
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from bvbabel.labels import label_statistics
+from bvbabel.resample import grid
+from bvbabel.vmp import create_vmp, write_vmp
 
 # =============================================================================
 def read_fbr(filename):
@@ -175,4 +183,819 @@ def write_fbr(output_filename, header, groups):
                 # then all colours R then G and then B
                 f.write(struct.pack(f'<{fiber["NrOfPoints"]}B', *fiber['Rcolour']))
                 f.write(struct.pack(f'<{fiber["NrOfPoints"]}B', *fiber['Gcolour']))
-                f.write(struct.pack(f'<{fiber["NrOfPoints"]}B', *fiber['Bcolour']))
\ No newline at end of file
+                f.write(struct.pack(f'<{fiber["NrOfPoints"]}B', *fiber['Bcolour']))
+
+# =============================================================================
+# Array based fiber representation
+# =============================================================================
+def _read_fbr_header(f):
+    """Read FBR header from an open file, leaving it at the first group."""
+    header = dict()
+    magic = f.read(4)
+    if magic != b'\xa4\xd3\xc2\xb1':  # magic number verification
+        raise ValueError("FBR file has invalid magic number")
+    header['MagicNumber'] = magic
+    header['FileVersion'] = struct.unpack('<I', f.read(4))[0]
+    header['CoordsType'] = struct.unpack('<I', f.read(4))[0]
+    fibers_origin = struct.unpack('<3f', f.read(12))
+    header['FibersOriginX'] = fibers_origin[0]
+    header['FibersOriginY'] = fibers_origin[1]
+    header['FibersOriginZ'] = fibers_origin[2]
+    header['NrOfGroups'] = struct.unpack('<I', f.read(4))[0]
+    return header
+
+
+def _write_fbr_header(f, header):
+    """Write FBR header into an open file."""
+    f.write(b'\xa4\xd3\xc2\xb1')  # magic number writing
+    f.write(struct.pack('<I', header['FileVersion']))
+    f.write(struct.pack('<I', header['CoordsType']))
+    f.write(struct.pack('<3f', header['FibersOriginX'],
+                        header['FibersOriginY'], header['FibersOriginZ']))
+    f.write(struct.pack('<I', header['NrOfGroups']))
+
+
+def _read_group_header(f):
+    """Read group information, leaving the file at the first fiber."""
+    group = dict()
+    group_name = bytearray()
+    while True:
+        char = f.read(1)
+        if char == b'\x00' or char == b'':  # '0' terminated character
+            break
+        group_name += char
+    group['Name'] = group_name.decode('latin-1')
+    group['Visible'] = struct.unpack('<I', f.read(4))[0]
+    group['Animate'] = struct.unpack('<i', f.read(4))[0]
+    group['Thickness'] = struct.unpack('<f', f.read(4))[0]
+    group['Color'] = struct.unpack('<3B', f.read(3))
+    group['NrOfFibers'] = struct.unpack('<I', f.read(4))[0]
+    return group
+
+
+def _write_group_header(f, group):
+    """Write group information into an open file."""
+    f.write(group['Name'].encode('latin-1') + b'\x00')
+    f.write(struct.pack('<I', group['Visible']))
+    f.write(struct.pack('<i', group['Animate']))
+    f.write(struct.pack('<f', group['Thickness']))
+    f.write(struct.pack('<3B', *group['Color']))
+    f.write(struct.pack('<I', group['NrOfFibers']))
+
+
+def _scan_fibers(buf, pos, nr_fibers):
+    """Find fiber records in a bytes buffer.
+
+    Stops early at an incomplete record at the end of the buffer.
+
+    Returns
+    -------
+    starts, counts : 1D numpy.arrays, int64
+        Byte position and number of points of each complete fiber.
+    pos : integer
+        Position after the last complete fiber.
+
+    """
+    starts, counts = list(), list()
+    size = len(buf)
+    unpack = struct.Struct('<I').unpack_from
+    for _ in range(nr_fibers):
+        if pos + 4 > size:
+            break
+        n, = unpack(buf, pos)
+        if pos + 4 + 15 * n > size:
+            break
+        starts.append(pos)
+        counts.append(n)
+        pos += 4 + 15 * n
+    return (np.asarray(starts, dtype=np.int64),
+            np.asarray(counts, dtype=np.int64), pos)
+
+
+def _fiber_layout(starts, counts):
+    """Byte masks and point order of a contiguous run of fiber records.
+
+    Each record is the number of points n (4 bytes), the X, Y and Z
+    coordinates (3 * n floats) and the R, G and B colours (3 * n bytes).
+
+    Returns
+    -------
+    coords_mask, colors_mask : 1D numpy.arrays, bool
+        Coordinate and colour bytes, relative to the first record.
+    offsets : 1D numpy.array, int64, (nr fibers + 1)
+        First point of each fiber.
+    planar : 1D numpy.array, int64, (nr points * 3)
+        Position of each (point, axis) value within the per fiber planar
+        (X..., Y..., Z...) value order of the records.
+
+    """
+    # Record parts: count (4 bytes), coordinates (12 n), colours (3 n)
+    lengths = np.stack([np.full(counts.size, 4), 12 * counts, 3 * counts],
+                       axis=1).ravel()
+    parts = np.tile(np.arange(3, dtype=np.uint8), counts.size)
+    parts = np.repeat(parts, lengths)
+
+    offsets = np.zeros(counts.size + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    fiber = np.repeat(np.arange(counts.size), counts)
+    local = np.arange(offsets[-1]) - offsets[fiber]
+    planar = (3 * offsets[fiber] + local)[:, None] + (
+        counts[fiber][:, None] * np.arange(3))
+    return parts == 1, parts == 2, offsets, planar
+
+
+def _gather_fibers(buf, starts, counts):
+    """Points, colours and fiber offsets of scanned fiber records."""
+    if counts.size == 0:
+        return (np.zeros((0, 3), dtype=np.float32),
+                np.zeros((0, 3), dtype=np.uint8), np.zeros(1, dtype=np.int64))
+    coords_mask, colors_mask, offsets, planar = _fiber_layout(starts, counts)
+    buf = np.frombuffer(buf, dtype=np.uint8, count=coords_mask.size,
+                        offset=int(starts[0]))
+    points = buf[coords_mask].view('<f4')[planar]
+    colors = buf[colors_mask][planar]
+    return points, colors, offsets
+
+
+def _pack_fibers(points, colors, offsets):
+    """Encode fibers into FBR fiber records."""
+    counts = np.diff(offsets).astype(np.int64)
+    if counts.size == 0:
+        return np.zeros(0, dtype=np.uint8)
+    starts = np.zeros(counts.size, dtype=np.int64)
+    np.cumsum(4 + 15 * counts[:-1], out=starts[1:])
+    coords_mask, colors_mask, _, planar = _fiber_layout(starts, counts)
+
+    buf = np.zeros(coords_mask.size, dtype=np.uint8)
+    buf[starts[:, None] + np.arange(4)] = (
+        counts.astype('<u4').view(np.uint8).reshape(-1, 4))
+    values = np.zeros(planar.size, dtype='<f4')
+    values[planar] = points
+    buf[coords_mask] = values.view(np.uint8)
+    values = np.zeros(planar.size, dtype=np.uint8)
+    values[planar] = colors
+    buf[colors_mask] = values
+    return buf
+
+
+def read_fbr_arrays(filename, batch_size=100000, buffer_size=2**24):
+    """Read BrainVoyager FBR file into contiguous arrays.
+
+    The file is read in chunks (see `iter_fbr`) straight into the output
+    arrays, so memory use stays close to the size of the result.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    batch_size : integer
+        Number of fibers decoded at once.
+    buffer_size : integer
+        Number of bytes read from disk at once.
+
+    Returns
+    -------
+    header : dictionary
+        FBR header data, same as in `read_fbr`.
+    groups : list of dictionaries
+        Group information as in `read_fbr`, with the fibers of each group
+        stored as:
+            "Points" : 2D numpy.array, float32, (nr points, XYZ)
+            "Colors" : 2D numpy.array, uint8, (nr points, RGB)
+            "Offsets" : 1D numpy.array, int64, (nr fibers + 1)
+                Points of fiber i are Points[Offsets[i]:Offsets[i + 1]].
+
+    """
+    file_size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        stream = _FiberStream(f, buffer_size)
+        header = _read_fbr_header(stream)
+        header['FBRFile'] = filename
+
+        groups = list()
+        for _ in range(header['NrOfGroups']):
+            group = _read_group_header(stream)
+            nr_fibers = group['NrOfFibers']
+            # Each point takes 15 bytes, which bounds the number of points.
+            # Pages of the bound beyond the actual points are never touched.
+            pos = f.tell() - len(stream.buf) + stream.pos
+            max_points = max((file_size - pos - 4 * nr_fibers) // 15, 0)
+            points = np.empty((max_points, 3), dtype=np.float32)
+            colors = np.empty((max_points, 3), dtype=np.uint8)
+            offsets = np.zeros(nr_fibers + 1, dtype=np.int64)
+            n = 0
+            for i in range(0, nr_fibers, batch_size):
+                p, c, o = stream.fibers(min(batch_size, nr_fibers - i))
+                points[n:n + p.shape[0]] = p
+                colors[n:n + p.shape[0]] = c
+                offsets[i + 1:i + o.size] = o[1:] + n
+                n += p.shape[0]
+            points.resize((n, 3), refcheck=False)
+            colors.resize((n, 3), refcheck=False)
+            group['Points'] = points
+            group['Colors'] = colors
+            group['Offsets'] = offsets
+            groups.append(group)
+
+    return header, groups
+
+
+def write_fbr_arrays(filename, header, groups, batch_size=100000):
+    """Write BrainVoyager FBR file from contiguous arrays.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file to be created.
+    header : dictionary
+        Fibers (FBR) header.
+    groups : list of dictionaries
+        Groups as returned by `read_fbr_arrays`. "NrOfFibers" is taken from
+        the "Offsets".
+    batch_size : integer
+        Number of fibers encoded and written at once.
+
+    """
+    header = dict(header)
+    header['NrOfGroups'] = len(groups)
+    with open(filename, 'wb') as f:
+        _write_fbr_header(f, header)
+        for group in groups:
+            offsets = np.asarray(group['Offsets'], dtype=np.int64)
+            group = dict(group)
+            group['NrOfFibers'] = offsets.size - 1
+            _write_group_header(f, group)
+            for i in range(0, group['NrOfFibers'], batch_size):
+                o = offsets[i:i + batch_size + 1]
+                a, b = o[0], o[-1]
+                f.write(_pack_fibers(group['Points'][a:b],
+                                     group['Colors'][a:b], o - a).tobytes())
+
+
+# =============================================================================
+# Streaming access
+# =============================================================================
+class _FiberStream:
+    """Buffered reading of FBR headers and fiber batches from a file."""
+
+    def __init__(self, f, buffer_size):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.buf = b''
+        self.pos = 0
+
+    def _more(self, nr_bytes):
+        """Drop consumed bytes and append at least nr_bytes from the file."""
+        data = self.f.read(max(nr_bytes, self.buffer_size))
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return len(data) > 0
+
+    def read(self, nr_bytes):
+        if len(self.buf) - self.pos < nr_bytes:
+            self._more(nr_bytes)
+        data = self.buf[self.pos:self.pos + nr_bytes]
+        self.pos += len(data)
+        return data
+
+    def fibers(self, nr_fibers):
+        """Decode the next fibers into points, colours and offsets."""
+        starts, counts = [], []
+        nr_found = 0
+        pos = self.pos
+        while True:
+            s, c, pos = _scan_fibers(self.buf, pos, nr_fibers - nr_found)
+            starts.append(s)
+            counts.append(c)
+            nr_found += c.size
+            if nr_found == nr_fibers:
+                break
+            # Keep the scanned part, shift its positions with the buffer.
+            # The buffer at least doubles so that large batches stay linear.
+            shift = self.pos
+            if not self._more(len(self.buf) - self.pos):
+                raise ValueError("FBR file ends within a fiber.")
+            starts = [s - shift for s in starts]
+            pos -= shift
+        starts, counts = np.concatenate(starts), np.concatenate(counts)
+        result = _gather_fibers(self.buf, starts, counts)
+        self.pos = pos
+        return result
+
+
+def read_fbr_header(filename):
+    """Read only the header of a BrainVoyager FBR file.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+
+    Returns
+    -------
+    header : dictionary
+        FBR header data, same as in `read_fbr`.
+
+    """
+    with open(filename, 'rb') as f:
+        header = _read_fbr_header(f)
+    header['FBRFile'] = filename
+    return header
+
+
+def iter_fbr(filename, batch_size=10000, buffer_size=2**24):
+    """Iterate over the fibers of a BrainVoyager FBR file in batches.
+
+    Only the current batch and a read buffer are held in memory.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    batch_size : integer
+        Maximum number of fibers per batch. Batches do not cross groups.
+        Groups without fibers are yielded once with empty arrays.
+    buffer_size : integer
+        Number of bytes read from disk at once.
+
+    Yields
+    ------
+    group : dictionary
+        Group information as in `read_fbr` (without fibers). The same
+        dictionary is yielded for all batches of a group.
+    points : 2D numpy.array, float32, (nr points, XYZ)
+    colors : 2D numpy.array, uint8, (nr points, RGB)
+    offsets : 1D numpy.array, int64, (nr fibers + 1)
+        Fiber boundaries within the batch, see `read_fbr_arrays`.
+
+    """
+    with open(filename, 'rb') as f:
+        stream = _FiberStream(f, buffer_size)
+        header = _read_fbr_header(stream)
+        for _ in range(header['NrOfGroups']):
+            group = _read_group_header(stream)
+            if group['NrOfFibers'] == 0:
+                points, colors, offsets = stream.fibers(0)
+                yield group, points, colors, offsets
+            for i in range(0, group['NrOfFibers'], batch_size):
+                nr_fibers = min(batch_size, group['NrOfFibers'] - i)
+                points, colors, offsets = stream.fibers(nr_fibers)
+                yield group, points, colors, offsets
+
+
+class FBRWriter:
+    """Write a BrainVoyager FBR file group by group and batch by batch.
+
+    The numbers of groups and fibers are counted while writing and patched
+    into the file when it is closed.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file to be created.
+    header : dictionary
+        Fibers (FBR) header.
+
+    Examples
+    --------
+    >>> header = bvbabel.fbr.read_fbr_header("in.fbr")
+    >>> with bvbabel.fbr.FBRWriter("out.fbr", header) as writer:
+    ...     for group, points, colors, offsets in bvbabel.fbr.iter_fbr("in.fbr"):
+    ...         if group is not writer.group_source:
+    ...             writer.start_group(group)
+    ...         writer.write_fibers(points, colors, offsets)
+
+    """
+
+    def __init__(self, filename, header):
+        self.f = open(filename, 'wb')
+        header = dict(header)
+        header['NrOfGroups'] = 0
+        _write_fbr_header(self.f, header)
+        self.nr_groups = 0
+        self.nr_fibers = 0
+        self.group_source = None
+        self._nr_fibers_pos = None
+
+    def start_group(self, group):
+        """Start a new group with the information of a group dictionary."""
+        self._finish_group()
+        self.group_source = group
+        group = dict(group)
+        group['NrOfFibers'] = 0
+        _write_group_header(self.f, group)
+        self._nr_fibers_pos = self.f.tell() - 4
+        self.nr_groups += 1
+        self.nr_fibers = 0
+
+    def write_fibers(self, points, colors, offsets):
+        """Append fibers (see `read_fbr_arrays`) to the current group."""
+        if self._nr_fibers_pos is None:
+            raise ValueError("Call start_group before writing fibers.")
+        offsets = np.asarray(offsets, dtype=np.int64)
+        a, b = offsets[0], offsets[-1]
+        self.f.write(_pack_fibers(points[a:b], colors[a:b],
+                                  offsets - a).tobytes())
+        self.nr_fibers += offsets.size - 1
+
+    def _finish_group(self):
+        if self._nr_fibers_pos is not None:
+            end = self.f.tell()
+            self.f.seek(self._nr_fibers_pos)
+            self.f.write(struct.pack('<I', self.nr_fibers))
+            self.f.seek(end)
+
+    def close(self):
+        """Patch the group and fiber counts and close the file."""
+        if self.f.closed:
+            return
+        self._finish_group()
+        self.f.seek(24)  # NrOfGroups, after magic, version, type and origin
+        self.f.write(struct.pack('<I', self.nr_groups))
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# =============================================================================
+# Spatial index
+# =============================================================================
+def _voxel_shift(header):
+    """Shift from fiber coordinates to VMR voxel coordinates (VOI axes)."""
+    if header['CoordsType'] == 2:  # BVI, already VMR voxel coordinates
+        return np.zeros(3, dtype=np.float32)
+    if header['CoordsType'] == 1:  # SYS, relative to the fibers origin
+        return np.array([header['FibersOriginX'], header['FibersOriginY'],
+                         header['FibersOriginZ']], dtype=np.float32)
+    raise ValueError("Fiber coordinates type {} is not supported.".format(
+        header['CoordsType']))
+
+
+def _fiber_voxels(points, offsets, dims, step):
+    """Unique (voxel, fiber) keys of fibers sampled along their segments.
+
+    Returns int64 keys, flat voxel index (x fastest) times 2^32 plus the
+    fiber number within the batch.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    counts = np.diff(offsets)
+    fiber = np.repeat(np.arange(counts.size), counts)
+    # Subdivide segments so that no voxel on the way is skipped
+    last = np.zeros(points.shape[0], dtype=bool)
+    last[offsets[1:][counts > 0] - 1] = True
+    delta = np.zeros_like(points)
+    delta[:-1] = points[1:] - points[:-1]
+    delta[last] = 0
+    nr_sub = np.ceil(np.max(np.abs(delta), axis=1) / step).astype(np.int64)
+    nr_sub = np.maximum(nr_sub, 1)
+    idx = np.repeat(np.arange(points.shape[0]), nr_sub)
+    frac = np.arange(idx.size) - np.repeat(np.cumsum(nr_sub) - nr_sub, nr_sub)
+    frac = frac / nr_sub[idx]
+    xyz = np.floor(points[idx] + frac[:, None] * delta[idx] + 0.5)
+    xyz = xyz.astype(np.int64)
+
+    inside = np.all((xyz >= 0) & (xyz < np.asarray(dims)), axis=1)
+    xyz = xyz[inside]
+    voxel = xyz[:, 0] + dims[0] * (xyz[:, 1] + dims[1] * xyz[:, 2])
+    return np.unique((voxel << 32) + fiber[idx[inside]])
+
+
+def build_fiber_index(filename, dims=(256, 256, 256), step=0.5,
+                      batch_size=100000):
+    """Build a voxel to fiber index of a BrainVoyager FBR file.
+
+    Fibers are streamed from disk (see `iter_fbr`) and sampled along their
+    segments, so that every VMR voxel a fiber passes through is indexed.
+
+    Parameters
+    ----------
+    filename : string
+        Path to FBR file. Fiber coordinates must be BVI (VMR voxel
+        coordinates) or SYS (relative to the fibers origin).
+    dims : tuple of three integers
+        VMR dimensions along the VOI x, y, z axes (framing cube).
+    step : float
+        Sampling distance along fiber segments in voxels.
+    batch_size : integer
+        Number of fibers processed at once.
+
+    Returns
+    -------
+    index : dictionary
+        "voxels" : 1D numpy.array, int64
+            Sorted flat indices (x + DimX * (y + DimY * z)) of the voxels
+            that contain fibers.
+        "indptr" : 1D numpy.array, int64, (nr voxels + 1)
+            Fibers of voxels[i] are fibers[indptr[i]:indptr[i + 1]].
+        "fibers" : 1D numpy.array, int32
+            Fiber numbers, counted over all groups in file order.
+        "groups" : 1D numpy.array, int64, (nr groups + 1)
+            First fiber number of each group.
+        "dims" : 1D numpy.array, int64, (3)
+            Grid dimensions.
+
+    """
+    header = read_fbr_header(filename)
+    shift = _voxel_shift(header)
+    dims = np.asarray(dims, dtype=np.int64)
+
+    keys, groups = [], [0]
+    nr_fibers, group_last = 0, None
+    for group, points, colors, offsets in iter_fbr(filename, batch_size):
+        if group is not group_last:
+            if group_last is not None:
+                groups.append(nr_fibers)
+            group_last = group
+        k = _fiber_voxels(points + shift, offsets, dims, step)
+        keys.append(k + nr_fibers)  # Fiber numbers stay below 2^32
+        nr_fibers += offsets.size - 1
+    if group_last is not None:
+        groups.append(nr_fibers)
+
+    keys = np.sort(np.concatenate(keys or [np.zeros(0, dtype=np.int64)]))
+    voxels, starts = np.unique(keys >> 32, return_index=True)
+    index = dict()
+    index["voxels"] = voxels
+    index["indptr"] = np.append(starts, keys.size).astype(np.int64)
+    index["fibers"] = (keys & 0xFFFFFFFF).astype(np.int32)
+    index["groups"] = np.asarray(groups, dtype=np.int64)
+    index["dims"] = dims
+    return index
+
+
+def fiber_index(filename, dims=(256, 256, 256), step=0.5, cache=True):
+    """Load the cached fiber index of an FBR file, or build and cache it.
+
+    The index is stored next to the FBR file as
+    "<name>_bvbabel-fiberindex.npz" and rebuilt when the FBR file changed.
+
+    Parameters
+    ----------
+    filename : string
+        Path to FBR file.
+    dims, step :
+        See `build_fiber_index`.
+    cache : bool
+        Read and write the index file.
+
+    Returns
+    -------
+    index : dictionary
+        See `build_fiber_index`.
+
+    """
+    stat = os.stat(filename)
+    source = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    cachename = os.path.splitext(filename)[0] + "_bvbabel-fiberindex.npz"
+    if cache and os.path.isfile(cachename):
+        with np.load(cachename) as npz:
+            index = {key: npz[key] for key in npz.files}
+        if (np.array_equal(index.pop("source"), source)
+                and np.array_equal(index["dims"], dims)
+                and index.pop("step") == step):
+            return index
+
+    index = build_fiber_index(filename, dims, step)
+    if cache:
+        np.savez(cachename, source=source, step=step, **index)
+    return index
+
+
+def regions_from_mask(header, data_img):
+    """Voxel coordinates of each label of a VMR or MSK mask.
+
+    Parameters
+    ----------
+    header : dictionary
+        VMR or MSK header.
+    data_img : 3D numpy.array
+        Mask or label image (`bvbabel.vmr.read_vmr`, `bvbabel.msk.read_msk`).
+
+    Returns
+    -------
+    regions : list of 2D numpy.arrays, (nr voxels, XYZ)
+        One region per nonzero label, in increasing label order.
+
+    """
+    return label_statistics(header, data_img)["coordinates"]
+
+
+def query_fibers(index, regions):
+    """Find the fibers passing through each of many regions in one pass.
+
+    Parameters
+    ----------
+    index : dictionary
+        Fiber index (see `fiber_index`).
+    regions : list
+        VOIs (dictionaries from `bvbabel.voi.read_voi`) or voxel
+        coordinate arrays (nr voxels, XYZ) in VOI axes, e.g. from
+        `regions_from_mask`.
+
+    Returns
+    -------
+    hits : 2D numpy.array, bool, (nr regions, nr fibers)
+        Whether a fiber passes through a region.
+
+    """
+    dims = index["dims"]
+    coords, labels = [], []
+    for i, region in enumerate(regions):
+        if isinstance(region, dict):
+            region = region["Coordinates"]
+        region = np.reshape(np.asarray(region, dtype=np.int64), (-1, 3))
+        coords.append(region)
+        labels.append(np.full(region.shape[0], i))
+    coords = np.concatenate(coords or [np.zeros((0, 3), dtype=np.int64)])
+    labels = np.concatenate(labels or [np.zeros(0, dtype=np.int64)])
+
+    inside = np.all((coords >= 0) & (coords < dims), axis=1)
+    coords, labels = coords[inside], labels[inside]
+    voxel = coords[:, 0] + dims[0] * (coords[:, 1] + dims[1] * coords[:, 2])
+
+    # Occupied voxels of all regions and their fiber lists
+    pos = np.searchsorted(index["voxels"], voxel)
+    found = pos < index["voxels"].size
+    found[found] = index["voxels"][pos[found]] == voxel[found]
+    pos, labels = pos[found], labels[found]
+    starts, ends = index["indptr"][pos], index["indptr"][pos + 1]
+    lengths = ends - starts
+    entries = (np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths)
+                                                    + lengths, lengths))
+
+    nr_fibers = int(index["groups"][-1]) if index["groups"].size > 0 else 0
+    hits = np.zeros((len(regions), nr_fibers), dtype=bool)
+    hits[np.repeat(labels, lengths), index["fibers"][entries]] = True
+    return hits
+
+
+def select_fibers(index, include=(), exclude=(), mode="all"):
+    """Select fibers by inclusion and exclusion regions (virtual dissection).
+
+    Parameters
+    ----------
+    index : dictionary
+        Fiber index (see `fiber_index`).
+    include : list
+        Regions (see `query_fibers`) fibers have to pass through. All fibers
+        when empty.
+    exclude : list
+        Regions fibers must not touch.
+    mode : string
+        "all": pass through every inclusion region, "any": through at least
+        one of them.
+
+    Returns
+    -------
+    fibers : 1D numpy.array, int64
+        Selected fiber numbers. Group and fiber within the group are
+        `g = numpy.searchsorted(index["groups"], fibers, "right") - 1` and
+        `fibers - index["groups"][g]`.
+
+    """
+    if mode not in ("all", "any"):
+        raise ValueError("Unknown selection mode '{}'.".format(mode))
+    hits = query_fibers(index, list(include) + list(exclude))
+    keep = np.ones(hits.shape[1], dtype=bool)
+    if len(include) > 0:
+        inc = hits[:len(include)]
+        keep = np.all(inc, axis=0) if mode == "all" else np.any(inc, axis=0)
+    keep &= ~np.any(hits[len(include):], axis=0)
+    return np.flatnonzero(keep)
+
+
+# =============================================================================
+# Density maps
+# =============================================================================
+def _density_voxels(points, offsets, mode, dims, start, res, step):
+    """Flat grid voxel indices hit by a batch of fibers, with repeats."""
+    # VMR voxel coordinates to continuous grid voxel coordinates
+    points = (points.astype(np.float64) + 0.5 - start) / res - 0.5
+    if mode == "segments":
+        return _fiber_voxels(points, offsets, dims, step / res) >> 32
+    if mode == "endpoints":
+        counts = np.diff(offsets)
+        ends = np.concatenate([offsets[:-1], offsets[1:] - 1])
+        points = points[ends[np.tile(counts > 0, 2)]]
+    xyz = np.floor(points + 0.5).astype(np.int64)
+    xyz = xyz[np.all((xyz >= 0) & (xyz < dims), axis=1)]
+    return xyz[:, 0] + dims[0] * (xyz[:, 1] + dims[1] * xyz[:, 2])
+
+
+def density_map(filename, outname=None, header_target=None, mode="segments",
+                fibers=None, step=0.5, batch_size=100000, nr_threads=None):
+    """Rasterize the fibers of an FBR file into a density map VMP.
+
+    Fibers are streamed from disk (see `iter_fbr`), so memory use does not
+    depend on the number of fibers. Worker threads rasterize batches into a
+    few partial count volumes which are summed at the end.
+
+    Parameters
+    ----------
+    filename : string
+        Path to FBR file, with BVI or SYS fiber coordinates.
+    outname : string
+        Output VMP path. Defaults to "<input>_bvbabel-TDI.vmp". Nothing is
+        written when False.
+    header_target : dictionary
+        VMR, VMP or VTC header defining the grid. Defaults to the 256^3 VMR
+        framing cube at resolution 1.
+    mode : string
+        "segments": number of fibers passing through each voxel (track
+        density). "points": number of fiber points in each voxel.
+        "endpoints": number of fiber start and end points in each voxel.
+    fibers : 1D numpy.array, int
+        Fiber numbers to include, counted over all groups in file order
+        (e.g. from `select_fibers`). Defaults to all fibers.
+    step : float
+        Sampling distance along fiber segments in VMR voxels.
+    batch_size : integer
+        Number of fibers read and rasterized at once.
+    nr_threads : integer
+        Number of worker threads, each keeping one partial count volume.
+        Defaults to 4.
+
+    Returns
+    -------
+    header : dictionary
+        VMP header.
+    data : 3D numpy.array, float32, (x, y, z)
+        Density map, in the same orientation as `bvbabel.vmp.read_vmp`.
+
+    """
+    if mode not in ("segments", "points", "endpoints"):
+        raise ValueError("Unknown density mode '{}'.".format(mode))
+    header_vmp = create_vmp()[0]
+    if header_target is None:
+        header_target = header_vmp
+    dims, start, res, framing = grid(header_target)
+    dims = np.asarray(dims[::-1], dtype=np.int64)  # As X, Y, Z
+    nr_voxels = int(np.prod(dims))
+    shift = _voxel_shift(read_fbr_header(filename))
+    if fibers is not None:
+        fibers = np.unique(fibers)
+
+    nr_threads = 4 if nr_threads is None else nr_threads
+    partials = queue.Queue()
+    for _ in range(nr_threads):
+        partials.put(np.zeros(nr_voxels, dtype=np.int64))
+
+    def work(points, offsets, first):
+        if fibers is not None:
+            keep = np.isin(np.arange(first, first + offsets.size - 1), fibers)
+            counts = np.diff(offsets)[keep]
+            points = points[np.repeat(keep, np.diff(offsets))]
+            offsets = np.zeros(counts.size + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+        idx = _density_voxels(points + shift, offsets, mode, dims, start,
+                              res, step)
+        counts = np.bincount(idx, minlength=nr_voxels)
+        partial = partials.get()
+        partial += counts
+        partials.put(partial)
+
+    # Keep a bounded number of batches in flight
+    pending = list()
+    nr_fibers = 0
+    with ThreadPoolExecutor(nr_threads) as pool:
+        for group, points, colors, offsets in iter_fbr(filename, batch_size):
+            if len(pending) >= 2 * nr_threads:
+                pending.pop(0).result()
+            pending.append(pool.submit(work, points, offsets, nr_fibers))
+            nr_fibers += offsets.size - 1
+        for future in pending:
+            future.result()
+
+    data = np.zeros(nr_voxels, dtype=np.int64)
+    while not partials.empty():
+        data += partials.get()
+    data = np.reshape(data.astype(np.float32), dims[::-1])  # BV (Z, Y, X)
+    data = np.transpose(data, (0, 2, 1))  # BV to Tal
+    data = data[::-1, ::-1, ::-1]  # Flip BV axes
+
+    # VMP with the bounding box of the target grid
+    header_vmp["XStart"], header_vmp["YStart"], header_vmp["ZStart"] = (
+        np.int32(v) for v in start)
+    header_vmp["XEnd"], header_vmp["YEnd"], header_vmp["ZEnd"] = (
+        np.int32(v) for v in start + dims * res)
+    header_vmp["Resolution"] = np.int32(res)
+    header_vmp["DimX"] = header_vmp["DimY"] = header_vmp["DimZ"] = np.int32(
+        framing)
+    info = copy.deepcopy(header_vmp["Map"][0])
+    info["MapName"] = "Fiber density ({})".format(mode)
+    info["TypeOfMap"] = np.int32(15)
+    info["MapThreshold"] = np.float32(1)
+    info["UpperThreshold"] = np.float32(max(np.percentile(data[data > 0], 99)
+                                            if np.any(data > 0) else 1, 1))
+    info["NrOfUsedVoxels"] = np.int32(np.sum(data > 0))
+    header_vmp["Map"] = [info]
+
+    if outname is None:
+        outname = "{}_bvbabel-TDI.vmp".format(filename.split(os.extsep, 1)[0])
+    if outname is not False:
+        write_vmp(outname, header_vmp, data)
+    return header_vmp, data
@@ -2,36 +2,15 @@
 
 import os
 import numpy as np
-from bvbabel.stc import read_stc, write_stc
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from bvbabel.stc import read_stc, write_stc, open_stc
+from bvbabel.sdm import write_sdm
+from bvbabel.utils import trilinear_sample
 
 
 # =============================================================================
-def read_fmr(filename, rearrange_data_axes=True):
-    """Read BrainVoyager FMR (and the paired STC) file.
-
-    Parameters
-    ----------
-    filename : string
-        Path to file.
-
-    Returns
-    -------
-    header : dictionary
-        Pre-data and post-data headers.
-    data : 4D numpy.array, (x, y, slices, time)
-        Image data.
-    rearrange_data_axes : bool
-        When 'False', axes are intended to follow LIP+ terminology used
-        internally in BrainVoyager (however see the notes below):
-            - 1st axis is Right to "L"eft.
-            - 2nd axis is Superior to "I"nferior.
-            - 3rd axis is Anterior to "P"osterior.
-        When 'True' axes are intended to follow nibabel RAS+ terminology:
-            - 1st axis is Left to "R"ight.
-            - 2nd axis is Posterior to "A"nterior.
-            - 3rd axis is Inferior to "S"uperior.
-
-    """
+def _read_fmr_header(filename):
+    """Read the text header of a BrainVoyager FMR file."""
     header = dict()
     info_pos = dict()
     info_tra = dict()
@@ -247,32 +226,23 @@ def read_fmr(filename, rearrange_data_axes=True):
     header["Transformation information"] = info_tra
     header["Multiband information"] = info_multiband
 
-    # -------------------------------------------------------------------------
-    # Access data from the separate STC file
-    dirname = os.path.dirname(filename)
-    filename_stc = os.path.join(dirname, "{}.stc".format(header["Prefix"]))
-
-    data_img = read_stc(filename_stc, nr_slices=header["NrOfSlices"],
-                        nr_volumes=header["NrOfVolumes"],
-                        res_x=header["ResolutionX"],
-                        res_y=header["ResolutionY"],
-                        data_type=header["DataType"],
-                        rearrange_data_axes=rearrange_data_axes)
-
-    return header, data_img
+    return header
 
 
 # =============================================================================
-def write_fmr(filename, header, data_img, rearrange_data_axes=True):
-    """Protocol to write BrainVoyager FMR (and the paired STC) file.
+def read_fmr(filename, rearrange_data_axes=True):
+    """Read BrainVoyager FMR (and the paired STC) file.
 
     Parameters
     ----------
     filename : string
         Path to file.
+
+    Returns
+    -------
     header : dictionary
-        Information that will be written into FMR file.
-    data_img : 4D numpy.array, (x, y, slices, time)
+        Pre-data and post-data headers.
+    data : 4D numpy.array, (x, y, slices, time)
         Image data.
     rearrange_data_axes : bool
         When 'False', axes are intended to follow LIP+ terminology used
@@ -285,6 +255,29 @@ def write_fmr(filename, header, data_img, rearrange_data_axes=True):
             - 2nd axis is Posterior to "A"nterior.
             - 3rd axis is Inferior to "S"uperior.
 
+    """
+    header = _read_fmr_header(filename)
+
+    # -------------------------------------------------------------------------
+    # Access data from the separate STC file
+    filename_stc = _stc_filename(filename, header)
+
+    data_img = read_stc(filename_stc, nr_slices=header["NrOfSlices"],
+                        nr_volumes=header["NrOfVolumes"],
+                        res_x=header["ResolutionX"],
+                        res_y=header["ResolutionY"],
+                        data_type=header["DataType"],
+                        rearrange_data_axes=rearrange_data_axes)
+
+    return header, data_img
+
+
+# =============================================================================
+def _write_fmr_header(filename, header):
+    """Write the text header of a BrainVoyager FMR file.
+
+    The "Prefix" entry is set to the FMR file name, so that the paired STC
+    file is expected next to it with the same base name.
     """
     info_pos = header["Position information"]
     info_tra = header["Transformation information"]
@@ -412,7 +405,7 @@ def write_fmr(filename, header, data_img, rearrange_data_axes=True):
 
         # ---------------------------------------------------------------------
         # Transformations section
-        if info_tra["NrOfPastSpatialTransformations"] > 0:
+        if info_tra.get("NrOfPastSpatialTransformations", 0) > 0:
             f.write("\n")
             data = info_tra["NrOfPastSpatialTransformations"]
             f.write("NrOfPastSpatialTransformations: {}\n".format(data))
@@ -471,6 +464,35 @@ def write_fmr(filename, header, data_img, rearrange_data_axes=True):
                 f.write("AcqusitionTime: {}\n".format(data))
                 f.write("\n")
 
+
+# =============================================================================
+def write_fmr(filename, header, data_img, rearrange_data_axes=True):
+    """Protocol to write BrainVoyager FMR (and the paired STC) file.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    header : dictionary
+        Information that will be written into FMR file.
+    data_img : 4D numpy.array, (x, y, slices, time)
+        Image data.
+    rearrange_data_axes : bool
+        When 'False', axes are intended to follow LIP+ terminology used
+        internally in BrainVoyager (however see the notes below):
+            - 1st axis is Right to "L"eft.
+            - 2nd axis is Superior to "I"nferior.
+            - 3rd axis is Anterior to "P"osterior.
+        When 'True' axes are intended to follow nibabel RAS+ terminology:
+            - 1st axis is Left to "R"ight.
+            - 2nd axis is Posterior to "A"nterior.
+            - 3rd axis is Inferior to "S"uperior.
+
+    """
+    _write_fmr_header(filename, header)
+    basepath = filename.split(os.extsep, 1)[0]
+    basename = os.path.basename(basepath)
+
     # -------------------------------------------------------------------------
     # Write voxel data as a separate STC file
     dirname = os.path.dirname(filename)
@@ -479,6 +501,412 @@ def write_fmr(filename, header, data_img, rearrange_data_axes=True):
               rearrange_data_axes=rearrange_data_axes)
 
 
+# =============================================================================
+def _stc_filename(filename, header):
+    """Path of the STC file paired with an FMR file."""
+    dirname = os.path.dirname(filename)
+    return os.path.join(dirname, "{}.stc".format(header["Prefix"]))
+
+
+def open_fmr(filename, mode="r", rearrange_data_axes=True):
+    """Open BrainVoyager FMR file with its paired STC file memory mapped.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    mode : string
+        numpy.memmap mode, "r" for reading, "r+" for modifying in place.
+    rearrange_data_axes : bool
+        Axes convention, same as in `read_fmr`.
+
+    Returns
+    -------
+    header : dictionary
+        FMR header.
+    data : 4D numpy.memmap, (x, y, slices, time)
+        Image data as in `read_fmr`, as a view on the STC file.
+
+    """
+    header = _read_fmr_header(filename)
+    data_img = open_stc(_stc_filename(filename, header),
+                        nr_slices=header["NrOfSlices"],
+                        nr_volumes=header["NrOfVolumes"],
+                        res_x=header["ResolutionX"],
+                        res_y=header["ResolutionY"],
+                        data_type=header["DataType"], mode=mode,
+                        rearrange_data_axes=rearrange_data_axes)
+    return header, data_img
+
+
+# =============================================================================
+def slice_timings(header):
+    """Acquisition time of each slice within a volume.
+
+    Parameters
+    ----------
+    header : dictionary
+        FMR header. The multiband "Slice timings" table is used when present.
+        Otherwise the timings are derived from "SliceAcquisitionOrder" and
+        "InterSliceTime" (0: ascending, 1: ascending interleaved, 2: ascending
+        interleaved starting with the 2nd slice, 10, 11, 12: descending
+        versions of these).
+
+    Returns
+    -------
+    timings : 1D numpy.array, (slices)
+        Slice acquisition times in milliseconds.
+
+    """
+    nr_slices = header["NrOfSlices"]
+    info_multiband = header.get("Multiband information", dict())
+    if "Slice timings" in info_multiband:
+        timings = np.asarray(info_multiband["Slice timings"], dtype=float)
+        if timings.size != nr_slices:
+            raise ValueError("Slice timing table size {} does not match {} "
+                             "slices.".format(timings.size, nr_slices))
+        return timings
+
+    order = int(header.get("SliceAcquisitionOrder", -1))
+    if order not in (0, 1, 2, 10, 11, 12):
+        raise ValueError("No slice timing table and unknown slice "
+                         "acquisition order '{}'.".format(order))
+    slices = np.arange(nr_slices)
+    if order % 10 == 0:
+        acquisition = slices
+    elif order % 10 == 1:
+        acquisition = np.concatenate([slices[0::2], slices[1::2]])
+    else:
+        acquisition = np.concatenate([slices[1::2], slices[0::2]])
+    if order >= 10:
+        acquisition = nr_slices - 1 - acquisition
+
+    timings = np.zeros(nr_slices)
+    timings[acquisition] = slices * float(header["InterSliceTime"])
+    return timings
+
+
+def _shift_fft(data, shift):
+    """Shift time courses (time on axis 0) by a fraction of a volume."""
+    nr_volumes = data.shape[0]
+    # Mirror the time courses to avoid wrap around at the edges
+    data = np.concatenate([data, data[::-1]], axis=0)
+    freqs = np.fft.rfftfreq(2 * nr_volumes)
+    phase = np.exp(-2j * np.pi * freqs * shift)
+    phase = np.reshape(phase, (-1,) + (1,) * (data.ndim - 1))
+    data = np.fft.irfft(np.fft.rfft(data, axis=0) * phase,
+                        n=2 * nr_volumes, axis=0)
+    return data[:nr_volumes]
+
+
+def _shift_cubic(data, shift):
+    """Shift time courses (time on axis 0) by cubic convolution."""
+    nr_volumes = data.shape[0]
+    t = np.arange(nr_volumes) - shift
+    t0 = np.floor(t)
+    x = t - t0
+    # Cubic convolution (Keys, a = -0.5) weights of the 4 neighbours
+    weights = [((-0.5 * x + 1) * x - 0.5) * x,
+               (1.5 * x - 2.5) * x * x + 1,
+               ((-1.5 * x + 2) * x + 0.5) * x,
+               (0.5 * x - 0.5) * x * x]
+    out = np.zeros(data.shape, dtype=np.float64)
+    for n in range(4):
+        idx = np.clip(t0.astype(int) + n - 1, 0, nr_volumes - 1)
+        w = np.reshape(weights[n], (-1,) + (1,) * (data.ndim - 1))
+        out += w * data[idx]
+    return out
+
+
+def slice_time_correct(filename, outname=None, method="fft",
+                       reference_time=0., nr_threads=None):
+    """Slice scan time correction of an FMR/STC pair.
+
+    Every slice time course is shifted to the reference time, using the
+    slice timing table (see `slice_timings`). Slices are read from the memory
+    mapped STC file one at a time and processed in parallel.
+
+    Parameters
+    ----------
+    filename : string
+        Path to FMR file.
+    outname : string
+        Output FMR path. Defaults to "<input>_bvbabel-SCCTBL.fmr". The STC
+        file is written next to it.
+    method : string
+        "fft" for sinc (Fourier) interpolation, "cubic" for cubic
+        interpolation.
+    reference_time : float
+        Time within a volume (milliseconds) to which all slices are shifted.
+    nr_threads : integer
+        Number of worker threads.
+
+    Returns
+    -------
+    header : dictionary
+        Output FMR header.
+
+    """
+    if method == "fft":
+        shift_func = _shift_fft
+    elif method == "cubic":
+        shift_func = _shift_cubic
+    else:
+        raise ValueError("Unknown interpolation method '{}'.".format(method))
+
+    header, data_in = open_fmr(filename, rearrange_data_axes=False)
+    shifts = (slice_timings(header) - reference_time) / float(header["TR"])
+
+    if outname is None:
+        outname = "{}_bvbabel-SCCTBL.fmr".format(
+            filename.split(os.extsep, 1)[0])
+    header = dict(header)
+    header["Prefix"] = os.path.basename(outname.split(os.extsep, 1)[0])
+    header["DataType"] = 2
+    _write_fmr_header(outname, header)
+    data_out = open_stc(_stc_filename(outname, header),
+                        nr_slices=header["NrOfSlices"],
+                        nr_volumes=header["NrOfVolumes"],
+                        res_x=header["ResolutionX"],
+                        res_y=header["ResolutionY"],
+                        data_type=2, mode="w+", rearrange_data_axes=False)
+
+    def work(s):
+        data = np.asarray(data_in[:, s], dtype=np.float64)
+        data_out[:, s] = shift_func(data, shifts[s])
+
+    with ThreadPoolExecutor(nr_threads) as pool:
+        for _ in pool.map(work, range(header["NrOfSlices"])):
+            pass
+    data_out.flush()
+    return header
+
+
+# =============================================================================
+def _rigid_matrix(params):
+    """4x4 matrix of translations (mm) and rotations (radians) along X, Y, Z.
+
+    Rotations are applied in X, Y, Z order.
+    """
+    tx, ty, tz, rx, ry, rz = params
+    cx, sx = np.cos(rx), np.sin(rx)
+    cy, sy = np.cos(ry), np.sin(ry)
+    cz, sz = np.cos(rz), np.sin(rz)
+    rot_x = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    rot_y = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rot_z = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    matrix = np.eye(4)
+    matrix[:3, :3] = rot_z @ rot_y @ rot_x
+    matrix[:3, 3] = [tx, ty, tz]
+    return matrix
+
+
+def _rigid_params(matrix):
+    """Inverse of `_rigid_matrix`."""
+    rot = matrix[:3, :3]
+    ry = -np.arcsin(np.clip(rot[2, 0], -1, 1))
+    rx = np.arctan2(rot[2, 1], rot[2, 2])
+    rz = np.arctan2(rot[1, 0], rot[0, 0])
+    return np.r_[matrix[:3, 3], rx, ry, rz]
+
+
+def _pyramid(volume, voxel_size, nr_levels):
+    """Block averaged image pyramid of an (X, Y, Z) volume, coarse first.
+
+    Each level is (image, origin, spacing), voxel centers being at
+    origin + index * spacing in millimeters, relative to the volume center.
+    """
+    volume = np.asarray(volume, dtype=np.float32)
+    voxel_size = np.asarray(voxel_size, dtype=float)
+    origin = -(np.asarray(volume.shape) - 1) / 2 * voxel_size
+    levels = [(volume, origin, voxel_size)]
+    for _ in range(nr_levels - 1):
+        volume, origin, spacing = levels[-1]
+        factor = np.where(np.asarray(volume.shape) >= 32, 2, 1)
+        dims = np.asarray(volume.shape) // factor
+        volume = volume[:dims[0] * factor[0], :dims[1] * factor[1],
+                        :dims[2] * factor[2]]
+        volume = volume.reshape(dims[0], factor[0], dims[1], factor[1],
+                                dims[2], factor[2]).mean(axis=(1, 3, 5))
+        origin = origin + (factor - 1) / 2 * spacing
+        levels.append((volume, origin, spacing * factor))
+    return levels[::-1]
+
+
+def _grid_points(shape, origin, spacing):
+    """Millimeter coordinates of all voxel centers of a grid."""
+    axes = [origin[a] + np.arange(shape[a]) * spacing[a] for a in range(3)]
+    points = np.meshgrid(*axes, indexing="ij")
+    return np.stack([p.ravel() for p in points], axis=1)
+
+
+def _reference_jacobian(volume, origin, spacing):
+    """Grid points and the (points, 6) Jacobian of a reference level."""
+    points = _grid_points(volume.shape, origin, spacing)
+    gx, gy, gz = [np.ravel(g) for g in np.gradient(volume, *spacing)]
+    x, y, z = points.T
+    jacobian = np.stack([gx, gy, gz,
+                         gz * y - gy * z,
+                         gx * z - gz * x,
+                         gy * x - gx * y], axis=1)
+    return points, jacobian
+
+
+def _estimate_rigid(volume, reference, voxel_size, nr_levels=3,
+                    max_iterations=20, tolerance=1e-4):
+    """Gauss-Newton (inverse compositional) rigid registration.
+
+    Parameters
+    ----------
+    volume : 3D numpy.array, (X, Y, Z)
+        Moving volume.
+    reference : list
+        Precomputed reference levels (`_pyramid` followed by
+        `_reference_jacobian`), coarse first.
+    voxel_size : 3 floats
+        Voxel size in millimeters.
+
+    Returns
+    -------
+    matrix : 2D numpy.array, (4, 4)
+        Maps reference millimeter coordinates to moving volume coordinates.
+
+    """
+    matrix = np.eye(4)
+    for (image, origin, spacing), (points, jacobian, ref_values) in zip(
+            _pyramid(volume, voxel_size, nr_levels), reference):
+        for _ in range(max_iterations):
+            moved = points @ matrix[:3, :3].T + matrix[:3, 3]
+            values, inside = trilinear_sample(image, (moved - origin) / spacing)
+            error = (values - ref_values)[inside]
+            jac = jacobian[inside]
+            delta = np.linalg.lstsq(jac.T @ jac, jac.T @ error, rcond=None)[0]
+            matrix = matrix @ np.linalg.inv(_rigid_matrix(delta))
+            if np.max(np.abs(delta)) < tolerance:
+                break
+    return matrix
+
+
+_MC = dict()  # Per process state of the motion correction workers
+
+
+def _mc_init(filename_in, filename_out, dims, data_type, voxel_size,
+             reference, nr_levels):
+    """Motion correction worker initializer."""
+    _MC["in"] = open_stc(filename_in, *dims, data_type=data_type,
+                         rearrange_data_axes=False)
+    _MC["out"] = open_stc(filename_out, *dims, data_type=2, mode="r+",
+                          rearrange_data_axes=False)
+    _MC["voxel_size"] = voxel_size
+    _MC["nr_levels"] = nr_levels
+    levels = _pyramid(np.transpose(_MC["in"][reference], (2, 1, 0)),
+                      voxel_size, nr_levels)
+    _MC["reference"] = list()
+    for image, origin, spacing in levels:
+        points, jacobian = _reference_jacobian(image, origin, spacing)
+        _MC["reference"].append((points, jacobian, np.ravel(image)))
+    _MC["points"] = levels[-1][1], levels[-1][2], _MC["reference"][-1][0]
+
+
+def _mc_volume(t):
+    """Estimate the motion of a volume and write its resampled version."""
+    volume = np.transpose(_MC["in"][t], (2, 1, 0))  # To (X, Y, Z)
+    matrix = _estimate_rigid(volume, _MC["reference"], _MC["voxel_size"],
+                             _MC["nr_levels"])
+    origin, spacing, points = _MC["points"]
+    moved = points @ matrix[:3, :3].T + matrix[:3, 3]
+    values, _ = trilinear_sample(volume, (moved - origin) / spacing)
+    _MC["out"][t] = np.transpose(np.reshape(values, volume.shape), (2, 1, 0))
+    return _rigid_params(matrix)
+
+
+def motion_correct(filename, outname=None, reference=0, nr_levels=3,
+                   nr_processes=None):
+    """Rigid body motion correction of an FMR/STC pair.
+
+    Each volume is registered to the reference volume by minimizing the sum
+    of squared intensity differences with a Gauss-Newton optimizer on a
+    coarse to fine image pyramid, and resampled with trilinear
+    interpolation. Volumes are processed in parallel in worker processes,
+    each reading its volumes directly from the memory mapped STC file.
+
+    Parameters
+    ----------
+    filename : string
+        Path to FMR file.
+    outname : string
+        Output FMR path. Defaults to "<input>_bvbabel-3DMC.fmr". The STC and
+        the motion parameters SDM are written next to it.
+    reference : integer
+        Index of the reference volume.
+    nr_levels : integer
+        Number of pyramid levels.
+    nr_processes : integer
+        Number of worker processes. Defaults to the number of CPUs. With 1,
+        volumes are processed in the calling process.
+
+    Returns
+    -------
+    header : dictionary
+        Output FMR header.
+    params : 2D numpy.array, (volumes, 6)
+        Translations along X, Y, Z (mm) and rotations around X, Y, Z
+        (degrees). X, Y, Z are the STC column, row and slice axes.
+
+    """
+    header = _read_fmr_header(filename)
+    dims = (header["NrOfSlices"], header["NrOfVolumes"],
+            header["ResolutionX"], header["ResolutionY"])
+    voxel_size = (float(header["InplaneResolutionX"]),
+                  float(header["InplaneResolutionY"]),
+                  float(header["SliceThickness"]) + float(header["SliceGap"]))
+
+    if outname is None:
+        outname = "{}_bvbabel-3DMC.fmr".format(filename.split(os.extsep, 1)[0])
+    basepath = outname.split(os.extsep, 1)[0]
+    header_out = dict(header)
+    header_out["Prefix"] = os.path.basename(basepath)
+    header_out["DataType"] = 2
+    _write_fmr_header(outname, header_out)
+    filename_out = _stc_filename(outname, header_out)
+    open_stc(filename_out, *dims, data_type=2, mode="w+").flush()
+
+    initargs = (_stc_filename(filename, header), filename_out, dims,
+                header["DataType"], voxel_size, reference, nr_levels)
+    volumes = range(header["NrOfVolumes"])
+    if nr_processes == 1:
+        _mc_init(*initargs)
+        params = [_mc_volume(t) for t in volumes]
+        _MC["out"].flush()
+        _MC.clear()
+    else:
+        with ProcessPoolExecutor(nr_processes, initializer=_mc_init,
+                                 initargs=initargs) as pool:
+            params = list(pool.map(_mc_volume, volumes, chunksize=8))
+    params = np.asarray(params)
+    params[:, 3:] = np.rad2deg(params[:, 3:])
+
+    # Motion parameters as SDM
+    names = ["Translation BV X [mm]", "Translation BV Y [mm]",
+             "Translation BV Z [mm]", "Rotation BV X [deg]",
+             "Rotation BV Y [deg]", "Rotation BV Z [deg]"]
+    colors = [[255, 0, 0], [0, 255, 0], [0, 0, 255],
+              [255, 255, 0], [255, 0, 255], [0, 255, 255]]
+    header_sdm = dict()
+    header_sdm["FileVersion"] = 1
+    header_sdm["NrOfPredictors"] = 6
+    header_sdm["NrOfDataPoints"] = header["NrOfVolumes"]
+    header_sdm["IncludesConstant"] = 0
+    header_sdm["FirstConfoundPredictor"] = 1
+    data_sdm = list()
+    for i in range(6):
+        data_sdm.append({"NameOfPredictor": names[i],
+                         "ColorOfPredictor": colors[i],
+                         "ValuesOfPredictor": params[:, i]})
+    write_sdm("{}.sdm".format(basepath), header_sdm, data_sdm)
+    return header_out, params
+
+
 def create_fmr():
     """Create BrainVoyager FMR file with default values."""
     header = dict()
@@ -2,6 +2,47 @@
 
 import struct
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+# =============================================================================
+def _read_gtc_header(f):
+    """Read GTC header from an open file."""
+    header = dict()
+    # Expected binary data: int (4 bytes)
+    data, = struct.unpack('<i', f.read(4))
+    header["File version"] = data
+
+    data, = struct.unpack('<i', f.read(4))
+    header["DimD"] = data
+    data, = struct.unpack('<i', f.read(4))
+    header["DimX"] = data
+    data, = struct.unpack('<i', f.read(4))
+    header["DimY"] = data
+    data, = struct.unpack('<i', f.read(4))
+    header["DimT"] = data
+    return header
+
+
+def _write_gtc_header(f, header):
+    """Write GTC header into an open file."""
+    # Expected binary data: int (4 bytes)
+    data = header["File version"]
+    f.write(struct.pack('<i', data))
+
+    data = header["DimD"]
+    f.write(struct.pack('<i', data))
+    data = header["DimX"]
+    f.write(struct.pack('<i', data))
+    data = header["DimY"]
+    f.write(struct.pack('<i', data))
+    data = header["DimT"]
+    f.write(struct.pack('<i', data))
+
+
+def _gtc_dims(header):
+    """Data dimensions in file order (DimD, DimY, DimX, DimT)."""
+    return (header["DimD"], header["DimY"], header["DimX"], header["DimT"])
 
 
 # =============================================================================
@@ -17,24 +58,12 @@ def read_gtc(filename):
     -------
     header : dictionary
         Pre-data header.
-    data_img : 4D numpy.array, (depth, x, y, time)
+    data_img : 4D numpy.array, (x, y, depth, time)
         Depth grid sampled images with time course.
 
     """
-    header = dict()
     with open(filename, 'rb') as f:
-        # Expected binary data: int (4 bytes)
-        data, = struct.unpack('<i', f.read(4))
-        header["File version"] = data
-
-        data, = struct.unpack('<i', f.read(4))
-        header["DimD"] = data
-        data, = struct.unpack('<i', f.read(4))
-        header["DimX"] = data
-        data, = struct.unpack('<i', f.read(4))
-        header["DimY"] = data
-        data, = struct.unpack('<i', f.read(4))
-        header["DimT"] = data
+        header = _read_gtc_header(f)
 
         # ---------------------------------------------------------------------
         # Read GTC data
@@ -57,6 +86,67 @@ def read_gtc(filename):
         return header, data_img
 
 
+# =============================================================================
+def open_gtc(filename, mode="r", rearrange_data_axes=True):
+    """Open BrainVoyager GTC file data as a memory map.
+
+    Only the parts that are indexed are read from disk, e.g. one depth
+    `data[:, :, d]`, the time courses of a grid point `data[x, y]` or a time
+    window `data[..., t0:t1]`.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    mode : string
+        numpy.memmap mode, "r" for reading, "r+" for modifying in place.
+    rearrange_data_axes : bool
+        When 'True', axes are the same as in `read_gtc`. When 'False', axes
+        follow the file order (depth, y, x, time).
+
+    Returns
+    -------
+    header : dictionary
+        Pre-data header.
+    data : 4D numpy.memmap
+        Depth grid time courses as a view on the file.
+
+    """
+    with open(filename, 'rb') as f:
+        header = _read_gtc_header(f)
+        offset = f.tell()
+    data_img = np.memmap(filename, dtype='<i', mode=mode, offset=offset,
+                         shape=_gtc_dims(header))
+    if rearrange_data_axes is True:
+        data_img = np.transpose(data_img, (2, 1, 0, 3))
+    return header, data_img
+
+
+def allocate_gtc(filename, header, rearrange_data_axes=True):
+    """Write a GTC header and reserve its data, for chunked writing.
+
+    Parameters
+    ----------
+    filename : string
+        Output filename.
+    header : dictionary
+        GTC header, determines the data dimensions.
+    rearrange_data_axes : bool
+        Axes convention of the returned map, same as in `open_gtc`.
+
+    Returns
+    -------
+    data : 4D numpy.memmap
+        Zero initialized data, writing into it writes into the file.
+
+    """
+    with open(filename, 'wb') as f:
+        _write_gtc_header(f, header)
+        f.truncate(f.tell() + int(np.prod(_gtc_dims(header))) * 4)
+    return open_gtc(filename, mode="r+",
+                    rearrange_data_axes=rearrange_data_axes)[1]
+
+
 # =============================================================================
 def write_gtc(filename, header, data_img):
     """Protocol to write BrainVoyager GTC file.
@@ -67,27 +157,78 @@ def write_gtc(filename, header, data_img):
         Path to file.
     header : dictionary
         Pre-data header.
-    data_img : 4D numpy.array, (depth, x, y, time)
+    data_img : 4D numpy.array, (x, y, depth, time)
         Depth grid sampled images with time course.
 
     """
     with open(filename, 'wb') as f:
-        # Expected binary data: int (4 bytes)
-        data = header["File version"]
-        f.write(struct.pack('<i', data))
-
-        data = header["DimD"]
-        f.write(struct.pack('<i', data))
-        data = header["DimX"]
-        f.write(struct.pack('<i', data))
-        data = header["DimY"]
-        f.write(struct.pack('<i', data))
-        data = header["DimT"]
-        f.write(struct.pack('<i', data))
+        _write_gtc_header(f, header)
 
         # ---------------------------------------------------------------------
         # Write GTC data
         # ---------------------------------------------------------------------
-        data_img = np.transpose(data_img, (2, 1, 0, 3))
-        data_img = np.reshape(data_img, data_img.size)
-        f.write(data_img.astype("<i").tobytes(order="C"))
+        # One depth at a time, to avoid a transposed copy of all data
+        for d in range(data_img.shape[2]):
+            data = np.transpose(data_img[:, :, d, :], (1, 0, 2))
+            f.write(np.ascontiguousarray(data, dtype="<i").tobytes())
+
+
+# =============================================================================
+def depth_time_courses(filename, mask=None, window=None):
+    """Average time course of each depth over grid points.
+
+    Parameters
+    ----------
+    filename : string
+        Path to GTC file, memory mapped.
+    mask : 2D numpy.array, bool, (x, y)
+        Grid points to average, e.g. a region of interest. Defaults to all.
+    window : tuple of two integers
+        First and last (exclusive) time point. Defaults to all.
+
+    Returns
+    -------
+    data : 2D numpy.array, float64, (depth, time)
+
+    """
+    header, data_img = open_gtc(filename, rearrange_data_axes=False)
+    window = slice(None) if window is None else slice(*window)
+    if mask is None:
+        points = np.ones(data_img.shape[1:3], dtype=bool)
+    else:
+        points = np.transpose(np.asarray(mask, dtype=bool))  # As (y, x)
+        if points.shape != data_img.shape[1:3]:
+            raise ValueError("Mask dimensions {} do not match the GTC "
+                             "grid.".format(np.shape(mask)))
+    nr_points = max(np.sum(points), 1)
+
+    profile = list()
+    for d in range(data_img.shape[0]):
+        rows = data_img[d, :, :, window][points]
+        profile.append(np.sum(rows, axis=0, dtype=np.float64) / nr_points)
+    return np.stack(profile, axis=0)
+
+
+def depth_profile(filenames, mask=None, window=None, nr_threads=None):
+    """Mean value of each depth for one or more runs.
+
+    Parameters
+    ----------
+    filenames : list of strings
+        GTC files of the runs, all with the same grid.
+    mask, window :
+        Grid points and time points to average, see `depth_time_courses`.
+    nr_threads : integer
+        Number of runs read in parallel.
+
+    Returns
+    -------
+    profiles : 2D numpy.array, float64, (runs, depth)
+
+    """
+    def work(filename):
+        return np.mean(depth_time_courses(filename, mask, window), axis=1)
+
+    with ThreadPoolExecutor(nr_threads) as pool:
+        profiles = list(pool.map(work, filenames))
+    return np.stack(profiles, axis=0)
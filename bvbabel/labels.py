@@ -0,0 +1,157 @@
+"""Label statistics and VOI conversion of segmentation volumes."""
+
+import numpy as np
+from bvbabel.voi import write_voi
+from bvbabel.utils import label_color
+
+
+# =============================================================================
+def _bv_labels(header, data_img):
+    """Return labels in BV (Z, Y, X) order, grid start and resolution.
+
+    Works with VMR (`bvbabel.vmr.read_vmr`) and MSK (`bvbabel.msk.read_msk`)
+    headers and data. MSK grids start at "XStart", "YStart", "ZStart" and
+    have voxels of "VTC resolution relative to VMR" VMR voxels.
+    """
+    data_img = data_img[::-1, ::-1, ::-1]  # Flip BV axes
+    data_img = np.transpose(data_img, (0, 2, 1))  # Tal to BV
+    if "XStart" in header:
+        start = np.array([header["XStart"], header["YStart"],
+                          header["ZStart"]])
+        res = header["VTC resolution relative to VMR (1, 2, or 3)"]
+    else:
+        start, res = np.zeros(3, dtype=int), 1
+    return data_img, start, res
+
+
+def label_statistics(header, data_img, coordinates=True):
+    """Compute voxel counts, centroids and bounding boxes of all labels.
+
+    All labels are processed at once with a single sort of the labeled
+    voxels.
+
+    Parameters
+    ----------
+    header : dictionary
+        VMR or MSK header.
+    data_img : 3D numpy.array
+        Label image as returned by `bvbabel.vmr.read_vmr` or
+        `bvbabel.msk.read_msk`. Zero is background.
+    coordinates : bool
+        Also return the voxel coordinates of each label.
+
+    Returns
+    -------
+    stats : dictionary
+        "labels" : 1D numpy.array, (nr labels)
+            Label values, sorted.
+        "nr voxels" : 1D numpy.array, (nr labels)
+            Number of VMR voxels of each label.
+        "centroids" : 2D numpy.array, (nr labels, XYZ)
+            Mean voxel coordinate of each label.
+        "bbox min", "bbox max" : 2D numpy.array, (nr labels, XYZ)
+            Inclusive bounding box of each label.
+        "coordinates" : list of 2D numpy.arrays, (nr voxels, XYZ)
+            Voxel coordinates of each label.
+
+        Coordinates are in BrainVoyager internal VMR voxel axes, as in VOI
+        files (X front to back, Y top to bottom, Z right to left).
+
+    """
+    data_img, start, res = _bv_labels(header, data_img)
+    dims = data_img.shape
+    flat = np.ravel(data_img)
+    idx = np.flatnonzero(flat)
+    values = flat[idx]
+    order = np.argsort(values, kind="stable")  # Radix sort for integers
+    idx, values = idx[order], values[order]
+
+    first = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+    counts = np.diff(np.r_[first, values.size])
+    xyz = np.stack([idx % dims[2], (idx // dims[2]) % dims[1],
+                    idx // (dims[2] * dims[1])], axis=1)
+    xyz = xyz * res + start
+
+    stats = dict()
+    stats["labels"] = values[first]
+    stats["nr voxels"] = counts * res**3
+    stats["centroids"] = (np.add.reduceat(xyz, first, axis=0)
+                          / counts[:, None] + (res - 1) / 2)
+    stats["bbox min"] = np.minimum.reduceat(xyz, first, axis=0)
+    stats["bbox max"] = np.maximum.reduceat(xyz, first, axis=0) + res - 1
+
+    if coordinates:
+        if res > 1:  # Each grid voxel covers res^3 VMR voxels
+            steps = np.arange(res)
+            block = np.stack(np.meshgrid(steps, steps, steps, indexing="ij"),
+                             axis=-1).reshape(-1, 3)
+            xyz = (xyz[:, None, :] + block[None]).reshape(-1, 3)
+            first = first * res**3
+        stats["coordinates"] = np.split(xyz, first[1:])
+    return stats
+
+
+def labels_to_voi(header, data_img, names=None, colors=None):
+    """Convert a label image into VOIs, one per label.
+
+    Parameters
+    ----------
+    header : dictionary
+        VMR or MSK header.
+    data_img : 3D numpy.array
+        Label image (`bvbabel.vmr.read_vmr` or `bvbabel.msk.read_msk`).
+    names : dictionary
+        Label value to VOI name. Defaults to "Label <value>".
+    colors : dictionary
+        Label value to RGB color. Defaults to a fixed color per label value
+        (see `bvbabel.utils.label_color`).
+
+    Returns
+    -------
+    header_voi : dictionary
+        VOI header.
+    data_voi : list of dictionaries
+        VOIs, ready for `bvbabel.voi.write_voi`.
+
+    """
+    stats = label_statistics(header, data_img)
+    names = dict() if names is None else names
+    colors = dict() if colors is None else colors
+
+    data_voi = list()
+    for i, label in enumerate(stats["labels"].tolist()):
+        color = colors.get(label)
+        if color is None:
+            color = label_color(label)
+        data_voi.append({
+            "NameOfVOI": names.get(label, "Label {}".format(label)),
+            "ColorOfVOI": [int(c) for c in color],
+            "NrOfVoxels": stats["coordinates"][i].shape[0],
+            "Coordinates": stats["coordinates"][i]})
+
+    header_voi = dict()
+    header_voi["FileVersion"] = 4
+    header_voi["ReferenceSpace"] = "BV"
+    header_voi["OriginalVMRResolutionX"] = header.get("VoxelSizeX", 1)
+    header_voi["OriginalVMRResolutionY"] = header.get("VoxelSizeY", 1)
+    header_voi["OriginalVMRResolutionZ"] = header.get("VoxelSizeZ", 1)
+    header_voi["OriginalVMROffsetX"] = header.get("OffsetX", 0)
+    header_voi["OriginalVMROffsetY"] = header.get("OffsetY", 0)
+    header_voi["OriginalVMROffsetZ"] = header.get("OffsetZ", 0)
+    header_voi["OriginalVMRFramingCubeDim"] = header.get(
+        "FramingCubeDim", 256)
+    header_voi["LeftRightConvention"] = header.get("LeftRightConvention", 1)
+    header_voi["SubjectVOINamingConvention"] = "<VOI>_<SUBJ>"
+    header_voi["NrOfVOIs"] = len(data_voi)
+    header_voi["NrOfVOIVTCs"] = 0
+    return header_voi, data_voi
+
+
+def write_labels_voi(filename, header, data_img, names=None, colors=None):
+    """Write all labels of a label image into one VOI file.
+
+    See `labels_to_voi` for the parameters.
+    """
+    header_voi, data_voi = labels_to_voi(header, data_img, names, colors)
+    write_voi(filename, header_voi, data_voi)
+    return header_voi, data_voi
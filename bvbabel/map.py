@@ -1,25 +1,3 @@
-'''
-!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-!!!!!!! WORK IN PROGRESS !!!!!!
-!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-
-BYTES	DATA TYPE	DEFAULT	DESCRIPTION
-2	short int	1	NrOfSlices/MapType (t, F, correlation, crosscorrelation etc.) (*1)
-2	short int	 	NrOfMaps (equal to NrOfSlices)
-2	short int	 	DimY (image dimension in number of pixels)
-2	short int	 	DimX (image dimension in number of pixels)
-2	short int	 	ClusterSize
-4	float	 	Statistical threshold, critical value
-4	float	 	Statistical threshold, max value
-2	short int	 	NrOfLags (ONLY PRESENT IF MapType = crosscorrelation)
-2	short int	9999	Reserved (MUST BE THIS VALUE)
-2	short int	3	FileVersion (Current version is 3)
-4   int             DF1 (only present if the file version is 3)
-4   int             DF2 (only present if the file version is 3)
-N	byte	<untitled>	Name of an RTC file (used to compute % signal changes etc.) (*2)
-(*2) Variable length, the end of the name is indicated by '0'.
-'''
-
 """Read, write, create BrainVoyager MAP file format."""
 
 import struct
@@ -27,6 +5,117 @@ import numpy as np
 from bvbabel.utils import read_variable_length_string, read_RGB_bytes
 from bvbabel.utils import write_variable_length_string, write_RGB_bytes
 
+# BYTES  DATA TYPE  DEFAULT     DESCRIPTION
+# 2      short int  1           NrOfSlices/MapType (t, F, correlation, etc.)
+# 2      short int              NrOfMaps (equal to NrOfSlices)
+# 2      short int              DimY (image dimension in number of pixels)
+# 2      short int              DimX (image dimension in number of pixels)
+# 2      short int              ClusterSize
+# 4      float                  Statistical threshold, critical value
+# 4      float                  Statistical threshold, max value
+# 2      short int              NrOfLags (ONLY PRESENT IF crosscorrelation)
+# 2      short int  9999        Reserved (MUST BE THIS VALUE)
+# 2      short int  3           FileVersion (Current version is 3)
+# 4      int                    DF1 (only present if the file version is 3)
+# 4      int                    DF2 (only present if the file version is 3)
+# N      byte       <untitled>  Name of an RTC file, '0' terminated
+
+RESERVED = 9999  # Value of the reserved field, follows the optional NrOfLags
+
+
+# =============================================================================
+def _read_map_header(f):
+    """Read MAP header from an open file."""
+    header = dict()
+    # Expected binary data: short int (2 bytes)
+    data, = struct.unpack('<h', f.read(2))
+    header["MapType"] = 't-values'
+    header["NrOfSlices"] = int(data)
+    data, = struct.unpack('<h', f.read(2))
+    header["NrOfMaps"] = int(data)
+    data, = struct.unpack('<h', f.read(2))
+    header["DimY"] = int(data)
+    data, = struct.unpack('<h', f.read(2))
+    header["DimX"] = int(data)
+    data, = struct.unpack('<h', f.read(2))
+    header["ClusterSize"] = int(data)
+
+    # Expected binary data: float (4 bytes)
+    data, = struct.unpack('<f', f.read(4))
+    header["Min"] = data  # Statistical threshold, critical value
+    data, = struct.unpack('<f', f.read(4))
+    header["Max"] = data  # Statistical threshold, max value
+
+    # Expected binary data: short int (2 bytes)
+    # Cross-correlation maps have NrOfLags before the reserved field
+    data, = struct.unpack('<h', f.read(2))
+    if data != RESERVED:
+        header["MapType"] = 'crosscorrelation'
+        header["NrOfLags"] = int(data)
+        data, = struct.unpack('<h', f.read(2))
+        if data != RESERVED:
+            raise ValueError("Unexpected MAP header, reserved field is {} "
+                             "instead of {}.".format(data, RESERVED))
+    data, = struct.unpack('<h', f.read(2))
+    header["FileVersion"] = int(data)
+
+    # Expected binary data: int (4 bytes)
+    if header["FileVersion"] >= 3:
+        data, = struct.unpack('<i', f.read(4))
+        header["df1"] = int(data)
+        data, = struct.unpack('<i', f.read(4))
+        header["df2"] = int(data)
+
+    # Expected binary data: variable-length string
+    data = read_variable_length_string(f)
+    header["RTCName"] = data
+    return header
+
+
+def _write_map_header(f, header):
+    """Write MAP header into an open file."""
+    # Expected binary data: short int (2 bytes)
+    data = header["NrOfSlices"]
+    f.write(struct.pack('<h', data))
+    data = header["NrOfMaps"]
+    f.write(struct.pack('<h', data))
+    data = header["DimY"]
+    f.write(struct.pack('<h', data))
+    data = header["DimX"]
+    f.write(struct.pack('<h', data))
+    data = header["ClusterSize"]
+    f.write(struct.pack('<h', data))
+
+    # Expected binary data: float (4 bytes)
+    data = header["Min"]
+    f.write(struct.pack('<f', data))
+    data = header["Max"]
+    f.write(struct.pack('<f', data))
+
+    # Expected binary data: short int (2 bytes)
+    if header.get("MapType") == 'crosscorrelation':
+        data = header["NrOfLags"]
+        f.write(struct.pack('<h', data))
+    f.write(struct.pack('<h', RESERVED))
+    data = header.get("FileVersion", 3)
+    f.write(struct.pack('<h', data))
+
+    # Expected binary data: int (4 bytes)
+    if data >= 3:
+        data = header.get("df1", 0)
+        f.write(struct.pack('<i', data))
+        data = header.get("df2", 0)
+        f.write(struct.pack('<i', data))
+
+    # Expected binary data: variable-length string
+    write_variable_length_string(f, header.get("RTCName", ""))
+
+
+def _rearrange(data_img):
+    """(slices, DimY, DimX) file order to (DimX, DimY, slices), as a view."""
+    data_img = np.transpose(data_img, (2, 1, 0))
+    return data_img[::-1, ::-1, :]  # Flip BV axes
+
 
 # =============================================================================
 def read_map(filename):
@@ -41,85 +130,87 @@ def read_map(filename):
     -------
     header : dictionary
         Pre-data and post-data headers.
-    data : 3D numpy.array
+    data : 3D numpy.array, (DimX, DimY, NrOfMaps)
         Image data.
 
     """
-    header = dict()
     with open(filename, 'rb') as f:
+        header = _read_map_header(f)
+
         # ---------------------------------------------------------------------
-        # NR-MAP Header (Version 2)
+        # Read MAP image data
         # ---------------------------------------------------------------------
+        # A map file contains NrOfMaps (= NrOfSlices) 2D statistical images.
+        # Each image contains DimY*DimX data points, each represented in 4
+        # bytes (float). Each slice is preceded by a 2 byte (short int) slice
+        # index ('0' for slice 1 and 'NrOfMaps-1' for the last slice).
+        data_img = np.zeros((header["NrOfMaps"], header["DimY"],
+                             header["DimX"]), dtype='<f')
+        for s in range(header["NrOfMaps"]):
+            f.seek(2, 1)  # Skip the slice index
+            if f.readinto(data_img[s]) != data_img[s].nbytes:
+                raise ValueError("MAP file ends within slice {}.".format(s))
 
-        # Expected binary data: short int (2 bytes)
-        data, = struct.unpack('<h', f.read(2))
-        header["MapType"] = 't-values'
-        header["NrOfSlices"] = int(data)
-        data, = struct.unpack('<h', f.read(2))
-        header["NrOfMaps"] = int(data)
-        data, = struct.unpack('<h', f.read(2))
-        header["DimX"] = int(data)
-        data, = struct.unpack('<h', f.read(2))
-        header["DimY"] = int(data)
-        data, = struct.unpack('<h', f.read(2))
-        header["ClusterSize"] = int(data)
-
-        # Expected binary data: float (4 bytes)
-        data, = struct.unpack('<f', f.read(4))
-        header["Min"] = data  # 	Statistical threshold, critical value
-        data, = struct.unpack('<f', f.read(4))
-        header["Max"] = data # 	Statistical threshold, max value
-
-        # Expected binary data: short int (2 bytes)
-        if header["MapType"] == 'crosscorrelation':
-	        data, = struct.unpack('<h', f.read(2))
-	        header["NrOfLags"] = int(data)
+    return header, _rearrange(data_img)
 
-        # Expected binary data: short int (2 bytes) 
-        data, = struct.unpack('<h', f.read(2)) # Reserved field 9999
-        # Expected binary data: short int (2 bytes)
-        data, = struct.unpack('<h', f.read(2)) # Version 3
 
-        data, = struct.unpack('<i', f.read(4)) # DF1
-        header["df1"] = int(data)
-
-        data, = struct.unpack('<i', f.read(4)) # DF2
-        header["df2"] = int(data)
+def open_map(filename, mode="r"):
+    """Open BrainVoyager MAP file data as a memory map.
 
-        # Expected binary data: variable-length string
-        data = read_variable_length_string(f)  # Reserved field
-        header["RTCName"] = data
+    Slices are only read from disk when indexed, e.g. `data[:, :, s]`.
 
-        # ---------------------------------------------------------------------
-        # Read MAP image data
-        # ---------------------------------------------------------------------
-        # A map file contains NrOfMaps (= NrOfSlices) 2D statistical images. Each image contains DimY*DimX data points.
-        # Each data point (statistical value) is represented in 4 bytes (float). 
-        # Each slice is preceded by a 2 byte (short int) value representing the slice index (i.e. '0' for slice 1 and 'NrOfMaps-1' for the last slice). 
-        # There are some additional informations about MAP files which are specific to correlation and cross-correlation maps.
-        #
-        
-        data_img = []#np.zeros( header['NrOfSlices'] * header['DimY'] * header['DimX'])
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    mode : string
+        numpy.memmap mode, "r" for reading, "r+" for modifying in place.
 
-        for s in range(header['NrOfSlices']):
+    Returns
+    -------
+    header : dictionary
+        Pre-data and post-data headers.
+    data : 3D numpy.memmap, (DimX, DimY, NrOfMaps)
+        Image data as in `read_map`, as a strided view on the file.
 
-            # Expected binary data: short int (2 bytes)
-            data, = struct.unpack('<h', f.read(2)) #Slice number
-            data_img.append(np.reshape(np.fromfile(f, dtype='<f', count=header['DimY'] * header['DimX'], sep="", offset=0), (header['DimX'],header['DimY']))[:,:,None]) # slice data
+    """
+    with open(filename, 'rb') as f:
+        header = _read_map_header(f)
+        offset = f.tell()
+    records = np.memmap(filename, mode=mode, offset=offset,
+                        shape=header["NrOfMaps"],
+                        dtype=[("SliceIndex", '<h'),
+                               ("Data", '<f', (header["DimY"],
+                                               header["DimX"]))])
+    return header, _rearrange(records["Data"])
 
-            #print('Slice: ', data)
 
-            temp_img = []
-            #for y in range(header['DimY']):
-            #    for x in range(header['DimX']):
-            #        data, = struct.unpack('<f', f.read(4))
-            #       temp_img.append(data)
-            #data_img.append(np.reshape(temp_img,(header['DimY'],header['DimX']))[:,:,None])
+# =============================================================================
+def write_map(filename, header, data_img):
+    """Protocol to write BrainVoyager MAP file.
 
-        # -----------------------------------------------------------------
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    header : dictionary
+        Pre-data and post-data headers. "NrOfMaps", "DimX" and "DimY" are
+        taken from the data.
+    data_img : 3D numpy.array, (DimX, DimY, NrOfMaps)
+        Image data, as in `read_map`.
 
-    data_img = np.concatenate(data_img, axis=2) # stuck the slices
-    data_img = np.transpose(data_img, (1, 0, 2))
-    data_img = data_img[::-1, ::-1,:]  # Flip BV axes
+    """
+    header = dict(header)
+    header["DimX"], header["DimY"], header["NrOfMaps"] = data_img.shape
+    with open(filename, 'wb') as f:
+        _write_map_header(f, header)
 
-    return header, data_img
+        # ---------------------------------------------------------------------
+        # Write MAP image data
+        # ---------------------------------------------------------------------
+        for s in range(header["NrOfMaps"]):
+            # Expected binary data: short int (2 bytes)
+            f.write(struct.pack('<h', s))
+            # Expected binary data: float (4 bytes)
+            data = np.transpose(data_img[::-1, ::-1, s])  # As (DimY, DimX)
+            f.write(np.ascontiguousarray(data, dtype='<f').tobytes())
@@ -3,6 +3,51 @@
 import struct
 import numpy as np
 from bvbabel.utils import read_variable_length_string, write_variable_length_string
+from bvbabel.srf import Mesh
+from bvbabel.utils import csr_from_triplets, csr_dot, trilinear_weights
+
+
+# =============================================================================
+def _read_mtc_header(f):
+    """Read MTC header from an open file, leaving it at the data start."""
+    header = dict()
+    # Expected binary data: int (4 bytes)
+    data, = struct.unpack('<i', f.read(4))
+    header["File version"] = data
+    data, = struct.unpack('<i', f.read(4))
+    header["Nr vertices"] = data
+    data, = struct.unpack('<i', f.read(4))
+    header["Nr time points"] = data
+
+    # Expected binary data: variable-length string
+    data = read_variable_length_string(f)
+    header["VTC name"] = data
+    data = read_variable_length_string(f)
+    header["PRT name"] = data
+
+    # Expected binary data: int (4 bytes)
+    data, = struct.unpack('<i', f.read(4))
+    header["Hemodynamic delay"] = data
+
+    # Expected binary data: float (4 bytes)
+    data, = struct.unpack('<f', f.read(4))
+    header["TR"] = data
+    data, = struct.unpack('<f', f.read(4))
+    header["delta"] = data
+    data, = struct.unpack('<f', f.read(4))
+    header["tau"] = data
+
+    # Expected binary data: int (4 bytes)
+    data, = struct.unpack('<i', f.read(4))
+    header["segment size"] = data
+    data, = struct.unpack('<i', f.read(4))
+    header["segment offset"] = data
+
+    # Expected binary data: char (1 byte)
+    data, = struct.unpack('<B', f.read(1))
+    header["Datatype (1 = float)"] = data
+
+    return header
 
 
 # =============================================================================
@@ -22,44 +67,8 @@ def read_mtc(filename):
         Vertex-wise time points (float32).
 
     """
-    header = dict()
-    data_mtc = dict()
     with open(filename, 'rb') as f:
-        # Expected binary data: int (4 bytes)
-        data, = struct.unpack('<i', f.read(4))
-        header["File version"] = data
-        data, = struct.unpack('<i', f.read(4))
-        header["Nr vertices"] = data
-        data, = struct.unpack('<i', f.read(4))
-        header["Nr time points"] = data
-
-        # Expected binary data: variable-length string
-        data = read_variable_length_string(f)
-        header["VTC name"] = data
-        data = read_variable_length_string(f)
-        header["PRT name"] = data
-
-        # Expected binary data: int (4 bytes)
-        data, = struct.unpack('<i', f.read(4))
-        header["Hemodynamic delay"] = data
-
-        # Expected binary data: float (4 bytes)
-        data, = struct.unpack('<f', f.read(4))
-        header["TR"] = data
-        data, = struct.unpack('<f', f.read(4))
-        header["delta"] = data
-        data, = struct.unpack('<f', f.read(4))
-        header["tau"] = data
-
-        # Expected binary data: int (4 bytes)
-        data, = struct.unpack('<i', f.read(4))
-        header["segment size"] = data
-        data, = struct.unpack('<i', f.read(4))
-        header["segment offset"] = data
-
-        # Expected binary data: char (1 byte)
-        data, = struct.unpack('<B', f.read(1))
-        header["Datatype (1 = float)"] = data
+        header = _read_mtc_header(f)
 
         # ---------------------------------------------------------------------
         # Vertex-wise time points data
@@ -71,6 +80,75 @@ def read_mtc(filename):
         return header, data_mtc
 
 
+# =============================================================================
+def open_mtc(filename, mode="r"):
+    """Open BrainVoyager MTC file data as a memory map.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    mode : string
+        numpy.memmap mode, "r" for reading, "r+" for modifying in place.
+
+    Returns
+    -------
+    header : dictionary
+        Pre-data headers.
+    data : 2D numpy.memmap, (nr_vertices, time points)
+        Vertex-wise time points (float32). Only the accessed vertices are
+        read from disk.
+
+    """
+    with open(filename, 'rb') as f:
+        header = _read_mtc_header(f)
+        offset = f.tell()
+    dims = (header["Nr vertices"], header["Nr time points"])
+    data_mtc = np.memmap(filename, dtype='<f4', mode=mode, offset=offset,
+                         shape=dims)
+    return header, data_mtc
+
+
+# =============================================================================
+def _write_mtc_header(f, header):
+    """Write MTC header to an open file, data follows right after."""
+    # Expected binary data: int (4 bytes)
+    data = header["File version"]
+    f.write(struct.pack('<i', data))
+    data = header["Nr vertices"]
+    f.write(struct.pack('<i', data))
+    data = header["Nr time points"]
+    f.write(struct.pack('<i', data))
+
+    # Expected binary data: variable-length string
+    data = header["VTC name"]
+    write_variable_length_string(f, data)
+    data = header["PRT name"]
+    write_variable_length_string(f, data)
+
+    # Expected binary data: int (4 bytes)
+    data = header["Hemodynamic delay"]
+    f.write(struct.pack('<i', data))
+
+    # Expected binary data: float (4 bytes)
+    data = header["TR"]
+    f.write(struct.pack('<f', data))
+    data = header["delta"]
+    f.write(struct.pack('<f', data))
+    data = header["tau"]
+    f.write(struct.pack('<f', data))
+
+    # Expected binary data: int (4 bytes)
+    data = header["segment size"]
+    f.write(struct.pack('<i', data))
+    data = header["segment offset"]
+    f.write(struct.pack('<i', data))
+
+    # Expected binary data: char (1 byte)
+    data = header["Datatype (1 = float)"]
+    f.write(struct.pack('<B', data))
+
+
 # =============================================================================
 def write_mtc(filename, header, data_mtc):
     """Protocol to write BrainVoyager MTC file.
@@ -86,53 +164,140 @@ def write_mtc(filename, header, data_mtc):
 
     """
     with open(filename, 'wb') as f:
-        # Expected binary data: int (4 bytes)
-        data = header["File version"]
-        f.write(struct.pack('<i', data))
-        data = header["Nr vertices"]
-        f.write(struct.pack('<i', data))
-        data = header["Nr time points"]
-        f.write(struct.pack('<i', data))
-
-        # Expected binary data: variable-length string
-        data = header["VTC name"]
-        write_variable_length_string(f, data)
-        data = header["PRT name"]
-        write_variable_length_string(f, data)
-
-        # Expected binary data: int (4 bytes)
-        data = header["Hemodynamic delay"]
-        f.write(struct.pack('<i', data))
-
-        # Expected binary data: float (4 bytes)
-        data = header["TR"]
-        f.write(struct.pack('<f', data))
-        data = header["delta"]
-        f.write(struct.pack('<f', data))
-        data = header["tau"]
-        f.write(struct.pack('<f', data))
-
-        # Expected binary data: int (4 bytes)
-        data = header["segment size"]
-        f.write(struct.pack('<i', data))
-        data = header["segment offset"]
-        f.write(struct.pack('<i', data))
-
-
-        # Expected binary data: char (1 byte)
-        data = header["Datatype (1 = float)"]
-        f.write(struct.pack('<B', data))
+        _write_mtc_header(f, header)
 
         # ---------------------------------------------------------------------
         # Vertex-wise time points data
         dims = (header["Nr vertices"], header["Nr time points"])
         data_mtc = np.reshape(data_mtc, dims[0] * dims[1])
-        for i in range(dims[0] * dims[1]):
-            f.write(struct.pack('<f', data_mtc[i]))
+        np.asarray(data_mtc, dtype='<f4').tofile(f)
 
         return header, data_mtc
 
 
+# =============================================================================
+def smooth(data_mtc, mesh, iterations=1, method="neighbor", sigma=None,
+           chunk_size=20000, out=None):
+    """Smooth MTC time courses on the surface.
+
+    Parameters
+    ----------
+    data_mtc : 2D numpy.array, (nr_vertices, time points)
+        Vertex-wise time points, e.g. a memory map from `open_mtc`.
+    mesh : bvbabel.srf.Mesh or dictionary
+        Mesh of the SRF the MTC belongs to, or mesh data from
+        `bvbabel.srf.read_srf`. Pass a Mesh to reuse its cached weights.
+    iterations : integer
+        Number of smoothing steps.
+    method : string, "neighbor" or "heat"
+        Neighbor averaging or iterated heat kernel smoothing.
+    sigma : float
+        Heat kernel width in vertex coordinate units. Defaults to the mean
+        edge length.
+    chunk_size : integer
+        Number of vertices processed at once. All time points of a chunk are
+        smoothed with one sparse product per iteration.
+    out : 2D numpy.array
+        Optional output, e.g. a writable memory map from `open_mtc`.
+
+    Returns
+    -------
+    out : 2D numpy.array, (nr_vertices, time points)
+        Smoothed time points (float32).
+
+    """
+    if not isinstance(mesh, Mesh):
+        mesh = Mesh(mesh)
+    return mesh.smooth(data_mtc, iterations, method, sigma, chunk_size, out)
+
+
+# =============================================================================
+def sample_vtc(header_vtc, data_vtc, mesh, depths=(0.,), vtc_name="",
+               rearrange_data_axes=True):
+    """Sample VTC time courses on SRF vertices.
+
+    Each vertex samples the VTC with trilinear interpolation at points along
+    its normal and averages the samples within the VTC bounding box. The interpolation weights are stored as a
+    sparse matrix in `mesh.cache` per VTC bounding box and depths, so
+    sampling further runs onto the same mesh is a single sparse product.
+
+    Parameters
+    ----------
+    header_vtc : dictionary
+        VTC header (`bvbabel.vtc.read_vtc`).
+    data_vtc : 4D numpy.array
+        VTC data (`bvbabel.vtc.read_vtc`).
+    mesh : bvbabel.srf.Mesh or dictionary
+        Mesh, or mesh data from `bvbabel.srf.read_srf`, in the VMR space of
+        the VTC. Pass a Mesh to reuse the cached weights.
+    depths : sequence of floats
+        Sampling positions along vertex normals, in VMR voxels. E.g.
+        (-1, 0, 1, 2, 3) samples from 1 voxel inside to 3 voxels outside.
+    vtc_name : string
+        Stored as "VTC name" in the MTC header.
+    rearrange_data_axes : bool
+        Axes convention of `data_vtc`, same as in `bvbabel.vtc.read_vtc`.
+
+    Returns
+    -------
+    header : dictionary
+        MTC header.
+    data_mtc : 2D numpy.array, (nr_vertices, time points)
+        Vertex-wise time points (float32), ready for `write_mtc`.
+
+    """
+    if not isinstance(mesh, Mesh):
+        mesh = Mesh(mesh)
+    res = header_vtc["VTC resolution relative to VMR (1, 2, or 3)"]
+    start = np.array([header_vtc["ZStart"], header_vtc["YStart"],
+                      header_vtc["XStart"]])
+    shape = (np.array([header_vtc["ZEnd"], header_vtc["YEnd"],
+                       header_vtc["XEnd"]]) - start) // res
+    depths = tuple(float(d) for d in depths)
+
+    key = ("sample_vtc", tuple(start), tuple(shape), res, depths)
+    if key not in mesh.cache:
+        rows, corners, weights = [], [], []
+        for d in depths:
+            # Vertex XYZ coordinates are VMR voxels, VTC data is ordered ZYX
+            points = mesh.vertices + d * mesh.vertex_normals
+            c, w = trilinear_weights(
+                (points[:, ::-1] - start - (res - 1) / 2) / res, shape)
+            rows.append(np.repeat(np.arange(mesh.nr_vertices), 8))
+            corners.append(c.reshape(-1, 3))
+            weights.append(w.ravel())
+        rows = np.concatenate(rows)
+        corners = np.concatenate(corners)
+        weights = np.concatenate(weights)
+        keep = weights > 0
+        rows, corners, weights = rows[keep], corners[keep], weights[keep]
+        # Average over the samples within the VTC box only
+        total = np.bincount(rows, weights=weights,
+                            minlength=mesh.nr_vertices)
+        weights = weights / total[rows]
+        flat = np.ravel_multi_index(corners.T, shape)
+        voxels, cols = np.unique(flat, return_inverse=True)
+        csr = csr_from_triplets(rows, cols.ravel(), weights,
+                                (mesh.nr_vertices, voxels.size))
+        mesh.cache[key] = csr, np.unravel_index(voxels, shape)
+    csr, (z, y, x) = mesh.cache[key]
+
+    # Gather only the voxels touched by the mesh
+    if rearrange_data_axes:
+        samples = data_vtc[shape[0] - 1 - z, shape[2] - 1 - x,
+                           shape[1] - 1 - y, :]
+    else:
+        samples = data_vtc[z, y, x, :]
+    data_mtc = csr_dot(*csr, samples.astype(np.float32)).astype(np.float32)
+
+    header, _ = create_mtc()
+    header["Nr vertices"] = mesh.nr_vertices
+    header["Nr time points"] = header_vtc["Nr time points"]
+    header["VTC name"] = vtc_name
+    header["TR"] = header_vtc["TR (ms)"]
+    return header, data_mtc
+
+
 # =============================================================================
 def create_mtc():
     """Create BrainVoyager MTC file with default values."""
@@ -1,6 +1,8 @@
 """Read BrainVoyager POI (surface patches of interest) file format."""
 
 import numpy as np
+from bvbabel.srf import Mesh
+from bvbabel.utils import label_color
 
 
 # =============================================================================
@@ -139,6 +141,75 @@ def write_poi(filename, header, data_poi):
         f.write("NrOfPOIMTCs: {}\n".format(data))
 
 
+def grow_pois(mesh, centers, radius, names=None, colors=None,
+              exclusive=False, mesh_filename=""):
+    """Create disk shaped POIs of a geodesic radius around center vertices.
+
+    Parameters
+    ----------
+    mesh : bvbabel.srf.Mesh or dictionary
+        Mesh, or mesh data from `bvbabel.srf.read_srf`. Pass a Mesh to reuse
+        its cached adjacency when growing POIs repeatedly.
+    centers : 1D numpy.array, int
+        Center vertex of each POI, stored as "LabelVertex".
+    radius : float or 1D numpy.array
+        Geodesic radius (vertex coordinate units) of all or each POI.
+    names : list of strings
+        POI names. Defaults to "POI 1", "POI 2", ...
+    colors : 2D numpy.array, (nr POIs, RGB)
+        POI colors. Defaults to a fixed color per POI number (see
+        `bvbabel.utils.label_color`).
+    exclusive : bool
+        If True, each vertex is assigned only to its nearest center, using a
+        single multi-source search. `radius` must be a scalar.
+    mesh_filename : string
+        Stored as "FromMeshFile".
+
+    Returns
+    -------
+    header : dictionary
+        Patches of interest (POI) header.
+    data_poi : list of dictionaries
+        POIs, ready for `write_poi`.
+
+    """
+    if not isinstance(mesh, Mesh):
+        mesh = Mesh(mesh)
+    centers = np.atleast_1d(centers).astype(np.int64)
+    radius = np.broadcast_to(np.asarray(radius, dtype=np.float64),
+                             centers.shape)
+    if names is None:
+        names = ["POI {}".format(i + 1) for i in range(centers.size)]
+    if colors is None:
+        colors = [label_color(i + 1) for i in range(centers.size)]
+
+    if exclusive:
+        vertices, _, label = mesh.geodesic_neighborhood(
+            centers, float(radius.max()))
+        order = np.argsort(label, kind="stable")
+        counts = np.bincount(label, minlength=centers.size)
+        members = np.split(vertices[order], np.cumsum(counts)[:-1])
+    else:
+        members = [mesh.geodesic_neighborhood(c, float(r))[0]
+                   for c, r in zip(centers, radius)]
+
+    data_poi = list()
+    for i, c in enumerate(centers):
+        data_poi.append({"NameOfPOI": '"{}"'.format(names[i]),
+                         "InfoTextFile": '""',
+                         "ColorOfPOI": [int(j) for j in colors[i]],
+                         "LabelVertex": int(c),
+                         "NrOfVertices": members[i].size,
+                         "Vertices": np.sort(members[i])})
+
+    header = {"FileVersion": 2,
+              "FromMeshFile": '"{}"'.format(mesh_filename),
+              "NrOfMeshVertices": mesh.nr_vertices,
+              "NrOfPOIs": centers.size,
+              "NrOfPOIMTCs": 0}
+    return header, data_poi
+
+
 def create_poi():
     """Create BrainVoyager POI.
 
@@ -0,0 +1,316 @@
+"""Temporal preprocessing of VTC and STC time series in a single pass."""
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from bvbabel.vtc import open_vtc, allocate_vtc
+from bvbabel.stc import open_stc
+
+
+# =============================================================================
+# Linear operators, (time points, time points) matrices applied as x @ M.T
+# =============================================================================
+def _residual_matrix(regressors):
+    """Matrix removing the (mean centered) regressors but keeping the mean."""
+    nr_volumes = regressors.shape[0]
+    regressors = regressors - np.mean(regressors, axis=0)
+    pinv = np.linalg.pinv(regressors)
+    return np.eye(nr_volumes) - regressors @ pinv
+
+
+def linear_detrend(nr_volumes):
+    """Linear trend removal matrix.
+
+    Parameters
+    ----------
+    nr_volumes : integer
+        Number of time points.
+
+    Returns
+    -------
+    matrix : 2D numpy.array, (nr_volumes, nr_volumes)
+        Removes the linear trend, keeps the mean.
+
+    """
+    return _residual_matrix(np.arange(nr_volumes, dtype=float)[:, None])
+
+
+def highpass_dct(nr_volumes, tr, cutoff=128.):
+    """Discrete cosine transform (DCT) high-pass filter matrix.
+
+    Parameters
+    ----------
+    nr_volumes : integer
+        Number of time points.
+    tr : float
+        Repetition time in seconds.
+    cutoff : float
+        Cutoff period in seconds. Slower fluctuations are removed.
+
+    Returns
+    -------
+    matrix : 2D numpy.array, (nr_volumes, nr_volumes)
+        Removes the low frequency cosines, keeps the mean.
+
+    """
+    nr_basis = int(np.floor(2. * nr_volumes * tr / cutoff))
+    if nr_basis < 1:
+        return np.eye(nr_volumes)
+    t = np.arange(nr_volumes)[:, None]
+    k = np.arange(1, nr_basis + 1)[None, :]
+    return _residual_matrix(np.cos(np.pi * k * (2 * t + 1) / (2 * nr_volumes)))
+
+
+def highpass_fourier(nr_volumes, nr_cycles=2):
+    """GLM-Fourier high-pass filter matrix, as in BrainVoyager.
+
+    Parameters
+    ----------
+    nr_volumes : integer
+        Number of time points.
+    nr_cycles : integer
+        Sine and cosine pairs with up to this many cycles per time course are
+        removed.
+
+    Returns
+    -------
+    matrix : 2D numpy.array, (nr_volumes, nr_volumes)
+        Removes the low frequency sines and cosines, keeps the mean.
+
+    """
+    if nr_cycles < 1:
+        return np.eye(nr_volumes)
+    t = np.arange(nr_volumes)[:, None] / nr_volumes
+    k = np.arange(1, nr_cycles + 1)[None, :]
+    regressors = np.concatenate([np.sin(2 * np.pi * k * t),
+                                 np.cos(2 * np.pi * k * t)], axis=1)
+    return _residual_matrix(regressors)
+
+
+def temporal_smoothing(nr_volumes, tr, fwhm):
+    """Gaussian temporal smoothing matrix.
+
+    Parameters
+    ----------
+    nr_volumes : integer
+        Number of time points.
+    tr : float
+        Repetition time in seconds.
+    fwhm : float
+        Full width at half maximum of the Gaussian kernel in seconds. Kernel
+        weights are renormalized at the time course edges.
+
+    Returns
+    -------
+    matrix : 2D numpy.array, (nr_volumes, nr_volumes)
+
+    """
+    sigma = fwhm / tr / np.sqrt(8 * np.log(2))
+    if sigma <= 0:
+        return np.eye(nr_volumes)
+    t = np.arange(nr_volumes)
+    matrix = np.exp(-0.5 * ((t[:, None] - t[None, :]) / sigma)**2)
+    matrix[matrix < 1e-8] = 0
+    return matrix / np.sum(matrix, axis=1, keepdims=True)
+
+
+def zscore(data):
+    """Z-score time courses along the last axis. Flat time courses are 0."""
+    data = data - np.mean(data, axis=-1, keepdims=True)
+    std = np.std(data, axis=-1, keepdims=True)
+    np.divide(data, std, out=data, where=std > 0)
+    data[np.broadcast_to(std == 0, data.shape)] = 0
+    return data
+
+
+# =============================================================================
+# Pipeline
+# =============================================================================
+def compile_steps(steps, nr_volumes, tr):
+    """Turn preprocessing steps into a list of per chunk operations.
+
+    Consecutive linear steps are multiplied into one matrix, so that any
+    number of them costs a single matrix product per chunk.
+
+    Parameters
+    ----------
+    steps : list of strings or (string, dictionary) tuples
+        Step names and their keyword arguments, applied in order:
+            "detrend" : `linear_detrend`.
+            "highpass_dct" : `highpass_dct` (cutoff).
+            "highpass_fourier" : `highpass_fourier` (nr_cycles).
+            "smooth" : `temporal_smoothing` (fwhm).
+            "zscore" : `zscore`.
+    nr_volumes : integer
+        Number of time points.
+    tr : float
+        Repetition time in seconds.
+
+    Returns
+    -------
+    operations : list
+        2D numpy.arrays (applied as x @ M.T) and callables.
+
+    """
+    operations = list()
+    for step in steps:
+        name, params = (step, dict()) if isinstance(step, str) else step
+        if name == "detrend":
+            op = linear_detrend(nr_volumes)
+        elif name == "highpass_dct":
+            op = highpass_dct(nr_volumes, tr, **params)
+        elif name == "highpass_fourier":
+            op = highpass_fourier(nr_volumes, **params)
+        elif name == "smooth":
+            op = temporal_smoothing(nr_volumes, tr, **params)
+        elif name == "zscore":
+            op = zscore
+        else:
+            raise ValueError("Unknown preprocessing step '{}'.".format(name))
+
+        if (isinstance(op, np.ndarray) and len(operations) > 0
+                and isinstance(operations[-1], np.ndarray)):
+            operations[-1] = op @ operations[-1]
+        else:
+            operations.append(op)
+    return [op.T.astype(np.float32) if isinstance(op, np.ndarray) else op
+            for op in operations]
+
+
+def _apply_operations(data, operations):
+    """Apply compiled operations to (voxels, time) data."""
+    data = np.asarray(data, dtype=np.float32)
+    for op in operations:
+        if isinstance(op, np.ndarray):
+            data = data @ op
+        else:
+            data = op(data)
+    return data
+
+
+def apply(data, steps, tr):
+    """Preprocess in-memory time courses.
+
+    Parameters
+    ----------
+    data : numpy.array, (..., time)
+        Time courses along the last axis, e.g. `bvbabel.vtc.read_vtc` data.
+    steps : list
+        Preprocessing steps, see `compile_steps`.
+    tr : float
+        Repetition time in seconds.
+
+    Returns
+    -------
+    data : numpy.array, float32, (..., time)
+
+    """
+    operations = compile_steps(steps, data.shape[-1], tr)
+    shape = data.shape
+    data = _apply_operations(np.reshape(data, (-1, shape[-1])), operations)
+    return np.reshape(data, shape)
+
+
+def process(data_in, data_out, steps, tr, chunk_size=20000, nr_threads=None):
+    """Preprocess voxel chunks of (voxels, time) arrays in one pass.
+
+    Parameters
+    ----------
+    data_in : 2D numpy.array or numpy.memmap, (voxels, time)
+        Input time courses, only one chunk per thread is read at a time.
+    data_out : 2D numpy.array or numpy.memmap, (voxels, time)
+        Output, written chunk by chunk.
+    steps : list
+        Preprocessing steps, see `compile_steps`.
+    tr : float
+        Repetition time in seconds.
+    chunk_size : integer
+        Number of voxels per chunk.
+    nr_threads : integer
+        Number of worker threads. Defaults to the executor default.
+
+    """
+    operations = compile_steps(steps, data_in.shape[1], tr)
+
+    def work(i):
+        chunk = _apply_operations(data_in[i:i + chunk_size], operations)
+        data_out[i:i + chunk_size] = chunk
+
+    with ThreadPoolExecutor(nr_threads) as pool:
+        for _ in pool.map(work, range(0, data_in.shape[0], chunk_size)):
+            pass
+
+
+def preprocess_vtc(filename_in, filename_out, steps, chunk_size=20000,
+                   nr_threads=None):
+    """Preprocess a VTC file in a single streaming pass.
+
+    Parameters
+    ----------
+    filename_in : string
+        Input VTC file, memory mapped.
+    filename_out : string
+        Output VTC file, float data.
+    steps : list
+        Preprocessing steps, see `compile_steps`.
+    chunk_size : integer
+        Number of voxels per chunk.
+    nr_threads : integer
+        Number of worker threads.
+
+    Returns
+    -------
+    header : dictionary
+        Output VTC header.
+
+    """
+    header, data_in = open_vtc(filename_in, rearrange_data_axes=False)
+    header = dict(header)
+    header["Data type (1:short int, 2:float)"] = 2
+    data_out = allocate_vtc(filename_out, header, rearrange_data_axes=False)
+
+    nr_volumes = header["Nr time points"]
+    process(np.reshape(data_in, (-1, nr_volumes)),
+            np.reshape(data_out, (-1, nr_volumes)), steps,
+            header["TR (ms)"] / 1000., chunk_size, nr_threads)
+    data_out.flush()
+    return header
+
+
+def preprocess_stc(filename_in, filename_out, nr_slices, nr_volumes, res_x,
+                   res_y, tr, steps, data_type=2, nr_threads=None):
+    """Preprocess an STC file in a single streaming pass.
+
+    STC files store volumes one after the other, so time courses are
+    gathered one slice at a time.
+
+    Parameters
+    ----------
+    filename_in : string
+        Input STC file, memory mapped.
+    filename_out : string
+        Output STC file, float data.
+    nr_slices, nr_volumes, res_x, res_y, data_type :
+        Input dimensions, see `bvbabel.stc.read_stc`.
+    tr : float
+        Repetition time in seconds ("TR" in the FMR is in milliseconds).
+    steps : list
+        Preprocessing steps, see `compile_steps`.
+    nr_threads : integer
+        Number of worker threads.
+
+    """
+    data_in = open_stc(filename_in, nr_slices, nr_volumes, res_x, res_y,
+                       data_type, rearrange_data_axes=False)
+    data_out = open_stc(filename_out, nr_slices, nr_volumes, res_x, res_y,
+                        2, mode="w+", rearrange_data_axes=False)
+    operations = compile_steps(steps, nr_volumes, tr)
+
+    def work(s):
+        chunk = np.reshape(data_in[:, s], (nr_volumes, -1)).T
+        chunk = _apply_operations(chunk, operations)
+        data_out[:, s] = np.reshape(chunk.T, (nr_volumes, res_y, res_x))
+
+    with ThreadPoolExecutor(nr_threads) as pool:
+        for _ in pool.map(work, range(nr_slices)):
+            pass
+    data_out.flush()
@@ -0,0 +1,247 @@
+"""Resample VMR, VTC, VMP, MSK data between grids and spaces."""
+
+import functools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from bvbabel.trf import compose_trfs
+from bvbabel.utils import trilinear_weights
+
+# =============================================================================
+def grid(header, framing_cube=256):
+    """Grid geometry of a VMR, V16, VTC, VMP, MSK or GLM header.
+
+    Parameters
+    ----------
+    header : dictionary
+        Header of any volumetric BrainVoyager file.
+    framing_cube : integer
+        VMR framing cube dimension, used when the header does not tell.
+
+    Returns
+    -------
+    dims : tuple of three integers
+        Grid dimensions in BrainVoyager file order (Z, Y, X).
+    start : 1D numpy.array, (XYZ)
+        VMR voxel coordinate of the first grid voxel corner.
+    res : integer
+        Grid voxel size in VMR voxels.
+    framing_cube : integer
+        VMR framing cube dimension.
+
+    """
+    if "XStart" in header:
+        res = 1
+        for key in ["VTC resolution relative to VMR (1, 2, or 3)",
+                    "Resolution",
+                    "Resolution multiplier (1, 2, 3 times VMR resolution)"]:
+            if key in header:
+                res = int(header[key])
+        start = np.array([header["XStart"], header["YStart"],
+                          header["ZStart"]], dtype=float)
+        end = np.array([header["XEnd"], header["YEnd"], header["ZEnd"]])
+        dims = tuple(((end - start) // res).astype(int)[::-1])
+        if "Resolution" in header and "DimX" in header:  # VMP
+            framing_cube = int(header["DimX"])
+    else:
+        dims = (int(header["DimZ"]), int(header["DimY"]), int(header["DimX"]))
+        start = np.array([header.get("OffsetX", 0), header.get("OffsetY", 0),
+                          header.get("OffsetZ", 0)], dtype=float)
+        res = 1
+        framing_cube = int(header.get("FramingCubeDim", framing_cube))
+    return dims, start, res, framing_cube
+
+
+def _framing_cube(header):
+    """VMR framing cube dimension given by a header, None if it does not."""
+    if "XStart" in header:
+        if "Resolution" in header and "DimX" in header:  # VMP
+            return int(header["DimX"])
+        return None
+    if "FramingCubeDim" in header:
+        return int(header["FramingCubeDim"])
+    return None
+
+
+def common_framing_cube(header, header_target, framing_cube=256):
+    """Framing cube dimension shared by a source and a target header.
+
+    VTC and MSK headers do not store the framing cube, they take it from
+    the other header. The default is only used when neither header tells.
+
+    Raises
+    ------
+    ValueError
+        When both headers give different framing cubes.
+
+    """
+    framing = _framing_cube(header)
+    framing_target = _framing_cube(header_target)
+    if framing is None:
+        framing = framing_target
+    elif framing_target is not None and framing_target != framing:
+        raise ValueError("Framing cubes of the headers differ ({} and {})."
+                         .format(framing, framing_target))
+    return framing_cube if framing is None else framing
+
+
+def _to_bv(data_img):
+    """RAS reader orientation to BV (Z, Y, X, ...) file order."""
+    data_img = data_img[::-1, ::-1, ::-1]  # Flip BV axes
+    return np.swapaxes(data_img, 1, 2)  # Tal to BV
+
+
+def _from_bv(data_img):
+    """BV (Z, Y, X, ...) file order to RAS reader orientation."""
+    data_img = np.swapaxes(data_img, 1, 2)  # BV to Tal
+    return data_img[::-1, ::-1, ::-1]  # Flip BV axes
+
+
+def _inplane_coordinates(header_target, matrix, framing_cube):
+    """Source coordinates of a target (Y, X) plane and the Z step, cached."""
+    dims, start, res, framing = grid(header_target, framing_cube)
+    matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+    return _plane_coordinates(dims, tuple(start), res, framing,
+                              matrix.tobytes())
+
+
+@functools.lru_cache(maxsize=8)
+def _plane_coordinates(dims, start, res, framing, matrix):
+    """Coordinates of `_inplane_coordinates` from hashable arguments.
+
+    The returned arrays are shared between calls and read-only.
+    """
+    matrix = np.frombuffer(matrix, dtype=np.float64).reshape(4, 4)
+    y, x = np.meshgrid(np.arange(dims[1]), np.arange(dims[2]), indexing="ij")
+    xyz = np.stack([x.ravel(), y.ravel(), np.zeros(x.size)], axis=1)
+    xyz = xyz * res + np.array(start) + (res - 1) / 2 - framing / 2
+    plane = xyz @ matrix[:3, :3].T + matrix[:3, 3]
+    step = matrix[:3, 2] * res
+    plane.flags.writeable = False
+    step.flags.writeable = False
+    return plane, step
+
+
+def _sample(data, coords, method):
+    """Sample (Z, Y, X, channels) data at (points, XYZ) voxel coordinates."""
+    dims = np.asarray(data.shape[:3])[::-1]  # As X, Y, Z
+    flat = np.reshape(data, (-1, data.shape[3]))
+    strides = np.array([1, dims[0], dims[0] * dims[1]])
+    inside = np.all((coords > -0.5) & (coords < dims - 0.5), axis=1)
+
+    if method == "nearest":
+        idx = np.clip(np.round(coords).astype(np.int64), 0, dims - 1)
+        out = flat[idx @ strides]
+        out[~inside] = 0
+        return out
+
+    # Trilinear corners and weights, out of grid corners get no weight
+    corners, weights = trilinear_weights(coords, dims)
+    corners = corners @ strides
+    total = np.sum(weights, axis=1, keepdims=True)
+    np.divide(weights, total, out=weights, where=total > 0)
+    weights[~inside] = 0
+
+    if method == "trilinear":
+        dtype = np.result_type(data.dtype, np.float32)
+        out = np.zeros((coords.shape[0], data.shape[3]), dtype=dtype)
+        for c in range(8):
+            out += weights[:, c, None] * flat[corners[:, c]]
+        return out
+
+    # Label mode: the label with the largest total weight among the corners
+    out = np.zeros((coords.shape[0], data.shape[3]), dtype=data.dtype)
+    for ch in range(data.shape[3]):
+        labels = np.stack([flat[corners[:, c], ch] for c in range(8)], axis=1)
+        score = np.sum((labels[:, :, None] == labels[:, None, :])
+                       * weights[:, None, :], axis=2)
+        winner = labels[np.arange(labels.shape[0]), np.argmax(score, axis=1)]
+        winner[~inside] = 0
+        out[:, ch] = winner
+    return out
+
+
+def resample(header, data_img, header_target, trfs=(), method="trilinear",
+             slab_size=8, nr_threads=None, framing_cube=256,
+             rearrange_data_axes=True):
+    """Resample volumetric data into the grid of another header.
+
+    Parameters
+    ----------
+    header : dictionary
+        Header of the data (VMR, V16, VTC, VMP, MSK, GLM).
+    data_img : 3D or 4D numpy.array
+        Data as returned by the bvbabel readers. A 4th axis (time points,
+        maps) is resampled in the same pass, e.g. all maps of a VMP at once.
+    header_target : dictionary
+        Header defining the target grid (VMR dimensions or VTC/VMP bounding
+        box).
+    trfs : list of TRF data dictionaries or 4x4 numpy.arrays
+        Transformations from the data space to the target space, in
+        processing order (see `bvbabel.trf.compose_trfs`). Empty when both
+        grids are in the same space.
+    method : string
+        "nearest", "trilinear" or "label". Label mode picks the value with
+        the largest trilinear weight among the eight neighbours, suitable for
+        segmentations and masks.
+    slab_size : integer
+        Number of target slices processed by a worker at once.
+    nr_threads : integer
+        Number of worker threads.
+    framing_cube : integer
+        VMR framing cube dimension, used when neither header tells (see
+        `common_framing_cube`).
+    rearrange_data_axes : bool
+        Axes convention of input and output, same as in the readers.
+
+    Returns
+    -------
+    data_target : 3D or 4D numpy.array
+        Resampled data. Trilinear output is float, other methods keep the
+        data type.
+
+    """
+    if method not in ("nearest", "trilinear", "label"):
+        raise ValueError("Unknown interpolation method '{}'.".format(method))
+    single = data_img.ndim == 3
+    if single:
+        data_img = data_img[..., None]
+    if rearrange_data_axes is True:
+        data_img = _to_bv(data_img)
+    data_img = np.ascontiguousarray(data_img)
+
+    framing_cube = common_framing_cube(header, header_target, framing_cube)
+    dims, start, res, framing = grid(header, framing_cube)
+    if data_img.shape[:3] != dims:
+        raise ValueError("Data dimensions {} do not match the header "
+                         "{}.".format(data_img.shape[:3], dims))
+
+    # Target VMR coordinates to source grid voxel coordinates
+    to_grid = np.eye(4)
+    to_grid[:3, :3] /= res
+    to_grid[:3, 3] = (framing / 2 - start - (res - 1) / 2) / res
+    matrix = to_grid @ compose_trfs(*trfs)
+    plane, step = _inplane_coordinates(header_target, matrix, framing_cube)
+
+    dims_target = grid(header_target, framing_cube)[0]
+    dtype = data_img.dtype
+    if method == "trilinear":
+        dtype = np.result_type(dtype, np.float32)
+    data_target = np.zeros(dims_target + data_img.shape[3:], dtype=dtype)
+    slice_size = dims_target[1] * dims_target[2]
+
+    def work(z0):
+        slab = data_target[z0:z0 + slab_size].reshape(-1, data_img.shape[3])
+        for z in range(slab.shape[0] // slice_size):
+            coords = plane + (z0 + z) * step
+            slab[z * slice_size:(z + 1) * slice_size] = _sample(
+                data_img, coords, method)
+
+    with ThreadPoolExecutor(nr_threads) as pool:
+        for _ in pool.map(work, range(0, dims_target[0], slab_size)):
+            pass
+
+    if rearrange_data_axes is True:
+        data_target = _from_bv(data_target)
+    if single:
+        data_target = data_target[..., 0]
+    return data_target
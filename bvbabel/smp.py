@@ -4,6 +4,7 @@ import struct
 import numpy as np
 from bvbabel.utils import read_variable_length_string, read_RGB_bytes
 from bvbabel.utils import write_variable_length_string, write_RGB_bytes
+from bvbabel.srf import Mesh
 
 
 # =============================================================================
@@ -263,6 +264,37 @@ def write_smp(filename, header, data_smp):
                 f.write(struct.pack('<f', data_smp[v, m]))
 
 
+# =============================================================================
+def smooth(data_smp, mesh, iterations=1, method="neighbor", sigma=None):
+    """Smooth SMP maps on the surface.
+
+    Parameters
+    ----------
+    data_smp : 2D numpy.array, [nr vertices, nr maps]
+        SMP data.
+    mesh : bvbabel.srf.Mesh or dictionary
+        Mesh of the SRF the SMP is created on, or mesh data from
+        `bvbabel.srf.read_srf`. Pass a Mesh to reuse its cached weights.
+    iterations : integer
+        Number of smoothing steps.
+    method : string, "neighbor" or "heat"
+        Neighbor averaging or iterated heat kernel smoothing.
+    sigma : float
+        Heat kernel width in vertex coordinate units. Defaults to the mean
+        edge length.
+
+    Returns
+    -------
+    data_smp : 2D numpy.array, [nr vertices, nr maps]
+        Smoothed maps (float32). All maps are smoothed together with one
+        sparse product per iteration.
+
+    """
+    if not isinstance(mesh, Mesh):
+        mesh = Mesh(mesh)
+    return mesh.smooth(data_smp, iterations, method, sigma)
+
+
 def create_smp(nr_maps=1, nr_vertices=64000):
     """Create BrainVoyager SMP file with default values."""
     nr_vertices = int(nr_vertices)
@@ -1,8 +1,11 @@
 """Read, write, create BrainVoyager SRF file format."""
 
+import heapq
 import struct
 import numpy as np
 from bvbabel.utils import read_variable_length_string, write_variable_length_string
+from bvbabel.utils import csr_from_triplets, csr_reduce, csr_dot
+from bvbabel.utils import csr_submatrix
 
 
 # =============================================================================
@@ -380,3 +383,461 @@ def create_srf():
                  'faces': np.array([], dtype=np.int32),
                  'strip_sequence': np.array([], dtype=np.int32)}
     return header, mesh_data
+
+
+# =============================================================================
+class Mesh:
+    """Sparse mesh operators built from SRF vertices and faces.
+
+    Adjacency, vertex areas and the cotangent Laplacian are computed on first
+    use and kept in `cache`, so that repeated operations on the same mesh
+    only cost sparse matrix products.
+
+    Parameters
+    ----------
+    mesh_data : dictionary
+        Mesh data as returned by `read_srf`. "vertices" and "faces" are
+        required, "vertex normals" are used if present.
+
+    """
+
+    def __init__(self, mesh_data):
+        self.vertices = np.asarray(mesh_data["vertices"], dtype=np.float64)
+        self.faces = np.asarray(mesh_data["faces"], dtype=np.int64)
+        self.nr_vertices = self.vertices.shape[0]
+        self.cache = dict()
+        if "vertex normals" in mesh_data:
+            normals = np.asarray(mesh_data["vertex normals"], dtype=np.float64)
+            if normals.shape == self.vertices.shape:
+                self.cache["vertex_normals"] = normals
+
+    # -------------------------------------------------------------------------
+    @property
+    def adjacency(self):
+        """Vertex adjacency as compressed sparse row arrays (indptr, indices).
+
+        Neighbors of vertex `v` are `indices[indptr[v]:indptr[v + 1]]`.
+        """
+        if "adjacency" not in self.cache:
+            f = self.faces
+            rows = np.concatenate([f[:, 0], f[:, 1], f[:, 2],
+                                   f[:, 1], f[:, 2], f[:, 0]])
+            cols = np.concatenate([f[:, 1], f[:, 2], f[:, 0],
+                                   f[:, 0], f[:, 1], f[:, 2]])
+            n = self.nr_vertices
+            indptr, indices, _ = csr_from_triplets(
+                rows, cols, np.ones(rows.size), (n, n))
+            self.cache["adjacency"] = indptr, indices
+        return self.cache["adjacency"]
+
+    @property
+    def degree(self):
+        """Number of neighbors of each vertex."""
+        return np.diff(self.adjacency[0])
+
+    @property
+    def edge_lengths(self):
+        """Euclidean length of each adjacency entry (aligned with indices)."""
+        if "edge_lengths" not in self.cache:
+            indptr, indices = self.adjacency
+            rows = np.repeat(np.arange(self.nr_vertices), np.diff(indptr))
+            self.cache["edge_lengths"] = np.linalg.norm(
+                self.vertices[rows] - self.vertices[indices], axis=1)
+        return self.cache["edge_lengths"]
+
+    @property
+    def face_normals(self):
+        """Face normals scaled by twice the face area."""
+        if "face_normals" not in self.cache:
+            v0, v1, v2 = (self.vertices[self.faces[:, i]] for i in range(3))
+            self.cache["face_normals"] = np.cross(v1 - v0, v2 - v0)
+        return self.cache["face_normals"]
+
+    @property
+    def vertex_normals(self):
+        """Unit vertex normals, area weighted from faces if not given."""
+        if "vertex_normals" not in self.cache:
+            normals = np.zeros((self.nr_vertices, 3))
+            for i in range(3):
+                for a in range(3):
+                    normals[:, a] += np.bincount(
+                        self.faces[:, i], weights=self.face_normals[:, a],
+                        minlength=self.nr_vertices)
+            norm = np.linalg.norm(normals, axis=1, keepdims=True)
+            self.cache["vertex_normals"] = normals / np.maximum(norm, 1e-12)
+        return self.cache["vertex_normals"]
+
+    @property
+    def face_areas(self):
+        """Area of each triangle."""
+        if "face_areas" not in self.cache:
+            self.cache["face_areas"] = 0.5 * np.linalg.norm(
+                self.face_normals, axis=1)
+        return self.cache["face_areas"]
+
+    @property
+    def vertex_areas(self):
+        """Barycentric vertex areas (one third of the adjacent face areas)."""
+        if "vertex_areas" not in self.cache:
+            areas = np.zeros(self.nr_vertices)
+            for i in range(3):
+                areas += np.bincount(self.faces[:, i], weights=self.face_areas,
+                                     minlength=self.nr_vertices)
+            self.cache["vertex_areas"] = areas / 3
+        return self.cache["vertex_areas"]
+
+    @property
+    def cotangent_weights(self):
+        """Cotangent edge weights as compressed sparse row arrays.
+
+        Returns (indptr, indices, data) with the same sparsity pattern as
+        `adjacency`. The weight of edge (i, j) is half the sum of the
+        cotangents of the two angles opposite to it.
+        """
+        if "cotangent_weights" not in self.cache:
+            f = self.faces
+            rows, cols, cots = [], [], []
+            for i, j, k in ((0, 1, 2), (1, 2, 0), (2, 0, 1)):
+                u = self.vertices[f[:, i]] - self.vertices[f[:, k]]
+                w = self.vertices[f[:, j]] - self.vertices[f[:, k]]
+                cross = np.linalg.norm(np.cross(u, w), axis=1)
+                cot = np.sum(u * w, axis=1) / np.maximum(cross, 1e-12)
+                rows += [f[:, i], f[:, j]]
+                cols += [f[:, j], f[:, i]]
+                cots += [0.5 * cot, 0.5 * cot]
+            n = self.nr_vertices
+            self.cache["cotangent_weights"] = csr_from_triplets(
+                np.concatenate(rows), np.concatenate(cols),
+                np.concatenate(cots), (n, n))
+        return self.cache["cotangent_weights"]
+
+    def smoothing_weights(self, method="neighbor", sigma=None):
+        """Row normalized smoothing weights, including each vertex itself.
+
+        Parameters
+        ----------
+        method : string, "neighbor" or "heat"
+            "neighbor" averages each vertex with its neighbors. "heat" uses
+            Gaussian weights exp(-d^2 / (2 * sigma^2)) of edge lengths
+            (iterated heat kernel smoothing).
+        sigma : float
+            Heat kernel width in vertex coordinate units. Defaults to the
+            mean edge length.
+
+        Returns
+        -------
+        indptr, indices, data : 1D numpy.arrays
+            Compressed sparse row weights.
+
+        """
+        if method == "heat" and sigma is None:
+            sigma = float(np.mean(self.edge_lengths))
+        key = ("smoothing_weights", method,
+               sigma if method == "heat" else None)
+        if key not in self.cache:
+            indptr, indices = self.adjacency
+            n = self.nr_vertices
+            rows = np.repeat(np.arange(n), np.diff(indptr))
+            if method == "neighbor":
+                weights = np.ones(indices.size)
+            elif method == "heat":
+                weights = np.exp(-self.edge_lengths**2 / (2 * sigma**2))
+            else:
+                raise ValueError("Unknown smoothing method: {}".format(method))
+            weights = np.concatenate([weights, np.ones(n)])
+            rows = np.concatenate([rows, np.arange(n)])
+            cols = np.concatenate([indices, np.arange(n)])
+            weights /= np.bincount(rows, weights=weights, minlength=n)[rows]
+            self.cache[key] = csr_from_triplets(rows, cols, weights, (n, n))
+        return self.cache[key]
+
+    def rings(self, idx, nr_rings=1):
+        """Vertex indices within `nr_rings` edges of the given vertices.
+
+        Parameters
+        ----------
+        idx : 1D numpy.array, int
+            Seed vertex indices.
+        nr_rings : integer
+            Number of neighbor rings to add.
+
+        Returns
+        -------
+        idx : 1D numpy.array, int64
+            Sorted unique vertex indices, including the seeds.
+
+        """
+        indptr, indices = self.adjacency
+        mask = np.zeros(self.nr_vertices, dtype=bool)
+        mask[idx] = True
+        front = np.unique(idx)
+        for _ in range(nr_rings):
+            lengths = indptr[front + 1] - indptr[front]
+            offsets = np.cumsum(lengths) - lengths
+            pos = (np.arange(lengths.sum()) - np.repeat(offsets, lengths)
+                   + np.repeat(indptr[front], lengths))
+            front = np.unique(indices[pos])
+            front = front[~mask[front]]
+            mask[front] = True
+        return np.flatnonzero(mask)
+
+    def smooth(self, values, iterations=1, method="neighbor", sigma=None,
+               chunk_size=None, out=None):
+        """Iteratively smooth vertex-wise values.
+
+        Parameters
+        ----------
+        values : 1D or 2D numpy.array, (nr vertices, ...)
+            Vertex-wise values, e.g. all maps of an SMP or all time points of
+            an MTC. Can be a numpy.memmap.
+        iterations : integer
+            Number of smoothing steps.
+        method : string, "neighbor" or "heat"
+            See `smoothing_weights`.
+        sigma : float
+            Heat kernel width, see `smoothing_weights`.
+        chunk_size : integer
+            If given, vertices are processed in chunks of this size. Each
+            chunk is read together with an `iterations` ring neighborhood,
+            so that only the rows of `values` around the chunk are in memory.
+        out : numpy.array
+            Optional output array, e.g. a writable numpy.memmap.
+
+        Returns
+        -------
+        out : 1D or 2D numpy.array, float32, (nr vertices, ...)
+
+        """
+        indptr, indices, data = self.smoothing_weights(method, sigma)
+        if out is None:
+            out = np.zeros(values.shape, dtype=np.float32)
+        if chunk_size is None:
+            chunk_size = self.nr_vertices
+
+        for i in range(0, self.nr_vertices, chunk_size):
+            core = np.arange(i, min(i + chunk_size, self.nr_vertices))
+            if core.size == self.nr_vertices:
+                idx, sub = core, (indptr, indices, data)
+            else:
+                idx = self.rings(core, iterations)
+                sub = csr_submatrix(indptr, indices, data, idx)
+            temp = np.asarray(values[idx], dtype=np.float32)
+            for _ in range(iterations):
+                temp = csr_dot(*sub, temp).astype(np.float32)
+            out[core[0]:core[-1] + 1] = temp[np.searchsorted(idx, core)]
+        return out
+
+    # -------------------------------------------------------------------------
+    def neighbor_reduce(self, values, ufunc=np.add, fill=0):
+        """Reduce values over the neighbors of each vertex.
+
+        Parameters
+        ----------
+        values : 1D or 2D numpy.array, (nr vertices, ...)
+            Vertex-wise values, e.g. all maps of an SMP.
+        ufunc : numpy.ufunc
+            Reduction, e.g. numpy.add, numpy.maximum or numpy.minimum.
+        fill : float
+            Output of vertices without neighbors.
+
+        Returns
+        -------
+        out : 1D or 2D numpy.array, (nr vertices, ...)
+
+        """
+        indptr, indices = self.adjacency
+        return csr_reduce(indptr, np.asarray(values)[indices], ufunc, fill)
+
+    def neighbor_sum(self, values):
+        """Sum of neighbor values of each vertex."""
+        return self.neighbor_reduce(values, np.add)
+
+    def neighbor_mean(self, values):
+        """Mean of neighbor values of each vertex."""
+        values = np.asarray(values)
+        degree = np.maximum(self.degree, 1)
+        degree = degree.reshape((-1,) + (1,) * (values.ndim - 1))
+        return self.neighbor_sum(values) / degree
+
+    def neighbor_max(self, values):
+        """Maximum of neighbor values of each vertex."""
+        return self.neighbor_reduce(values, np.maximum)
+
+    def neighbor_min(self, values):
+        """Minimum of neighbor values of each vertex."""
+        return self.neighbor_reduce(values, np.minimum)
+
+    def laplacian(self, values):
+        """Apply the cotangent Laplacian, sum_j w_ij * (f_j - f_i).
+
+        Divide by `vertex_areas` for the area normalized Laplace-Beltrami
+        operator.
+        """
+        indptr, indices, data = self.cotangent_weights
+        values = np.asarray(values)
+        diag = csr_reduce(indptr, data)
+        diag = diag.reshape((-1,) + (1,) * (values.ndim - 1))
+        return csr_dot(indptr, indices, data, values) - diag * values
+
+    def gradient(self, values):
+        """Gradient of piecewise linear vertex values.
+
+        Face gradients are averaged to vertices weighted by face area.
+
+        Parameters
+        ----------
+        values : 1D or 2D numpy.array, (nr vertices, ...)
+            Vertex-wise values, e.g. all maps of an SMP.
+
+        Returns
+        -------
+        gradient : 2D or 3D numpy.array, (nr vertices, ..., XYZ)
+
+        """
+        values = np.asarray(values, dtype=np.float64)
+        f = self.faces
+        normals = self.face_normals
+        double_area = np.maximum(np.linalg.norm(normals, axis=1), 1e-12)
+        unit = normals / double_area[:, None]
+        grad = 0
+        for i, j, k in ((0, 1, 2), (1, 2, 0), (2, 0, 1)):
+            # Gradient of the hat function of vertex i within each face
+            edge = self.vertices[f[:, k]] - self.vertices[f[:, j]]
+            hat = np.cross(unit, edge) / double_area[:, None]
+            if values.ndim == 1:
+                grad = grad + values[f[:, i], None] * hat
+            else:
+                grad = grad + values[f[:, i], :, None] * hat[:, None, :]
+
+        if "face_to_vertex" not in self.cache:
+            n = self.nr_vertices
+            rows = f.T.ravel()
+            cols = np.tile(np.arange(f.shape[0]), 3)
+            weights = self.face_areas[cols] / np.maximum(
+                3 * self.vertex_areas[rows], 1e-12)
+            self.cache["face_to_vertex"] = csr_from_triplets(
+                rows, cols, weights, (n, f.shape[0]))
+        indptr, indices, data = self.cache["face_to_vertex"]
+        shape = grad.shape
+        out = csr_dot(indptr, indices, data, grad.reshape(shape[0], -1))
+        return out.reshape((self.nr_vertices,) + shape[1:])
+
+    def geodesic_neighborhood(self, sources, max_distance=np.inf):
+        """Vertices within a geodesic distance of one or multiple sources.
+
+        Same search as `geodesic_distance`, but only the reached vertices
+        are returned, so that small neighborhoods of large meshes stay
+        cheap. Only the adjacency lists are cached, results are not, so that
+        many calls (e.g. one per POI) do not accumulate memory.
+
+        Parameters
+        ----------
+        sources : integer or 1D numpy.array, int
+            Source vertex indices.
+        max_distance : float
+            Search stops at this distance (vertex coordinate units).
+
+        Returns
+        -------
+        vertices : 1D numpy.array, int64
+            Reached vertices, in order of increasing distance.
+        distance : 1D numpy.array, float64
+            Distance of each reached vertex to its nearest source.
+        nearest : 1D numpy.array, int64
+            Position of the nearest source in `sources`.
+
+        """
+        sources = [int(s) for s in np.atleast_1d(sources)]
+        if "adjacency_lists" not in self.cache:
+            # Python lists are much faster to index in the loop below
+            indptr, indices = self.adjacency
+            self.cache["adjacency_lists"] = (
+                indptr.tolist(), indices.tolist(), self.edge_lengths.tolist())
+        indptr, indices, lengths = self.cache["adjacency_lists"]
+
+        dist, label, best = dict(), dict(), dict()
+        heap = [(0.0, s, i) for i, s in enumerate(sources)]
+        heapq.heapify(heap)
+        while heap:
+            d, v, i = heapq.heappop(heap)
+            if v in dist:
+                continue
+            dist[v] = d
+            label[v] = i
+            for e in range(indptr[v], indptr[v + 1]):
+                n = indices[e]
+                nd = d + lengths[e]
+                if nd <= max_distance and nd < best.get(n, np.inf) \
+                        and n not in dist:
+                    best[n] = nd
+                    heapq.heappush(heap, (nd, n, i))
+
+        return (np.fromiter(dist.keys(), dtype=np.int64, count=len(dist)),
+                np.fromiter(dist.values(), dtype=np.float64, count=len(dist)),
+                np.fromiter(label.values(), dtype=np.int64, count=len(dist)))
+
+    def geodesic_distance(self, sources, max_distance=np.inf):
+        """Geodesic distance from one or multiple source vertices.
+
+        Distances are shortest paths along mesh edges (Dijkstra), which
+        slightly overestimate true geodesic distances on irregular meshes.
+
+        Parameters
+        ----------
+        sources : integer or 1D numpy.array, int
+            Source vertex indices.
+        max_distance : float
+            Search stops at this distance (vertex coordinate units).
+
+        Returns
+        -------
+        distance : 1D numpy.array, (nr vertices)
+            Distance to the nearest source. Not reached vertices are inf.
+        nearest : 1D numpy.array, int, (nr vertices)
+            Position of the nearest source in `sources`. Not reached vertices
+            are -1.
+
+        """
+        vertices, dist, label = self.geodesic_neighborhood(sources,
+                                                            max_distance)
+        distance = np.full(self.nr_vertices, np.inf)
+        nearest = np.full(self.nr_vertices, -1, dtype=np.int64)
+        distance[vertices] = dist
+        nearest[vertices] = label
+        return distance, nearest
+
+    def cortical_magnification(self, prf_xy, scale=1.0):
+        """Cortical magnification factor from population receptive fields.
+
+        For each vertex, the ratio of cortical distance to visual field
+        distance is averaged over its neighbors. Neighbors with identical
+        visual field positions are ignored.
+
+        Parameters
+        ----------
+        prf_xy : 2D numpy.array, (nr vertices, 2)
+            Visual field x and y coordinates (degrees). Vertices with a zero
+            coordinate are treated as missing and get a zero.
+        scale : float
+            Millimeters per vertex coordinate unit, e.g.
+            (VMR dimension / 256) * voxel size.
+
+        Returns
+        -------
+        cmf : 1D numpy.array, (nr vertices)
+            Cortical magnification (mm / degree).
+
+        """
+        prf_xy = np.asarray(prf_xy, dtype=np.float64)
+        indptr, indices = self.adjacency
+        rows = np.repeat(np.arange(self.nr_vertices), np.diff(indptr))
+        dist_vfield = np.linalg.norm(prf_xy[rows] - prf_xy[indices], axis=1)
+        valid = dist_vfield > 0
+        ratio = np.zeros(indices.size)
+        ratio[valid] = self.edge_lengths[valid] * scale / dist_vfield[valid]
+        cmf_sum = csr_reduce(indptr, ratio)
+        count = csr_reduce(indptr, valid.astype(np.int64))
+        cmf = np.zeros(self.nr_vertices)
+        idx = (count > 0) & np.all(prf_xy != 0, axis=1)
+        cmf[idx] = cmf_sum[idx] / count[idx]
+        return cmf
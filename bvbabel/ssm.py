@@ -1,7 +1,11 @@
 """Read, write, create BrainVoyager SSM file format."""
 
 import struct
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from bvbabel.mtc import open_mtc, _write_mtc_header
+from bvbabel.srf import Mesh
+from bvbabel.utils import csr_reduce
 
 
 # =============================================================================
@@ -18,7 +22,9 @@ def read_ssm(filename):
     header : dictionary
         Header containing SMP information.
     data : 1D numpy.array
-        Data containing vertex indices
+        Data containing vertex indices. For each vertex of mesh 1, the
+        0-based index of a vertex of the referenced mesh 2, as stored in the
+        file.
 
     """
     header = dict()
@@ -39,9 +45,8 @@ def read_ssm(filename):
         # ---------------------------------------------------------------------
         # Data
         # ---------------------------------------------------------------------
-        data_ssm = np.zeros(header["Nr vertices 1"], dtype=int)
-        for i in range(header["Nr vertices 1"]):
-            data_ssm[i], = struct.unpack('<i', f.read(4))
+        data_ssm = np.fromfile(f, dtype='<i4', count=header["Nr vertices 1"])
+        data_ssm = data_ssm.astype(int)
 
     return header, data_ssm
 
@@ -56,7 +61,7 @@ def write_ssm(filename, header, data_ssm):
     header : dictionary
         Header containing SMP information
     data_ssm : 1D numpy.array
-        Data containing vertex indices
+        Data containing vertex indices, 0-based (see `read_ssm`).
 
     """
     with open(filename, 'wb') as f:
@@ -80,6 +85,7 @@ def write_ssm(filename, header, data_ssm):
 
 
 def create_ssm(nr_vertices=32492):
+    """Create identity surface to surface mapping (0-based indices)."""
     nr_vertices = int(nr_vertices)
 
     # Create header
@@ -89,6 +95,321 @@ def create_ssm(nr_vertices=32492):
     header["Nr vertices 2"] = nr_vertices
 
     # Create data
-    data_ssm = np.arange(1, nr_vertices+1)
+    data_ssm = np.arange(nr_vertices)
 
     return header, data_ssm
+
+
+# =============================================================================
+def apply(data, data_ssm, weights=None, chunk_size=None, out=None):
+    """Resample vertex-wise data with a surface to surface mapping.
+
+    Parameters
+    ----------
+    data : 1D or 2D numpy.array, (nr vertices 2, ...)
+        Vertex-wise data of the referenced mesh, e.g. SMP maps or MTC time
+        courses. Can be a memory map (`bvbabel.mtc.open_mtc`).
+    data_ssm : 1D or 2D numpy.array, int, (nr vertices 1, ...)
+        Referenced 0-based vertex index of each vertex (`read_ssm`,
+        `create_ssm`, `build_from_srfs`), or several vertex indices per
+        vertex (e.g. triangle corners) when `weights` are given.
+    weights : 2D numpy.array, (nr vertices 1, nr indices per vertex)
+        Interpolation weights, e.g. barycentric coordinates.
+    chunk_size : integer
+        Number of output vertices processed at once. Each chunk reads only
+        the referenced vertices it needs.
+    out : numpy.array
+        Optional output array, (nr vertices 1, ...).
+
+    Returns
+    -------
+    out : 1D or 2D numpy.array, float32, (nr vertices 1, ...)
+
+    """
+    data_ssm = np.asarray(data_ssm)
+    nr_vertices = data_ssm.shape[0]
+    if data_ssm.size > 0 and (data_ssm.min() < 0
+                              or data_ssm.max() >= data.shape[0]):
+        raise ValueError("SSM vertex indices must be 0-based and below the "
+                         "number of referenced vertices ({}).".format(
+                             data.shape[0]))
+    if out is None:
+        out = np.zeros((nr_vertices,) + data.shape[1:], dtype=np.float32)
+    if chunk_size is None:
+        chunk_size = nr_vertices
+
+    for i in range(0, nr_vertices, chunk_size):
+        idx = data_ssm[i:i + chunk_size]
+        if isinstance(data, np.memmap):
+            # Read each referenced vertex once, in file order
+            uniq, inverse = np.unique(idx, return_inverse=True)
+            temp = np.asarray(data[uniq], dtype=np.float32)
+            temp = temp[inverse.reshape(idx.shape)]
+        else:
+            temp = np.asarray(data[idx], dtype=np.float32)
+        if weights is not None:
+            w = weights[i:i + chunk_size].astype(np.float32)
+            w = w.reshape(w.shape + (1,) * (temp.ndim - w.ndim))
+            temp = np.sum(w * temp, axis=1)
+        out[i:i + temp.shape[0]] = temp
+    return out
+
+
+def apply_mtc(filename_in, filename_out, data_ssm, weights=None,
+              chunk_size=10000):
+    """Resample an MTC file with a surface to surface mapping.
+
+    The input is read as a memory map and the output is written in vertex
+    chunks, so neither time course matrix has to fit in memory.
+
+    Parameters
+    ----------
+    filename_in : string
+        Path to MTC file of the referenced mesh (nr vertices 2).
+    filename_out : string
+        Path of the resampled MTC file (nr vertices 1).
+    data_ssm : 1D or 2D numpy.array, int
+        See `apply`.
+    weights : 2D numpy.array
+        See `apply`.
+    chunk_size : integer
+        Number of output vertices processed at once.
+
+    Returns
+    -------
+    header : dictionary
+        Header of the resampled MTC.
+
+    """
+    header, data_mtc = open_mtc(filename_in)
+    header = dict(header)
+    header["Nr vertices"] = np.asarray(data_ssm).shape[0]
+    with open(filename_out, 'wb') as f:
+        _write_mtc_header(f, header)
+        for i in range(0, header["Nr vertices"], chunk_size):
+            w = None if weights is None else weights[i:i + chunk_size]
+            temp = apply(data_mtc, data_ssm[i:i + chunk_size], w)
+            temp.astype('<f4').tofile(f)
+    return header
+
+
+# =============================================================================
+def _grid_index(mesh, max_cells=2**24):
+    """Uniform grid over mesh vertices, cached in `mesh.cache`.
+
+    Returns the grid origin, cell size, grid dimensions, the start of each
+    cell in the sorted vertex order (dense, one extra entry at the end) and
+    that vertex order.
+    """
+    if "grid_index" not in mesh.cache:
+        points = mesh.vertices
+        origin = points.min(axis=0)
+        extent = points.max(axis=0) - origin
+        # About two vertices per cell, unless the grid gets too large
+        cell = max(2 * float(np.mean(mesh.edge_lengths)),
+                   float(np.prod(extent + 1e-6) / max_cells) ** (1 / 3))
+        cells = ((points - origin) // cell).astype(np.int64)
+        dims = cells.max(axis=0) + 1
+        keys = cells[:, 0] + dims[0] * (cells[:, 1] + dims[1] * cells[:, 2])
+        order = np.argsort(keys, kind="stable")
+        starts = np.zeros(np.prod(dims) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(keys, minlength=np.prod(dims)), out=starts[1:])
+        mesh.cache["grid_index"] = origin, cell, dims, starts, order
+    return mesh.cache["grid_index"]
+
+
+def _search_cells(mesh, queries, radius):
+    """Nearest vertex among the grid cells within `radius` cells."""
+    origin, cell, dims, starts, order = _grid_index(mesh)
+    cells = np.floor((queries - origin) / cell).astype(np.int64)
+    steps = np.arange(-radius, radius + 1)
+    offsets = np.stack(np.meshgrid(steps, steps, steps), axis=-1)
+
+    # NOTE: Distances (float32 bits, monotonic for positive values) and
+    # vertex indices are packed into one integer so that a single minimum
+    # reduction finds the nearest vertex.
+    empty = np.iinfo(np.int64).max
+    best = np.full(queries.shape[0], empty)
+    for offset in offsets.reshape(-1, 3):
+        c = cells + offset
+        valid = np.flatnonzero(np.all((c >= 0) & (c < dims), axis=1))
+        k = c[valid, 0] + dims[0] * (c[valid, 1] + dims[1] * c[valid, 2])
+        start = starts[k]
+        lengths = starts[k + 1] - start
+        first = np.cumsum(lengths) - lengths
+        pos = (np.arange(lengths.sum()) - np.repeat(first, lengths)
+               + np.repeat(start, lengths))
+        cand = order[pos]
+        diff = queries[np.repeat(valid, lengths)] - mesh.vertices[cand]
+        dist = np.sqrt(np.sum(diff * diff, axis=1)).astype(np.float32)
+        packed = (dist.view(np.int32).astype(np.int64) << 32) | cand
+        indptr = np.zeros(valid.size + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        packed = csr_reduce(indptr, packed, np.minimum, empty)
+        best[valid] = np.minimum(best[valid], packed)
+
+    found = best < empty
+    nearest = np.where(found, best & 0xFFFFFFFF, -1)
+    distance = np.full(queries.shape[0], np.inf)
+    distance[found] = (best[found] >> 32).astype(np.int32).view(np.float32)
+    return nearest, distance
+
+
+def _nearest_vertex(mesh, queries, max_radius=4, chunk_size=2**24):
+    """Nearest mesh vertex and its distance for each query point.
+
+    The grid search radius is doubled for queries whose nearest vertex is
+    not guaranteed to be within the searched cells. Queries still left
+    after `max_radius` cells are compared against all vertices.
+    """
+    origin, cell = _grid_index(mesh)[:2]
+    # Distance from each query to the border of its own cell
+    frac = (queries - origin) / cell % 1
+    border = cell * np.min(np.minimum(frac, 1 - frac), axis=1)
+
+    nearest = np.full(queries.shape[0], -1, dtype=np.int64)
+    distance = np.full(queries.shape[0], np.inf)
+    todo = np.arange(queries.shape[0])
+    radius = 1
+    while todo.size > 0 and radius <= max_radius:
+        n, d = _search_cells(mesh, queries[todo], radius)
+        nearest[todo], distance[todo] = n, d
+        todo = todo[d > radius * cell + border[todo]]
+        radius *= 2
+
+    step = max(chunk_size // mesh.nr_vertices, 1)
+    for i in range(0, todo.size, step):
+        q = todo[i:i + step]
+        d = np.sum((queries[q, None, :] - mesh.vertices[None]) ** 2, axis=2)
+        nearest[q] = np.argmin(d, axis=1)
+        distance[q] = np.sqrt(d[np.arange(q.size), nearest[q]])
+    return nearest, distance
+
+
+def _nearest_triangle(mesh, queries, nearest):
+    """Barycentric coordinates in the closest triangle around nearest vertices.
+
+    This is an approximation: only the triangles that contain the nearest
+    vertex are considered. On meshes with long thin triangles the closest
+    triangle can lack the nearest vertex, a triangle next to it is then
+    returned. Sphere registered meshes with regular triangles are not
+    affected in practice.
+    """
+    if "vertex_faces" not in mesh.cache:
+        rows = mesh.faces.T.ravel()
+        order = np.argsort(rows, kind="stable")
+        indptr = np.zeros(mesh.nr_vertices + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=mesh.nr_vertices),
+                  out=indptr[1:])
+        faces = np.tile(np.arange(mesh.faces.shape[0]), 3)[order]
+        mesh.cache["vertex_faces"] = indptr, faces
+    indptr, faces = mesh.cache["vertex_faces"]
+
+    lengths = indptr[nearest + 1] - indptr[nearest]
+    offsets = np.cumsum(lengths) - lengths
+    pos = (np.arange(lengths.sum()) - np.repeat(offsets, lengths)
+           + np.repeat(indptr[nearest], lengths))
+    qid = np.repeat(np.arange(queries.shape[0]), lengths)
+    tri = mesh.faces[faces[pos]]
+
+    # Barycentric coordinates of the projection onto each triangle plane
+    p = queries[qid]
+    a, b, c = (mesh.vertices[tri[:, i]] for i in range(3))
+    v0, v1, v2 = b - a, c - a, p - a
+    d00 = np.sum(v0 * v0, axis=1)
+    d01 = np.sum(v0 * v1, axis=1)
+    d11 = np.sum(v1 * v1, axis=1)
+    d20 = np.sum(v2 * v0, axis=1)
+    d21 = np.sum(v2 * v1, axis=1)
+    denom = np.maximum(d00 * d11 - d01 * d01, 1e-12)
+    w1 = (d11 * d20 - d01 * d21) / denom
+    w2 = (d00 * d21 - d01 * d20) / denom
+    weights = np.stack([1 - w1 - w2, w1, w2], axis=1)
+
+    # Points outside of a triangle are moved onto it
+    weights = np.maximum(weights, 0)
+    weights /= np.maximum(weights.sum(axis=1, keepdims=True), 1e-12)
+    closest = (weights[:, 0, None] * a + weights[:, 1, None] * b
+               + weights[:, 2, None] * c)
+    dist = np.linalg.norm(p - closest, axis=1)
+
+    idx = np.lexsort((dist, qid))
+    first = idx[np.r_[True, qid[idx][1:] != qid[idx][:-1]]]
+    return tri[first], weights[first]
+
+
+def build_from_srfs(mesh_data_1, mesh_data_2, method="vertex",
+                    nr_threads=None, chunk_size=50000):
+    """Create surface to surface mapping between two meshes.
+
+    Each vertex of mesh 1 is mapped onto mesh 2, e.g. between sphere
+    registered meshes. Mesh 2 vertices are put into a uniform grid that is
+    cached on the Mesh, and mesh 1 vertices are queried in parallel chunks.
+
+    Parameters
+    ----------
+    mesh_data_1 : dictionary or bvbabel.srf.Mesh
+        Mesh whose vertices are mapped (`bvbabel.srf.read_srf`).
+    mesh_data_2 : dictionary or bvbabel.srf.Mesh
+        Referenced mesh. Pass a Mesh to reuse its spatial index.
+    method : string, "vertex" or "barycentric"
+        Nearest vertex, or barycentric coordinates within the closest
+        triangle of mesh 2 among those around the nearest vertex.
+    nr_threads : integer
+        Number of worker threads. Defaults to the number of processors.
+    chunk_size : integer
+        Number of mesh 1 vertices per query.
+
+    Returns
+    -------
+    header : dictionary
+        SSM header.
+    data_ssm : 1D numpy.array, int
+        0-based mesh 2 vertex index of each mesh 1 vertex, the same base as
+        `read_ssm` and `create_ssm`, ready for `write_ssm`. For
+        "barycentric", the triangle corner with the largest weight.
+    barycentric : tuple of two 2D numpy.arrays or None
+        For "barycentric", triangle corner indices and weights, both
+        (nr vertices 1, 3), to be used with `apply`.
+
+    """
+    vertices_1 = np.asarray(mesh_data_1.vertices if isinstance(
+        mesh_data_1, Mesh) else mesh_data_1["vertices"], dtype=np.float64)
+    mesh = mesh_data_2 if isinstance(mesh_data_2, Mesh) else Mesh(mesh_data_2)
+    if method not in ("vertex", "barycentric"):
+        raise ValueError("Unknown mapping method: {}".format(method))
+    # Build the grid before the threads start and sort queries by grid cell
+    # for memory locality
+    origin, cell, dims = _grid_index(mesh)[:3]
+    cells = np.clip((vertices_1 - origin) // cell, 0, dims - 1).astype(int)
+    order = np.argsort(cells[:, 0] + dims[0] * (cells[:, 1]
+                                                + dims[1] * cells[:, 2]))
+    vertices_sorted = vertices_1[order]
+
+    def query(i):
+        queries = vertices_sorted[i:i + chunk_size]
+        nearest, _ = _nearest_vertex(mesh, queries)
+        if method == "vertex":
+            return nearest, None, None
+        corners, weights = _nearest_triangle(mesh, queries, nearest)
+        return nearest, corners, weights
+
+    with ThreadPoolExecutor(nr_threads) as pool:
+        results = list(pool.map(query, range(0, vertices_1.shape[0],
+                                             chunk_size)))
+
+    inverse = np.argsort(order)
+    data_ssm = np.concatenate([r[0] for r in results])[inverse]
+    barycentric = None
+    if method == "barycentric":
+        corners = np.concatenate([r[1] for r in results])[inverse]
+        weights = np.concatenate([r[2] for r in results])[inverse]
+        data_ssm = corners[np.arange(corners.shape[0]),
+                           np.argmax(weights, axis=1)]
+        barycentric = corners, weights
+
+    header = dict()
+    header["File version"] = 2
+    header["Nr vertices 1"] = vertices_1.shape[0]
+    header["Nr vertices 2"] = mesh.nr_vertices
+    return header, data_ssm, barycentric
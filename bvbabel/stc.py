@@ -62,6 +62,45 @@ def read_stc(filename, nr_slices, nr_volumes, res_x, res_y, data_type=2, rearran
     return data_img
 
 
+# =============================================================================
+def open_stc(filename, nr_slices, nr_volumes, res_x, res_y, data_type=2,
+             mode="r", rearrange_data_axes=True):
+    """Open BrainVoyager STC file as a memory map.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    nr_slices, nr_volumes, res_x, res_y, data_type :
+        Same as in `read_stc`.
+    mode : string
+        numpy.memmap mode. "r" for reading, "r+" for modifying in place, "w+"
+        for creating a new (zero initialized) file.
+    rearrange_data_axes : bool
+        Axes convention, same as in `read_stc`.
+
+    Returns
+    -------
+    data : 4D numpy.memmap
+        Image data as in `read_stc`, as a view on the file.
+
+    """
+    if data_type == 1:
+        dtype = "<h"
+    elif data_type == 2:
+        dtype = "<f"
+    else:
+        raise ValueError("Unrecognized STC data type.")
+    data_img = np.memmap(filename, dtype=dtype, mode=mode,
+                         shape=(nr_volumes, nr_slices, res_y, res_x))
+
+    if rearrange_data_axes is True:
+        data_img = np.transpose(data_img, (2, 3, 1, 0))
+        data_img = data_img[:, ::-1, :, :]  # Flip BV axes
+
+    return data_img
+
+
 # =============================================================================
 def write_stc(filename, data_img, data_type=2, rearrange_data_axes=True):
     """Protocol to write BrainVoyager STC file.
@@ -0,0 +1,29 @@
+"""Shared fixtures of the bvbabel tests."""
+
+import os
+import gzip
+import shutil
+import pytest
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir, os.pardir, "test_data")
+
+
+@pytest.fixture
+def test_data(tmp_path):
+    """Return a function giving the path of a (gunzipped) test data file."""
+    def get(name):
+        source = os.path.join(TEST_DATA, name)
+        if not os.path.isfile(source):
+            source += ".gz"
+        if not os.path.isfile(source):
+            pytest.skip("Test data {} is not available.".format(name))
+        if not source.endswith(".gz"):
+            return source
+        target = os.path.join(str(tmp_path), name)
+        if not os.path.isfile(target):
+            with gzip.open(source, 'rb') as f_in:
+                with open(target, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+        return target
+    return get
@@ -0,0 +1,166 @@
+"""Test DMR/DWI memory mapping and diffusion tensor fitting."""
+
+import os
+import numpy as np
+import pytest
+import bvbabel
+from bvbabel.dmr import _tensor_design, _fit_tensor_chunk
+
+EVALS = np.array([1.7e-3, 0.3e-3, 0.3e-3])  # Prolate tensor along X
+
+
+def gradient_table(nr_b0=2, nr_dirs=30, bvals=(1000,), seed=0):
+    """Gradient directions and b-values, (4, volumes)."""
+    rng = np.random.RandomState(seed)
+    table = [np.zeros((4, nr_b0))]
+    for b in bvals:
+        dirs = rng.normal(size=(3, nr_dirs))
+        dirs /= np.linalg.norm(dirs, axis=0)
+        table.append(np.vstack([dirs, np.full(nr_dirs, float(b))]))
+    return np.hstack(table)
+
+
+def tensor_signal(grads, s0=1000., evals=EVALS):
+    """Noise free signal of a diagonal tensor, (volumes,)."""
+    g, b = grads[:3], grads[3]
+    return s0 * np.exp(-b * np.sum(evals[:, None] * g**2, axis=0))
+
+
+def write_dmr(filename, grads, data_file, prefix="test", storage_format=2):
+    """Minimal DMR text file with its DWI file.
+
+    data_file : 4D numpy.array, (slices, volumes, res_x, res_y), the layout
+        of storage format 2. Other formats are transposed from it.
+    """
+    nr_slices, nr_volumes, res_x, res_y = data_file.shape
+    lines = ["FileVersion:                   3",
+             "NrOfVolumes:                   {}".format(nr_volumes),
+             "NrOfSlices:                    {}".format(nr_slices),
+             'Prefix:                        "{}"'.format(prefix),
+             "DataStorageFormat:             {}".format(storage_format),
+             "DataType:                      2",
+             "ResolutionX:                   {}".format(res_x),
+             "ResolutionY:                   {}".format(res_y),
+             "GradientInformationAvailable:  YES"]
+    lines += ["{:.6f} {:.6f} {:.6f} {:.1f}".format(*v) for v in grads.T]
+    with open(filename, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    dwi = os.path.join(os.path.dirname(filename), prefix + ".dwi")
+    axes = {2: (0, 1, 2, 3), 3: (1, 0, 2, 3), 4: (0, 2, 3, 1)}[storage_format]
+    np.ascontiguousarray(np.transpose(data_file, axes), dtype="<f").tofile(dwi)
+
+
+def fa_reference(evals):
+    """Fractional anisotropy of eigenvalues."""
+    md = np.mean(evals)
+    return np.sqrt(1.5 * np.sum((evals - md)**2) / np.sum(evals**2))
+
+
+# =============================================================================
+@pytest.mark.parametrize("storage_format", [2, 3, 4])
+@pytest.mark.parametrize("rearrange", [True, False])
+def test_open_dmr(tmp_path, storage_format, rearrange):
+    """Memory mapped DWI of any storage format equals read_dmr."""
+    grads = gradient_table(nr_b0=3, nr_dirs=4, bvals=(1000, 2000))
+    data_file = np.random.RandomState(0).rand(5, grads.shape[1], 6, 7)
+    filename = os.path.join(str(tmp_path), "ref.dmr")
+    write_dmr(filename, grads, data_file, prefix="ref")
+    _, reference = bvbabel.dmr.read_dmr(filename,
+                                        rearrange_data_axes=rearrange)
+    if not rearrange:
+        # Unlike read_dmr, open_dmr keeps one axis order for all formats
+        reference = np.transpose(reference, (2, 3, 0, 1))
+
+    filename = os.path.join(str(tmp_path), "test.dmr")
+    write_dmr(filename, grads, data_file, storage_format=storage_format)
+    header, data, shells = bvbabel.dmr.open_dmr(
+        filename, rearrange_data_axes=rearrange)
+    assert isinstance(data.base, np.memmap)
+    assert np.array_equal(data, reference)
+    assert np.array_equal(data[..., shells[1000]],
+                          reference[..., 3:7])
+
+
+def test_open_dmr_modify(tmp_path):
+    """Writes into an r+ memory map are read back at the same voxel."""
+    grads = gradient_table(nr_b0=1, nr_dirs=3)
+    data_file = np.zeros((3, grads.shape[1], 4, 5))
+    filename = os.path.join(str(tmp_path), "test.dmr")
+    write_dmr(filename, grads, data_file, storage_format=4)
+    _, data, _ = bvbabel.dmr.open_dmr(filename, mode="r+")
+    data[1, 2, 0, 3] = 42
+    data.base.flush()
+    del data
+    _, data, _ = bvbabel.dmr.open_dmr(filename)
+    assert data[1, 2, 0, 3] == 42
+    assert np.sum(data) == 42
+
+
+def test_shell_index():
+    """Volumes are grouped by b-value with a tolerance."""
+    bvals = [0, 5, 1000, 2010, 990, 1990, 0, 1020, 2000]
+    header = {"Gradient information": {"Gradients": np.vstack(
+        [np.ones((3, len(bvals))), bvals])}}
+    shells = bvbabel.dmr.shell_index(header)
+    assert list(shells) == [0., 1003, 2000]
+    assert np.array_equal(shells[0.], [0, 1, 6])
+    assert np.array_equal(shells[1003], [2, 4, 7])
+    assert np.array_equal(shells[2000], [3, 5, 8])
+    assert len(bvbabel.dmr.shell_index(header, tolerance=1)) == 8
+    with pytest.raises(ValueError):
+        bvbabel.dmr.shell_index({"Gradient information": {}})
+
+
+def test_fit_tensor_reference(tmp_path):
+    """Known tensor is recovered from noise free data, incl. a bad voxel."""
+    grads = gradient_table()
+    signal = tensor_signal(grads)
+    data_file = np.tile(signal[None, :, None, None], (3, 1, 5, 4))
+    # Extreme voxel inside the mask, its weighted fit is degenerate
+    data_file[1, :, 2, 2] = 0
+    data_file[1, grads[3] == 0, 2, 2] = 3e38
+    filename = os.path.join(str(tmp_path), "test.dmr")
+    write_dmr(filename, grads, data_file)
+
+    mask = np.ones((4, 5, 3), dtype=bool)
+    outname = os.path.join(str(tmp_path), "test_DTI.vmp")
+    header, data = bvbabel.dmr.fit_tensor(filename, outname=outname,
+                                          mask=mask, slab_size=2)
+    assert np.all(np.isfinite(data))
+    good = bvbabel.dmr.open_dmr(filename)[1][..., 0] < 1e37
+    assert np.sum(~good) == 1
+    maps = data[good]
+    assert np.allclose(maps[:, 0], fa_reference(EVALS), atol=1e-5)
+    assert np.allclose(maps[:, 1], np.mean(EVALS), rtol=1e-4)
+    assert np.allclose(maps[:, 2], EVALS[0], rtol=1e-4)
+    assert np.allclose(maps[:, 3], EVALS[1], rtol=1e-4)
+    assert np.allclose(np.abs(maps[:, 4:]), [1, 0, 0], atol=1e-4)
+    assert os.path.isfile(outname)
+
+
+def test_fit_tensor_chunk_singular_voxel():
+    """A singular voxel does not turn the rest of the chunk into OLS fits."""
+    grads = gradient_table()
+    header = {"Gradient information": {"Gradients": grads}}
+    design = _tensor_design(header)
+    pinv = np.linalg.pinv(design)
+    outer = np.reshape(design[:, :, None] * design[:, None, :], (-1, 49))
+
+    rng = np.random.RandomState(1)
+    noise = rng.normal(0, 0.05, (20, grads.shape[1]))
+    signal = tensor_signal(grads) * np.exp(noise)
+    signal[7] = 1e-6
+    signal[7, grads[3] == 0] = 1e300  # Weights of all DW volumes underflow
+    maps = _fit_tensor_chunk(signal, design, pinv, outer)
+
+    # Per voxel weighted least squares reference
+    for i in np.delete(np.arange(20), 7):
+        log_signal = np.log(signal[i])
+        weights = np.exp(design @ (pinv @ log_signal))
+        params = np.linalg.lstsq(design * weights[:, None],
+                                 log_signal * weights, rcond=None)[0]
+        d = params[[1, 4, 5, 4, 2, 6, 5, 6, 3]].reshape(3, 3)
+        evals = np.maximum(np.linalg.eigvalsh(d), 0)[::-1]
+        assert np.isclose(maps[i, 0], fa_reference(evals), rtol=1e-6)
+        assert np.isclose(maps[i, 2], evals[0], rtol=1e-6)
+    assert np.all(np.isfinite(maps[7]))
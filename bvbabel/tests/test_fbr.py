@@ -0,0 +1,345 @@
+"""Test FBR reading, writing, streaming and fiber queries."""
+
+import os
+import numpy as np
+import pytest
+import bvbabel
+
+HEADER = {"FileVersion": 5, "CoordsType": 2, "FibersOriginX": 128.,
+          "FibersOriginY": 128., "FibersOriginZ": 128.}
+
+
+def random_groups(nr_fibers=(7, 0, 12), seed=0, low=2., high=30.):
+    """Groups of random walk fibers in `read_fbr` form, one may be empty."""
+    rng = np.random.RandomState(seed)
+    groups = list()
+    for i, n in enumerate(nr_fibers):
+        fibers = list()
+        for _ in range(n):
+            nr_points = rng.randint(1, 20)
+            xyz = rng.uniform(low + 5, high - 5, 3) + np.cumsum(
+                rng.normal(0, 0.7, (nr_points, 3)), axis=0)
+            xyz = np.clip(xyz, low, high).astype(np.float32)
+            rgb = rng.randint(0, 256, (nr_points, 3))
+            fibers.append({"NrOfPoints": nr_points,
+                           "Xpositions": tuple(xyz[:, 0].tolist()),
+                           "Ypositions": tuple(xyz[:, 1].tolist()),
+                           "Zpositions": tuple(xyz[:, 2].tolist()),
+                           "Rcolour": tuple(rgb[:, 0].tolist()),
+                           "Gcolour": tuple(rgb[:, 1].tolist()),
+                           "Bcolour": tuple(rgb[:, 2].tolist())})
+        groups.append({"Name": "group {}".format(i), "Visible": 1,
+                       "Animate": -1, "Thickness": 0.3, "Color": (25, 25, i),
+                       "NrOfFibers": n, "Fibers": fibers})
+    return groups
+
+
+def write_random_fbr(filename, **kwargs):
+    """Write random groups with `write_fbr`, return them."""
+    groups = random_groups(**kwargs)
+    header = dict(HEADER, NrOfGroups=len(groups))
+    bvbabel.fbr.write_fbr(filename, header, groups)
+    return groups
+
+
+def fiber_points(fiber):
+    """Points (nr points, XYZ) of a `read_fbr` fiber."""
+    return np.stack([fiber["Xpositions"], fiber["Ypositions"],
+                     fiber["Zpositions"]], axis=1)
+
+
+def fiber_colors(fiber):
+    """Colors (nr points, RGB) of a `read_fbr` fiber."""
+    return np.stack([fiber["Rcolour"], fiber["Gcolour"], fiber["Bcolour"]],
+                    axis=1)
+
+
+def read_bytes(filename):
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+# =============================================================================
+@pytest.mark.parametrize("batch_size, buffer_size", [(1, 16), (5, 100),
+                                                     (100000, 2**24)])
+def test_fbr_arrays_roundtrip(tmp_path, batch_size, buffer_size):
+    """Array reading equals `read_fbr`, array writing is byte identical."""
+    filename = os.path.join(str(tmp_path), "in.fbr")
+    write_random_fbr(filename)
+    header1, groups1 = bvbabel.fbr.read_fbr(filename)
+    header2, groups2 = bvbabel.fbr.read_fbr_arrays(
+        filename, batch_size=batch_size, buffer_size=buffer_size)
+    assert header2 == header1
+    for group1, group2 in zip(groups1, groups2):
+        for key in ("Name", "Visible", "Animate", "Thickness", "Color",
+                    "NrOfFibers"):
+            assert group2[key] == group1[key]
+        offsets = group2["Offsets"]
+        assert offsets.size == group1["NrOfFibers"] + 1
+        assert group2["Points"].dtype == np.float32
+        assert group2["Colors"].dtype == np.uint8
+        for i, fiber in enumerate(group1["Fibers"]):
+            a, b = offsets[i], offsets[i + 1]
+            assert np.array_equal(group2["Points"][a:b], fiber_points(fiber))
+            assert np.array_equal(group2["Colors"][a:b], fiber_colors(fiber))
+
+    outname = os.path.join(str(tmp_path), "out.fbr")
+    bvbabel.fbr.write_fbr_arrays(outname, header2, groups2,
+                                 batch_size=batch_size)
+    assert read_bytes(outname) == read_bytes(filename)
+
+
+def test_fbr_arrays_truncated(tmp_path):
+    """A file ending within a fiber is an error, not silently shorter."""
+    filename = os.path.join(str(tmp_path), "in.fbr")
+    write_random_fbr(filename)
+    data = read_bytes(filename)
+    with open(filename, "wb") as f:
+        f.write(data[:-10])
+    with pytest.raises(ValueError):
+        bvbabel.fbr.read_fbr_arrays(filename)
+
+
+# =============================================================================
+@pytest.mark.parametrize("batch_size, buffer_size", [(1, 16), (4, 100),
+                                                     (10000, 2**24)])
+def test_iter_fbr_writer_roundtrip(tmp_path, batch_size, buffer_size):
+    """Streamed batches equal the arrays, rewriting is byte identical."""
+    filename = os.path.join(str(tmp_path), "in.fbr")
+    write_random_fbr(filename, nr_fibers=(7, 0, 12, 0))
+    header, groups = bvbabel.fbr.read_fbr_arrays(filename)
+    assert bvbabel.fbr.read_fbr_header(filename) == header
+
+    outname = os.path.join(str(tmp_path), "out.fbr")
+    batches = {i: [] for i in range(len(groups))}
+    with bvbabel.fbr.FBRWriter(outname, header) as writer:
+        for group, points, colors, offsets in bvbabel.fbr.iter_fbr(
+                filename, batch_size=batch_size, buffer_size=buffer_size):
+            if group is not writer.group_source:
+                writer.start_group(group)
+            assert offsets.size - 1 <= batch_size
+            batches[writer.nr_groups - 1].append((points, colors, offsets))
+            writer.write_fibers(points, colors, offsets)
+    assert read_bytes(outname) == read_bytes(filename)
+
+    # Empty groups come as one empty batch
+    for i, group in enumerate(groups):
+        points = np.concatenate([b[0] for b in batches[i]])
+        colors = np.concatenate([b[1] for b in batches[i]])
+        counts = np.concatenate([np.diff(b[2]) for b in batches[i]])
+        assert np.array_equal(points, group["Points"])
+        assert np.array_equal(colors, group["Colors"])
+        assert np.array_equal(counts, np.diff(group["Offsets"]))
+
+
+def test_fbr_writer_fiber_subset(tmp_path):
+    """Counts are patched for fibers written from offsets not starting at 0."""
+    filename = os.path.join(str(tmp_path), "in.fbr")
+    write_random_fbr(filename, nr_fibers=(9,))
+    header, groups = bvbabel.fbr.read_fbr_arrays(filename)
+    group = groups[0]
+
+    outname = os.path.join(str(tmp_path), "out.fbr")
+    with bvbabel.fbr.FBRWriter(outname, header) as writer:
+        with pytest.raises(ValueError):
+            writer.write_fibers(group["Points"], group["Colors"],
+                                group["Offsets"])
+        writer.start_group(group)
+        writer.write_fibers(group["Points"], group["Colors"],
+                            group["Offsets"][3:7])
+    _, groups_out = bvbabel.fbr.read_fbr_arrays(outname)
+    assert groups_out[0]["NrOfFibers"] == 3
+    a, b = group["Offsets"][3], group["Offsets"][6]
+    assert np.array_equal(groups_out[0]["Points"], group["Points"][a:b])
+    assert np.array_equal(groups_out[0]["Offsets"], group["Offsets"][3:7] - a)
+
+
+# =============================================================================
+def fiber_voxels_reference(points, dims, step):
+    """Voxels (x, y, z) a fiber passes through, one segment at a time."""
+    voxels = set()
+    for i in range(points.shape[0]):
+        if i + 1 < points.shape[0]:
+            delta = points[i + 1].astype(float) - points[i]
+            n = max(int(np.ceil(np.max(np.abs(delta)) / step)), 1)
+        else:
+            delta, n = np.zeros(3), 1
+        for k in range(n):
+            xyz = np.floor(points[i] + k / n * delta + 0.5).astype(int)
+            if np.all((xyz >= 0) & (xyz < dims)):
+                voxels.add(tuple(xyz))
+    return voxels
+
+
+def all_fibers(groups):
+    """Points of every fiber of `read_fbr_arrays` groups in file order."""
+    return [g["Points"][g["Offsets"][i]:g["Offsets"][i + 1]]
+            for g in groups for i in range(g["NrOfFibers"])]
+
+
+def test_fiber_index_reference(tmp_path):
+    """Indexed voxels and region queries against a per fiber loop."""
+    dims, step = np.array([32, 28, 30]), 0.5
+    filename = os.path.join(str(tmp_path), "in.fbr")
+    write_random_fbr(filename, nr_fibers=(15, 0, 20))
+    _, groups = bvbabel.fbr.read_fbr_arrays(filename)
+    fibers = all_fibers(groups)
+    reference = [fiber_voxels_reference(p, dims, step) for p in fibers]
+
+    index = bvbabel.fbr.build_fiber_index(filename, dims=dims, step=step,
+                                          batch_size=4)
+    assert np.array_equal(index["groups"], [0, 15, 15, 35])
+    assert np.all(np.diff(index["voxels"]) > 0)
+    for i, voxel in enumerate(index["voxels"]):
+        xyz = (voxel % dims[0], voxel // dims[0] % dims[1],
+               voxel // (dims[0] * dims[1]))
+        entries = index["fibers"][index["indptr"][i]:index["indptr"][i + 1]]
+        expected = [f for f, r in enumerate(reference) if xyz in r]
+        assert np.array_equal(np.sort(entries), expected)
+    assert index["fibers"].size == sum(len(r) for r in reference)
+
+    # Boxes as coordinate arrays and as VOIs
+    rng = np.random.RandomState(1)
+    regions, boxes = list(), list()
+    for _ in range(6):
+        low = rng.randint(0, 24, 3)
+        box = np.indices((6, 6, 6)).reshape(3, -1).T + low
+        boxes.append(set(map(tuple, box)))
+        regions.append(box)
+    regions[1] = {"Coordinates": regions[1].tolist()}
+    regions.append(np.array([[-1, 0, 0], [40, 5, 5]]))  # Outside the grid
+    boxes.append(set())
+    hits = bvbabel.fbr.query_fibers(index, regions)
+    expected = np.array([[len(r & box) > 0 for r in reference]
+                         for box in boxes])
+    assert np.array_equal(hits, expected)
+
+    # Virtual dissection
+    selection = bvbabel.fbr.select_fibers(index, include=regions[:2],
+                                          exclude=regions[2:3])
+    keep = expected[0] & expected[1] & ~expected[2]
+    assert np.array_equal(selection, np.flatnonzero(keep))
+    selection = bvbabel.fbr.select_fibers(index, include=regions[:2],
+                                          mode="any")
+    assert np.array_equal(selection, np.flatnonzero(expected[0] | expected[1]))
+    selection = bvbabel.fbr.select_fibers(index, exclude=regions[3:4])
+    assert np.array_equal(selection, np.flatnonzero(~expected[3]))
+    with pytest.raises(ValueError):
+        bvbabel.fbr.select_fibers(index, mode="some")
+
+
+def test_fiber_index_sys_and_mask(tmp_path):
+    """SYS coordinates index like BVI, mask labels are regions."""
+    dims = (32, 32, 32)
+    filename = os.path.join(str(tmp_path), "bvi.fbr")
+    groups = write_random_fbr(filename, nr_fibers=(10,))
+    for fiber in groups[0]["Fibers"]:
+        for key in ("Xpositions", "Ypositions", "Zpositions"):
+            fiber[key] = tuple(v - 128 for v in fiber[key])
+    filename_sys = os.path.join(str(tmp_path), "sys.fbr")
+    bvbabel.fbr.write_fbr(filename_sys, dict(HEADER, CoordsType=1,
+                                             NrOfGroups=1), groups)
+    index = bvbabel.fbr.build_fiber_index(filename, dims=dims)
+    index_sys = bvbabel.fbr.build_fiber_index(filename_sys, dims=dims)
+    for key in index:
+        assert np.array_equal(index_sys[key], index[key])
+
+    # Label image in `read_msk` axes from VOI axes (x, y, z)
+    labels = np.zeros((32, 32, 32), dtype=np.uint8)
+    labels[5:15, 5:20, 5:20] = 1
+    labels[15:30, 10:20, 5:25] = 2
+    regions = bvbabel.fbr.regions_from_mask(
+        {}, labels.transpose(2, 0, 1)[::-1, ::-1, ::-1])
+    hits = bvbabel.fbr.query_fibers(index, regions)
+    boxes = [np.argwhere(labels == 1), np.argwhere(labels == 2)]
+    assert np.array_equal(hits, bvbabel.fbr.query_fibers(index, boxes))
+
+
+def test_fiber_index_cache(tmp_path):
+    """The cached index is reused, and rebuilt when the inputs change."""
+    filename = os.path.join(str(tmp_path), "in.fbr")
+    write_random_fbr(filename)
+    cachename = os.path.join(str(tmp_path), "in_bvbabel-fiberindex.npz")
+    index1 = bvbabel.fbr.fiber_index(filename, dims=(32, 32, 32))
+    assert os.path.isfile(cachename)
+    index2 = bvbabel.fbr.fiber_index(filename, dims=(32, 32, 32))
+    assert sorted(index2) == sorted(index1)
+    for key in index1:
+        assert np.array_equal(index2[key], index1[key])
+
+    # Another grid or another file
+    index3 = bvbabel.fbr.fiber_index(filename, dims=(16, 16, 16))
+    assert np.array_equal(index3["dims"], [16, 16, 16])
+    write_random_fbr(filename, seed=3)
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    index4 = bvbabel.fbr.fiber_index(filename, dims=(16, 16, 16))
+    reference = bvbabel.fbr.build_fiber_index(filename, dims=(16, 16, 16))
+    for key in reference:
+        assert np.array_equal(index4[key], reference[key])
+
+
+# =============================================================================
+def density_reference(fibers, mode, dims, start, res, step=0.5):
+    """Count volume (x, y, z) of fibers on a grid, one fiber at a time."""
+    counts = np.zeros(dims, dtype=np.int64)
+    for points in fibers:
+        # VMR voxel coordinates to continuous grid voxel coordinates
+        points = (points.astype(float) + 0.5 - start) / res - 0.5
+        if mode == "segments":
+            voxels = fiber_voxels_reference(points, np.array(dims),
+                                            step / res)
+        else:
+            if mode == "endpoints":
+                points = points[[0, -1]]
+            voxels = [tuple(v) for v in np.floor(points + 0.5).astype(int)
+                      if np.all((v >= 0) & (v < dims))]
+        for xyz in voxels:
+            counts[xyz] += 1
+    return counts
+
+
+@pytest.mark.parametrize("mode", ["segments", "points", "endpoints"])
+@pytest.mark.parametrize("res", [1, 2])
+def test_density_map_reference(tmp_path, mode, res):
+    """Density counts against a per fiber loop, with a fiber selection."""
+    filename = os.path.join(str(tmp_path), "in.fbr")
+    write_random_fbr(filename, nr_fibers=(15, 0, 20))
+    _, groups = bvbabel.fbr.read_fbr_arrays(filename)
+    fibers = all_fibers(groups)
+    header_target = {"VTC resolution relative to VMR (1, 2, or 3)": res,
+                     "XStart": 4, "XEnd": 32, "YStart": 2, "YEnd": 30,
+                     "ZStart": 0, "ZEnd": 24}
+    dims = (28 // res, 28 // res, 24 // res)
+    start = np.array([4, 2, 0])
+
+    outname = os.path.join(str(tmp_path), "density.vmp")
+    header, data = bvbabel.fbr.density_map(
+        filename, outname, header_target=header_target, mode=mode,
+        batch_size=4, nr_threads=3)
+    # `read_vmp` axes to (x, y, z)
+    counts = data[::-1, ::-1, ::-1].transpose(1, 2, 0)
+    reference = density_reference(fibers, mode, dims, start, res)
+    assert np.sum(reference) > 0
+    assert np.array_equal(counts, reference)
+    assert header["Resolution"] == res
+    assert (header["XStart"], header["XEnd"]) == (4, 32)
+    assert header["Map"][0]["NrOfUsedVoxels"] == np.sum(reference > 0)
+    assert np.array_equal(bvbabel.vmp.read_vmp(outname)[1], data)
+
+    selection = np.array([0, 3, 17, 34])
+    _, data = bvbabel.fbr.density_map(
+        filename, False, header_target=header_target, mode=mode,
+        fibers=selection, batch_size=4, nr_threads=1)
+    counts = data[::-1, ::-1, ::-1].transpose(1, 2, 0)
+    reference = density_reference([fibers[i] for i in selection], mode, dims,
+                                  start, res)
+    assert np.array_equal(counts, reference)
+
+
+def test_density_map_unknown_mode(tmp_path):
+    """Unknown density modes are rejected."""
+    filename = os.path.join(str(tmp_path), "in.fbr")
+    write_random_fbr(filename)
+    with pytest.raises(ValueError):
+        bvbabel.fbr.density_map(filename, False, mode="voxels")
@@ -0,0 +1,135 @@
+"""Test FMR/STC access, slice timing and motion correction."""
+
+import os
+import numpy as np
+import pytest
+import bvbabel
+
+
+def write_run(dirname, data, **kwargs):
+    """Write an FMR/STC pair with a default header, return its path.
+
+    data : 4D numpy.array, (x, y, slices, time), as in `read_fmr`.
+    """
+    header, _ = bvbabel.fmr.create_fmr()
+    header["Prefix"] = "run"
+    header["ResolutionY"], header["ResolutionX"] = data.shape[:2]
+    header["NrOfSlices"], header["NrOfVolumes"] = data.shape[2:]
+    header["DataType"] = 2
+    header.update(kwargs)
+    filename = os.path.join(dirname, "run.fmr")
+    bvbabel.fmr.write_fmr(filename, header, data)
+    return filename
+
+
+# =============================================================================
+def test_open_fmr(tmp_path):
+    """Memory mapped FMR equals read_fmr."""
+    data = np.random.RandomState(0).rand(6, 6, 4, 20).astype(np.float32)
+    filename = write_run(str(tmp_path), data)
+    _, data1 = bvbabel.fmr.read_fmr(filename)
+    _, data2 = bvbabel.fmr.open_fmr(filename)
+    assert np.array_equal(data1, data)
+    assert np.array_equal(data2, data)
+
+
+def test_slice_timings():
+    """Timings from acquisition orders and from a multiband table."""
+    header = {"NrOfSlices": 4, "InterSliceTime": "500"}
+    expected = {0: [0, 500, 1000, 1500], 1: [0, 1000, 500, 1500],
+                2: [1000, 0, 1500, 500], 10: [1500, 1000, 500, 0],
+                11: [1500, 500, 1000, 0]}
+    for order, timings in expected.items():
+        header["SliceAcquisitionOrder"] = str(order)
+        assert np.array_equal(bvbabel.fmr.slice_timings(header), timings)
+
+    header["Multiband information"] = {"Slice timings": [0, 0, 800, 800]}
+    assert np.array_equal(bvbabel.fmr.slice_timings(header), [0, 0, 800, 800])
+    header["Multiband information"] = {"Slice timings": [0, 800]}
+    with pytest.raises(ValueError):
+        bvbabel.fmr.slice_timings(header)
+
+
+@pytest.mark.parametrize("method, tolerance", [("fft", 0.1),
+                                               ("cubic", 0.2)])
+def test_slice_time_correct(tmp_path, method, tolerance):
+    """Slices sampled at their acquisition times are shifted to time zero."""
+    tr, nr_volumes = 2000., 60
+    timings = np.array([0., 1000., 500., 1500.])  # Ascending interleaved
+
+    def signal(t):
+        return 100 + 10 * np.sin(2 * np.pi * t / 40000.)
+
+    t = np.arange(nr_volumes) * tr
+    data = np.zeros((5, 5, 4, nr_volumes), dtype=np.float32)
+    for s in range(4):
+        data[:, :, s] = signal(t + timings[s])
+    filename = write_run(str(tmp_path), data, TR=int(tr), InterSliceTime=500,
+                         SliceAcquisitionOrder=1)
+
+    outname = os.path.join(str(tmp_path), "run_SCCTBL.fmr")
+    bvbabel.fmr.slice_time_correct(filename, outname, method=method)
+    _, data_out = bvbabel.fmr.read_fmr(outname)
+    inner = slice(5, nr_volumes - 5)  # Edges are extrapolated
+    for s in range(4):
+        assert np.allclose(data_out[2, 2, s, inner], signal(t[inner]),
+                           atol=tolerance)
+
+
+# =============================================================================
+def blobs(points):
+    """Smooth asymmetric test image at (points, XYZ) millimeter positions."""
+    centers = np.array([[-12., -8., -4.], [10., -6., 6.], [2., 12., -2.]])
+    widths = np.array([6., 8., 5.])
+    values = np.zeros(points.shape[0])
+    for c, w in zip(centers, widths):
+        values += 100 * np.exp(-np.sum((points - c)**2, axis=1) / (2 * w**2))
+    return values
+
+
+def test_rigid_params_inverse():
+    """Matrix to parameters round trip."""
+    params = np.array([1.5, -2., 0.5, 0.05, -0.03, 0.02])
+    matrix = bvbabel.fmr._rigid_matrix(params)
+    assert np.allclose(bvbabel.fmr._rigid_params(matrix), params)
+
+
+@pytest.mark.parametrize("nr_processes", [1, 2])
+def test_motion_correct(tmp_path, nr_processes):
+    """Known rigid motions are recovered and corrected."""
+    shape, voxel_size = np.array([32, 32, 20]), np.array([2., 2., 2.])
+    points = bvbabel.fmr._grid_points(shape, -(shape - 1) / 2 * voxel_size,
+                                      voxel_size)
+    motions = np.array([[0, 0, 0, 0, 0, 0],
+                        [1.5, 0, 0, 0, 0, 0],
+                        [0, -1, 0.5, 0, 0, np.deg2rad(2)],
+                        [0.5, 0.5, -1, np.deg2rad(-1.5), np.deg2rad(1), 0]])
+    raw = np.zeros((len(motions), shape[2], shape[1], shape[0]))
+    for t, params in enumerate(motions):
+        # The moving volume at M p shows the reference at p
+        inverse = np.linalg.inv(bvbabel.fmr._rigid_matrix(params))
+        moved = points @ inverse[:3, :3].T + inverse[:3, 3]
+        raw[t] = np.transpose(blobs(moved).reshape(shape), (2, 1, 0))
+    data = np.transpose(raw, (2, 3, 1, 0))[:, ::-1]  # As in read_fmr
+    filename = write_run(str(tmp_path), data.astype(np.float32),
+                         InplaneResolutionX=2, InplaneResolutionY=2,
+                         SliceThickness=2, SliceGap=0)
+
+    outname = os.path.join(str(tmp_path), "run_3DMC.fmr")
+    header, params = bvbabel.fmr.motion_correct(
+        filename, outname, nr_processes=nr_processes)
+    expected = np.copy(motions)
+    expected[:, 3:] = np.rad2deg(expected[:, 3:])
+    assert np.allclose(params[:, :3], expected[:, :3], atol=0.05)
+    assert np.allclose(params[:, 3:], expected[:, 3:], atol=0.1)
+    assert os.path.isfile(os.path.join(str(tmp_path), "run_3DMC.sdm"))
+
+    _, data_out = bvbabel.fmr.read_fmr(outname)
+    inner = (slice(6, -6), slice(6, -6), slice(4, -4))
+    assert np.allclose(data_out[..., 0], data[..., 0], atol=1e-3)
+    for t in range(1, len(motions)):
+        error = np.abs(data_out[inner + (t,)] - data[inner + (0,)])
+        before = np.abs(data[inner + (t,)] - data[inner + (0,)])
+        # Only trilinear interpolation errors at the peaks remain
+        assert np.mean(error) < 0.15 * np.mean(before)
+        assert np.max(error) < 0.3 * np.max(before)
@@ -0,0 +1,81 @@
+"""Test GTC reading, writing and depth profiles."""
+
+import os
+import numpy as np
+import pytest
+import bvbabel
+
+
+def random_gtc(dims=(5, 4, 3, 8), seed=0):
+    """GTC header and int32 data, (x, y, depth, time)."""
+    header = {"File version": 1, "DimX": dims[0], "DimY": dims[1],
+              "DimD": dims[2], "DimT": dims[3]}
+    data = np.random.RandomState(seed).randint(-1000, 1000, dims)
+    return header, data.astype(np.int32)
+
+
+# =============================================================================
+def test_gtc_roundtrip(tmp_path):
+    """GTC write, read, memory mapped and allocated access."""
+    header, data = random_gtc()
+    filename = os.path.join(str(tmp_path), "test.gtc")
+    bvbabel.gtc.write_gtc(filename, header, data)
+    assert os.path.getsize(filename) == 20 + data.size * 4
+
+    header1, data1 = bvbabel.gtc.read_gtc(filename)
+    assert header1 == header
+    assert np.array_equal(data1, data)
+    header2, data2 = bvbabel.gtc.open_gtc(filename)
+    assert header2 == header
+    assert isinstance(data2.base, np.memmap)
+    assert np.array_equal(data2, data)
+    _, data3 = bvbabel.gtc.open_gtc(filename, rearrange_data_axes=False)
+    assert np.array_equal(data3, np.transpose(data, (2, 1, 0, 3)))
+
+    outname = os.path.join(str(tmp_path), "allocated.gtc")
+    data4 = bvbabel.gtc.allocate_gtc(outname, header)
+    assert np.all(data4 == 0)
+    data4[:, :, 1] = data[:, :, 1]
+    data4.base.flush()
+    del data4
+    reference = np.zeros_like(data)
+    reference[:, :, 1] = data[:, :, 1]
+    assert np.array_equal(bvbabel.gtc.read_gtc(outname)[1], reference)
+
+
+# =============================================================================
+def test_depth_time_courses_reference(tmp_path):
+    """Mean over masked grid points, within a time window."""
+    header, data = random_gtc()
+    filename = os.path.join(str(tmp_path), "test.gtc")
+    bvbabel.gtc.write_gtc(filename, header, data)
+
+    courses = bvbabel.gtc.depth_time_courses(filename)
+    assert courses.shape == (3, 8)
+    assert np.allclose(courses, np.mean(data, axis=(0, 1)))
+
+    mask = np.zeros((5, 4), dtype=bool)
+    mask[1:4, 2] = True
+    mask[0, 0] = True
+    courses = bvbabel.gtc.depth_time_courses(filename, mask=mask,
+                                             window=(2, 6))
+    assert np.allclose(courses, np.mean(data[mask][..., 2:6], axis=0))
+    with pytest.raises(ValueError):
+        bvbabel.gtc.depth_time_courses(filename, mask=mask.T)
+
+
+def test_depth_profile_reference(tmp_path):
+    """One mean profile per run."""
+    filenames = list()
+    reference = list()
+    for run in range(3):
+        header, data = random_gtc(seed=run)
+        filenames.append(os.path.join(str(tmp_path), "run{}.gtc".format(run)))
+        bvbabel.gtc.write_gtc(filenames[-1], header, data)
+        reference.append(np.mean(data[:, 1:, :, :5], axis=(0, 1, 3)))
+    mask = np.ones((5, 4), dtype=bool)
+    mask[:, 0] = False
+    profiles = bvbabel.gtc.depth_profile(filenames, mask=mask, window=(0, 5),
+                                         nr_threads=2)
+    assert profiles.shape == (3, 3)
+    assert np.allclose(profiles, reference)
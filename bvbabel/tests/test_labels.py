@@ -0,0 +1,101 @@
+"""Test label statistics and label image to VOI conversion."""
+
+import os
+import numpy as np
+import bvbabel
+
+
+def to_read_axes(raw):
+    """File order (Z, Y, X) to the axes of `read_vmr`/`read_msk`."""
+    return raw.transpose(0, 2, 1)[::-1, ::-1, ::-1]
+
+
+def sorted_rows(xyz):
+    """Coordinates in a canonical row order."""
+    xyz = np.asarray(xyz)
+    return xyz[np.lexsort(xyz.T[::-1])]
+
+
+# =============================================================================
+def test_label_statistics_reference():
+    """Counts, centroids and bounding boxes against a per label loop."""
+    raw = np.random.RandomState(0).randint(0, 6, (9, 11, 13)).astype(np.uint8)
+    raw[raw == 3] = 0  # A missing label
+    stats = bvbabel.labels.label_statistics({}, to_read_axes(raw))
+    assert np.array_equal(stats["labels"], [1, 2, 4, 5])
+    for i, label in enumerate(stats["labels"]):
+        z, y, x = np.nonzero(raw == label)
+        xyz = np.stack([x, y, z], axis=1)
+        assert stats["nr voxels"][i] == xyz.shape[0]
+        assert np.allclose(stats["centroids"][i], xyz.mean(axis=0))
+        assert np.array_equal(stats["bbox min"][i], xyz.min(axis=0))
+        assert np.array_equal(stats["bbox max"][i], xyz.max(axis=0))
+        assert np.array_equal(sorted_rows(stats["coordinates"][i]),
+                              sorted_rows(xyz))
+
+
+def test_label_statistics_msk():
+    """MSK grid voxels count as res^3 VMR voxels from the grid start."""
+    raw = np.zeros((4, 5, 6), dtype=np.uint8)
+    raw[1, 2, 3] = 1
+    header = {"XStart": 10, "YStart": 20, "ZStart": 30,
+              "VTC resolution relative to VMR (1, 2, or 3)": 3}
+    stats = bvbabel.labels.label_statistics(header, to_read_axes(raw))
+    assert stats["nr voxels"][0] == 27
+    assert np.array_equal(stats["bbox min"][0], [19, 26, 33])
+    assert np.array_equal(stats["bbox max"][0], [21, 28, 35])
+    assert np.allclose(stats["centroids"][0], [20, 27, 34])
+    assert np.array_equal(sorted_rows(stats["coordinates"][0]),
+                          sorted_rows(np.indices((3, 3, 3)).reshape(3, -1).T
+                                      + [19, 26, 33]))
+
+
+def test_labels_to_voi_synthetic():
+    """Names, counts and coordinates of a hand-built label image."""
+    raw = np.zeros((3, 4, 5), dtype=np.uint8)  # (Z, Y, X)
+    raw[0, 1, 2] = 7
+    raw[2, 3, 4] = 7
+    raw[1, 0, 0] = 2
+    raw[1, 2, 3] = 2
+    raw[2, 2, 1] = 2
+    header = {"VoxelSizeX": 1, "FramingCubeDim": 256}
+    header_voi, data_voi = bvbabel.labels.labels_to_voi(
+        header, to_read_axes(raw), names={7: "seven"})
+    assert header_voi["NrOfVOIs"] == 2
+    assert [v["NameOfVOI"] for v in data_voi] == ["Label 2", "seven"]
+    assert [v["NrOfVoxels"] for v in data_voi] == [3, 2]
+    assert np.array_equal(sorted_rows(data_voi[0]["Coordinates"]),
+                          [[0, 0, 1], [1, 2, 2], [3, 2, 1]])
+    assert np.array_equal(sorted_rows(data_voi[1]["Coordinates"]),
+                          [[2, 1, 0], [4, 3, 2]])
+
+    # Colors depend only on the label value
+    _, data_voi2 = bvbabel.labels.labels_to_voi(
+        header, to_read_axes(raw), colors={2: (1, 2, 3)})
+    assert data_voi2[0]["ColorOfVOI"] == [1, 2, 3]
+    assert data_voi2[1]["ColorOfVOI"] == data_voi[1]["ColorOfVOI"]
+    assert data_voi[1]["ColorOfVOI"] == list(bvbabel.utils.label_color(7))
+
+
+def test_labels_voi_roundtrip(test_data, tmp_path):
+    """VOIs rasterized into a label image convert back to the same VOIs."""
+    header_vmr, data_vmr = bvbabel.vmr.read_vmr(test_data("sub-test03.vmr"))
+    header_voi, data_voi = bvbabel.voi.read_voi(test_data("sub-test03.voi"))
+    raw = np.zeros(data_vmr.shape, dtype=np.uint8).transpose(0, 2, 1)
+    for i, voi in enumerate(data_voi):
+        x, y, z = np.asarray(voi["Coordinates"]).T
+        raw[z, y, x] = i + 1
+
+    outname = os.path.join(str(tmp_path), "labels.voi")
+    names = {i + 1: v["NameOfVOI"] for i, v in enumerate(data_voi)}
+    bvbabel.labels.write_labels_voi(outname, header_vmr, to_read_axes(raw),
+                                    names=names)
+    header_out, data_out = bvbabel.voi.read_voi(outname)
+    assert header_out["NrOfVOIs"] == header_voi["NrOfVOIs"]
+    assert header_out["OriginalVMRFramingCubeDim"] == \
+        header_voi["OriginalVMRFramingCubeDim"]
+    for voi, voi_out in zip(data_voi, data_out):
+        assert voi_out["NameOfVOI"] == voi["NameOfVOI"]
+        assert voi_out["NrOfVoxels"] == voi["NrOfVoxels"]
+        assert np.array_equal(sorted_rows(voi_out["Coordinates"]),
+                              sorted_rows(voi["Coordinates"]))
@@ -0,0 +1,105 @@
+"""Test MAP reading, writing and memory mapped access."""
+
+import os
+import struct
+import numpy as np
+import pytest
+import bvbabel
+
+HEADER = {"MapType": "t-values", "NrOfSlices": 3, "NrOfMaps": 3, "DimY": 5,
+          "DimX": 4, "ClusterSize": 4, "Min": 2.5, "Max": 8.0,
+          "FileVersion": 3, "df1": 120, "df2": 1, "RTCName": "test.rtc"}
+
+
+def map_bytes(header, raw):
+    """MAP file written field by field, raw is (slices, DimY, DimX)."""
+    parts = [struct.pack('<5h2f', header["NrOfSlices"], raw.shape[0],
+                         raw.shape[1], raw.shape[2], header["ClusterSize"],
+                         header["Min"], header["Max"])]
+    if header["MapType"] == "crosscorrelation":
+        parts.append(struct.pack('<h', header["NrOfLags"]))
+    parts.append(struct.pack('<2h', 9999, header["FileVersion"]))
+    if header["FileVersion"] >= 3:
+        parts.append(struct.pack('<2i', header["df1"], header["df2"]))
+    parts.append(header["RTCName"].encode() + b'\x00')
+    for s in range(raw.shape[0]):
+        parts.append(struct.pack('<h', s) + raw[s].astype('<f').tobytes())
+    return b''.join(parts)
+
+
+def raw_data(shape=(3, 5, 4), seed=0):
+    """Random map values in file order (slices, DimY, DimX)."""
+    return np.random.RandomState(seed).normal(0, 3, shape).astype(np.float32)
+
+
+# =============================================================================
+@pytest.mark.parametrize("changes", [
+    {},
+    {"MapType": "crosscorrelation", "NrOfLags": 7},
+    {"FileVersion": 2, "RTCName": ""}])
+def test_map_roundtrip(tmp_path, changes):
+    """Reading the field layout, writing it back byte by byte."""
+    header = dict(HEADER, **changes)
+    if header["FileVersion"] < 3:
+        del header["df1"], header["df2"]
+    raw = raw_data()
+    filename = os.path.join(str(tmp_path), "in.map")
+    with open(filename, 'wb') as f:
+        f.write(map_bytes(header, raw))
+
+    header1, data1 = bvbabel.map.read_map(filename)
+    assert header1 == header
+    assert data1.shape == (4, 5, 3)  # (DimX, DimY, NrOfMaps)
+    assert np.array_equal(data1, np.transpose(raw, (2, 1, 0))[::-1, ::-1])
+    header2, data2 = bvbabel.map.open_map(filename)
+    assert header2 == header
+    assert isinstance(data2.base, np.memmap)
+    assert np.array_equal(data2, data1)
+
+    outname = os.path.join(str(tmp_path), "out.map")
+    bvbabel.map.write_map(outname, header1, data1)
+    with open(filename, 'rb') as f1, open(outname, 'rb') as f2:
+        assert f1.read() == f2.read()
+
+
+def test_map_dimensions_from_data(tmp_path):
+    """Written dimensions follow the data, not the header."""
+    data = raw_data((6, 7, 2))
+    filename = os.path.join(str(tmp_path), "test.map")
+    bvbabel.map.write_map(filename, HEADER, data)
+    header, data_out = bvbabel.map.read_map(filename)
+    assert (header["DimX"], header["DimY"], header["NrOfMaps"]) == (6, 7, 2)
+    assert np.array_equal(data_out, data)
+
+
+def test_open_map_modify(tmp_path):
+    """Writes into an r+ memory map keep the slice indices intact."""
+    filename = os.path.join(str(tmp_path), "test.map")
+    data = raw_data((4, 5, 3))
+    bvbabel.map.write_map(filename, HEADER, data)
+    _, data_mmap = bvbabel.map.open_map(filename, mode="r+")
+    data_mmap[1, 2, 2] = 42
+    data_mmap.base.flush()
+    del data_mmap
+    data[1, 2, 2] = 42
+    assert np.array_equal(bvbabel.map.read_map(filename)[1], data)
+    with open(filename, 'rb') as f:
+        assert f.read() == map_bytes(HEADER, np.transpose(
+            data[::-1, ::-1], (2, 1, 0)))
+
+
+def test_read_map_errors(tmp_path):
+    """Truncated data and an unexpected reserved field are errors."""
+    raw = raw_data()
+    filename = os.path.join(str(tmp_path), "test.map")
+    with open(filename, 'wb') as f:
+        f.write(map_bytes(HEADER, raw)[:-6])
+    with pytest.raises(ValueError):
+        bvbabel.map.read_map(filename)
+
+    header = dict(HEADER, MapType="crosscorrelation", NrOfLags=7)
+    data = map_bytes(header, raw)
+    with open(filename, 'wb') as f:
+        f.write(data[:20] + struct.pack('<h', 1234) + data[22:])
+    with pytest.raises(ValueError):
+        bvbabel.map.read_map(filename)
@@ -0,0 +1,154 @@
+"""Test MTC reading, writing, surface smoothing and VTC sampling."""
+
+import os
+import numpy as np
+import pytest
+import bvbabel
+
+RES = "VTC resolution relative to VMR (1, 2, or 3)"
+
+
+def smoothing_matrix(mesh, method="neighbor", sigma=None):
+    """Dense row normalized smoothing weights, including the vertex itself."""
+    n = mesh.nr_vertices
+    dist = np.linalg.norm(mesh.vertices[:, None] - mesh.vertices[None],
+                          axis=2)
+    indptr, indices = mesh.adjacency
+    adj = np.zeros((n, n), dtype=bool)
+    adj[np.repeat(np.arange(n), np.diff(indptr)), indices] = True
+    if method == "neighbor":
+        weights = adj.astype(float)
+    else:
+        weights = np.where(adj, np.exp(-dist**2 / (2 * sigma**2)), 0)
+    weights += np.eye(n)
+    return weights / weights.sum(axis=1, keepdims=True)
+
+
+# =============================================================================
+def test_mtc_roundtrip(test_data, tmp_path):
+    """MTC read, write and memory mapped access."""
+    header1, data1 = bvbabel.mtc.read_mtc(test_data("sub-test03_cube.mtc"))
+    outname = os.path.join(str(tmp_path), "out.mtc")
+    bvbabel.mtc.write_mtc(outname, header1, data1)
+    header2, data2 = bvbabel.mtc.read_mtc(outname)
+    assert header1 == header2
+    assert np.array_equal(data1, data2)
+    header3, data3 = bvbabel.mtc.open_mtc(outname)
+    assert header1 == header3
+    assert np.array_equal(data1, data3)
+
+
+@pytest.mark.parametrize("method, sigma", [("neighbor", None), ("heat", 1.5)])
+def test_smooth_reference(test_data, method, sigma):
+    """Iterated smoothing equals powers of the dense weight matrix."""
+    mesh_data = bvbabel.srf.read_srf(test_data("sub-test03_cube.srf"))[1]
+    mesh = bvbabel.srf.Mesh(mesh_data)
+    values = np.random.RandomState(0).normal(
+        size=(mesh.nr_vertices, 3)).astype(np.float32)
+    weights = smoothing_matrix(mesh, method, sigma)
+    reference = np.linalg.matrix_power(weights, 3) @ values
+
+    data_smp = bvbabel.smp.smooth(values, mesh_data, 3, method, sigma)
+    assert data_smp.dtype == np.float32
+    assert np.allclose(data_smp, reference, atol=1e-5)
+    chunked = bvbabel.mtc.smooth(values, mesh, 3, method, sigma,
+                                 chunk_size=100)
+    assert np.allclose(chunked, reference, atol=1e-5)
+    # Smoothing keeps constants
+    assert np.allclose(mesh.smooth(np.ones(mesh.nr_vertices), 5, method,
+                                   sigma), 1)
+
+
+def test_smooth_mtc_in_place(test_data, tmp_path):
+    """Chunked smoothing from one memory map into another."""
+    filename = test_data("sub-test03_cube.mtc")
+    srf = test_data("sub-test03_cube.srf")
+    mesh = bvbabel.srf.Mesh(bvbabel.srf.read_srf(srf)[1])
+    header, data_mtc = bvbabel.mtc.open_mtc(filename)
+    outname = os.path.join(str(tmp_path), "smooth.mtc")
+    bvbabel.mtc.write_mtc(outname, header, np.zeros(data_mtc.shape))
+    out = bvbabel.mtc.open_mtc(outname, mode="r+")[1]
+    bvbabel.mtc.smooth(data_mtc, mesh, 2, chunk_size=50, out=out)
+    out.flush()
+    del out
+    reference = mesh.smooth(np.asarray(data_mtc), 2)
+    assert np.allclose(bvbabel.mtc.read_mtc(outname)[1], reference,
+                       rtol=1e-5, atol=1e-3)
+
+
+# =============================================================================
+@pytest.mark.parametrize("rearrange", [True, False])
+def test_sample_vtc_linear(test_data, rearrange):
+    """Trilinear sampling reproduces a linear function of voxel position."""
+    header_vtc, data_vtc = bvbabel.vtc.read_vtc(test_data("sub-test03.vtc"),
+                                                rearrange_data_axes=False)
+    mesh = bvbabel.srf.Mesh(bvbabel.srf.read_srf(
+        test_data("sub-test03_cube.srf"))[1])
+    z, y, x, t = np.indices(data_vtc.shape, dtype=np.float32)
+    data = z + 2 * y + 3 * x + t
+    if rearrange:
+        data = np.transpose(data, (0, 2, 1, 3))[::-1, ::-1, ::-1, :]
+
+    header, data_mtc = bvbabel.mtc.sample_vtc(
+        header_vtc, data, mesh, rearrange_data_axes=rearrange)
+    assert header["Nr vertices"] == mesh.nr_vertices
+    assert data_mtc.shape == (mesh.nr_vertices, data_vtc.shape[3])
+
+    res = header_vtc["VTC resolution relative to VMR (1, 2, or 3)"]
+    start = np.array([header_vtc["ZStart"], header_vtc["YStart"],
+                      header_vtc["XStart"]])
+    coords = (mesh.vertices[:, ::-1] - start - (res - 1) / 2) / res
+    inside = np.all((coords >= 0)
+                    & (coords <= np.array(data_vtc.shape[:3]) - 1), axis=1)
+    assert np.sum(inside) > 0.9 * mesh.nr_vertices
+    reference = coords @ [1, 2, 3]
+    reference = reference[:, None] + np.arange(data_vtc.shape[3])
+    assert np.allclose(data_mtc[inside], reference[inside], atol=1e-3)
+
+
+@pytest.mark.parametrize("res", [2, 3])
+def test_sample_vtc_voxel_centers(res):
+    """Vertices on VTC voxel centers sample those voxels exactly."""
+    header_vtc = bvbabel.vtc.create_vtc(rearrange_data_axes=False)[0]
+    header_vtc.update({RES: res, "XStart": 100, "XEnd": 100 + 5 * res,
+                       "YStart": 90, "YEnd": 90 + 4 * res, "ZStart": 80,
+                       "ZEnd": 80 + 6 * res, "Nr time points": 3})
+    start = np.array([80, 90, 100])  # (Z, Y, X)
+    data = np.random.RandomState(0).normal(size=(6, 4, 5, 3))
+    data = data.astype(np.float32)
+
+    # (Z, Y, X) voxels, the last one is on the upper X edge of the box
+    voxels = np.array([[0, 0, 0], [2, 1, 3], [5, 3, 4], [3, 2, 4]])
+    centers = start + voxels * res + (res - 1) / 2
+    normals = np.zeros((4, 3))
+    normals[:, 0] = 1  # Along +X, (X, Y, Z) vertex axes
+    mesh = bvbabel.srf.Mesh({"vertices": centers[:, ::-1],
+                             "faces": np.array([[0, 1, 2], [1, 2, 3]]),
+                             "vertex normals": normals})
+    reference = data[tuple(voxels.T)]
+
+    _, data_mtc = bvbabel.mtc.sample_vtc(header_vtc, data, mesh,
+                                         rearrange_data_axes=False)
+    assert np.allclose(data_mtc, reference, atol=1e-6)
+
+    # The sample one voxel further along X falls outside of the box for the
+    # last vertex, it averages over the sample it has
+    _, data_mtc = bvbabel.mtc.sample_vtc(header_vtc, data, mesh,
+                                         depths=(0, res),
+                                         rearrange_data_axes=False)
+    assert np.allclose(data_mtc[3], reference[3], atol=1e-6)
+    next_voxel = data[tuple((voxels[1] + [0, 0, 1]).T)]
+    assert np.allclose(data_mtc[1], (reference[1] + next_voxel) / 2,
+                       atol=1e-6)
+
+
+def test_sample_vtc_reference(test_data):
+    """Sampling is close to the BrainVoyager MTC of the same run."""
+    header_vtc, data_vtc = bvbabel.vtc.read_vtc(test_data("sub-test03.vtc"))
+    mesh = bvbabel.srf.Mesh(bvbabel.srf.read_srf(
+        test_data("sub-test03_cube.srf"))[1])
+    _, reference = bvbabel.mtc.read_mtc(test_data("sub-test03_cube.mtc"))
+    _, data_mtc = bvbabel.mtc.sample_vtc(header_vtc, data_vtc, mesh,
+                                         depths=(-2, -1, 0, 1, 2))
+    assert data_mtc.shape == reference.shape
+    assert np.corrcoef(data_mtc.ravel(), reference.ravel())[0, 1] > 0.9
@@ -0,0 +1,87 @@
+"""Test temporal preprocessing operators and streaming pipelines."""
+
+import os
+import numpy as np
+import pytest
+import bvbabel
+from bvbabel import preproc
+
+STEPS = ["detrend", ("highpass_fourier", {"nr_cycles": 2}),
+         ("smooth", {"fwhm": 4.}), "zscore"]
+
+
+# =============================================================================
+def test_linear_operators():
+    """Filters remove what they should and keep the mean."""
+    n, tr = 120, 2.
+    t = np.arange(n, dtype=float)
+    mean = 5.
+    fast = np.sin(2 * np.pi * 20 * t / n)
+
+    x = mean + 0.3 * t + fast
+    y = preproc.linear_detrend(n) @ x
+    slope = np.polyfit(t, x, 1)[0]
+    assert np.allclose(y, x - slope * (t - np.mean(t)))
+    assert np.isclose(np.polyfit(t, y, 1)[0], 0)
+
+    x = mean + np.cos(2 * np.pi * 2 * t / n) + fast
+    assert np.allclose(preproc.highpass_fourier(n, nr_cycles=2) @ x,
+                       mean + fast, atol=1e-10)
+
+    # Periods above the cutoff are removed by the DCT basis
+    x = mean + np.cos(np.pi * 3 * (2 * t + 1) / (2 * n))  # 160 s period
+    assert np.allclose(preproc.highpass_dct(n, tr, cutoff=128.) @ x, mean)
+    x = mean + np.cos(np.pi * 10 * (2 * t + 1) / (2 * n))  # 48 s period
+    assert np.allclose(preproc.highpass_dct(n, tr, cutoff=128.) @ x, x)
+
+    smooth = preproc.temporal_smoothing(n, tr, fwhm=6.)
+    assert np.allclose(smooth @ np.full(n, mean), mean)
+    impulse = np.zeros(n)
+    impulse[60] = 1
+    kernel = smooth @ impulse
+    sigma = 6. / tr / np.sqrt(8 * np.log(2))
+    reference = np.exp(-0.5 * ((t - 60) / sigma)**2)
+    assert np.allclose(kernel[50:71], (reference / reference.sum())[50:71])
+
+
+def test_zscore_and_compile():
+    """Linear steps are merged and z-scores have unit variance."""
+    data = np.random.RandomState(0).normal(3, 2, (50, 80))
+    data[0] = 0  # Empty voxel, e.g. outside of the brain
+    operations = preproc.compile_steps(STEPS, 80, 2.)
+    assert len(operations) == 2
+    out = preproc.apply(data, STEPS, 2.)
+    assert np.allclose(out[1:].mean(axis=1), 0, atol=1e-5)
+    assert np.allclose(out[1:].std(axis=1), 1, atol=1e-4)
+    assert np.all(out[0] == 0)
+    with pytest.raises(ValueError):
+        preproc.compile_steps(["unknown"], 80, 2.)
+
+
+# =============================================================================
+def test_preprocess_vtc(test_data, tmp_path):
+    """Streaming VTC preprocessing equals in-memory preprocessing."""
+    filename = test_data("sub-test03.vtc")
+    header, data = bvbabel.vtc.read_vtc(filename)
+    outname = os.path.join(str(tmp_path), "preproc.vtc")
+    header_out = preproc.preprocess_vtc(filename, outname, STEPS,
+                                        chunk_size=1000, nr_threads=2)
+    assert header_out["Data type (1:short int, 2:float)"] == 2
+    reference = preproc.apply(data, STEPS, header["TR (ms)"] / 1000.)
+    assert np.allclose(bvbabel.vtc.read_vtc(outname)[1], reference,
+                       atol=1e-4)
+
+
+def test_preprocess_stc(tmp_path):
+    """Streaming STC preprocessing equals in-memory preprocessing."""
+    dims = (6, 5, 4, 40)  # (x, y, slices, time)
+    data = np.random.RandomState(1).normal(100, 10, dims)
+    data += np.linspace(0, 20, dims[3])
+    filename = os.path.join(str(tmp_path), "in.stc")
+    bvbabel.stc.write_stc(filename, data)
+    outname = os.path.join(str(tmp_path), "out.stc")
+    preproc.preprocess_stc(filename, outname, nr_slices=4, nr_volumes=40,
+                           res_x=5, res_y=6, tr=2., steps=STEPS)
+    out = bvbabel.stc.read_stc(outname, 4, 40, 5, 6)
+    reference = preproc.apply(data.astype(np.float32), STEPS, 2.)
+    assert np.allclose(out, reference, atol=1e-4)
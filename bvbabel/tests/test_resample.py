@@ -0,0 +1,69 @@
+"""Test resampling between VMR, VTC and VMP grids."""
+
+import numpy as np
+import pytest
+import bvbabel
+from bvbabel.resample import _to_bv
+
+
+def test_resample_vtc_into_vmr(test_data):
+    """A VTC takes the framing cube of the VMR it is resampled into."""
+    header_vtc, data_vtc = bvbabel.vtc.read_vtc(test_data("sub-test03.vtc"))
+    header_vmr, data_vmr = bvbabel.vmr.read_vmr(test_data("sub-test03.vmr"))
+    assert header_vmr["FramingCubeDim"] == 179
+
+    data = bvbabel.resample.resample(header_vtc, data_vtc, header_vmr,
+                                     method="nearest")
+    assert data.shape == data_vmr.shape + data_vtc.shape[3:]
+    assert np.count_nonzero(data[..., 0]) == 763264
+
+    # Resolution 1 and start 0: VTC voxels land on the same VMR voxels
+    source = _to_bv(data_vtc)
+    target = _to_bv(data)[:source.shape[0], :source.shape[1],
+                          :source.shape[2]]
+    assert np.array_equal(target, source)
+
+
+def test_resample_framing_cube_conflict(test_data):
+    """Different framing cubes of the two headers are an error."""
+    header_vmr, data_vmr = bvbabel.vmr.read_vmr(test_data("sub-test03.vmr"))
+    header_vmp = bvbabel.vmp.create_vmp()[0]  # 256 framing cube
+    with pytest.raises(ValueError):
+        bvbabel.resample.resample(header_vmr, data_vmr, header_vmp)
+
+
+def test_resample_identity(test_data):
+    """Resampling into the own grid returns the data."""
+    header, data = bvbabel.vmr.read_vmr(test_data("sub-test03.vmr"))
+    for method in ["nearest", "trilinear", "label"]:
+        out = bvbabel.resample.resample(header, data, header, method=method)
+        assert np.allclose(out, data)
+
+
+def test_resample_translation():
+    """A one voxel shift matches shifting the array."""
+    header = {"DimX": 16, "DimY": 12, "DimZ": 10, "FramingCubeDim": 16}
+    data = np.random.rand(10, 12, 16).astype(np.float32)  # BV (Z, Y, X)
+    matrix = np.eye(4)
+    matrix[0, 3] = 1  # Target BV X to source BV X + 1
+    out = bvbabel.resample.resample(header, data, header, trfs=[matrix],
+                                    rearrange_data_axes=False)
+    assert np.allclose(out[:, :, :-1], data[:, :, 1:])
+    assert np.all(out[:, :, -1] == 0)
+
+
+def test_inplane_coordinates_cache():
+    """Plane coordinates are cached per grid and matrix, and read-only."""
+    header = {"DimX": 16, "DimY": 12, "DimZ": 10, "FramingCubeDim": 16}
+    matrix = np.eye(4)
+    plane1, step1 = bvbabel.resample._inplane_coordinates(header, matrix, 16)
+    plane2, _ = bvbabel.resample._inplane_coordinates(header, matrix.copy(),
+                                                      16)
+    assert plane2 is plane1
+    assert not plane1.flags.writeable
+    assert np.array_equal(step1, [0, 0, 1])
+
+    matrix[0, 3] = 1
+    plane3, _ = bvbabel.resample._inplane_coordinates(header, matrix, 16)
+    assert np.allclose(plane3, plane1 + [1, 0, 0])
+    assert bvbabel.resample._plane_coordinates.cache_info().maxsize == 8
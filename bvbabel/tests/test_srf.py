@@ -0,0 +1,192 @@
+"""Test SRF mesh operators."""
+
+import numpy as np
+import bvbabel
+
+
+def grid_mesh(nx=6, ny=5, spacing=1.0):
+    """Planar triangulated grid mesh data, as from `read_srf`."""
+    x, y = np.meshgrid(np.arange(nx), np.arange(ny), indexing="ij")
+    vertices = np.stack([x.ravel(), y.ravel(), np.zeros(x.size)], axis=1)
+    vertices *= spacing
+    idx = np.arange(nx * ny).reshape(nx, ny)
+    a, b = idx[:-1, :-1].ravel(), idx[1:, :-1].ravel()
+    c, d = idx[:-1, 1:].ravel(), idx[1:, 1:].ravel()
+    faces = np.concatenate([np.stack([a, b, d], axis=1),
+                            np.stack([a, d, c], axis=1)], axis=0)
+    return {"vertices": vertices, "faces": faces}
+
+
+def edge_graph_distances(mesh_data):
+    """All pairs shortest paths along mesh edges (Floyd-Warshall)."""
+    vertices, faces = mesh_data["vertices"], mesh_data["faces"]
+    n = vertices.shape[0]
+    dist = np.full((n, n), np.inf)
+    np.fill_diagonal(dist, 0)
+    for i, j in ((0, 1), (1, 2), (2, 0)):
+        length = np.linalg.norm(vertices[faces[:, i]] - vertices[faces[:, j]],
+                                axis=1)
+        dist[faces[:, i], faces[:, j]] = length
+        dist[faces[:, j], faces[:, i]] = length
+    for k in range(n):
+        dist = np.minimum(dist, dist[:, k, None] + dist[None, k, :])
+    return dist
+
+
+def dense_adjacency(mesh_data):
+    """Dense boolean vertex adjacency from faces."""
+    faces = mesh_data["faces"]
+    n = mesh_data["vertices"].shape[0]
+    adj = np.zeros((n, n), dtype=bool)
+    for i, j in ((0, 1), (1, 2), (2, 0)):
+        adj[faces[:, i], faces[:, j]] = True
+        adj[faces[:, j], faces[:, i]] = True
+    return adj
+
+
+# =============================================================================
+def test_mesh_adjacency(test_data):
+    """CSR adjacency matches a dense reference, on a real SRF as well."""
+    for mesh_data in (grid_mesh(), bvbabel.srf.read_srf(
+            test_data("sub-test03_cube.srf"))[1]):
+        mesh = bvbabel.srf.Mesh(mesh_data)
+        indptr, indices = mesh.adjacency
+        adj = np.zeros((mesh.nr_vertices,) * 2, dtype=bool)
+        adj[np.repeat(np.arange(mesh.nr_vertices), np.diff(indptr)),
+            indices] = True
+        assert np.array_equal(adj, dense_adjacency(mesh_data))
+        assert np.array_equal(mesh.degree, adj.sum(axis=1))
+
+
+def test_mesh_neighbor_reductions():
+    """Neighbor sum, mean, max and min against dense references."""
+    mesh_data = grid_mesh()
+    adj = dense_adjacency(mesh_data)
+    mesh = bvbabel.srf.Mesh(mesh_data)
+    values = np.random.RandomState(0).normal(size=(mesh.nr_vertices, 2))
+    assert np.allclose(mesh.neighbor_sum(values), adj @ values)
+    assert np.allclose(mesh.neighbor_mean(values),
+                       adj @ values / adj.sum(axis=1, keepdims=True))
+    masked = np.where(adj[:, :, None], values[None], -np.inf)
+    assert np.allclose(mesh.neighbor_max(values), masked.max(axis=1))
+    masked = np.where(adj[:, :, None], values[None], np.inf)
+    assert np.allclose(mesh.neighbor_min(values), masked.min(axis=1))
+
+
+def test_mesh_geometry_linear_functions():
+    """Areas, Laplacian and gradient are exact for planar linear functions."""
+    mesh = bvbabel.srf.Mesh(grid_mesh(6, 5, spacing=2.0))
+    assert np.isclose(mesh.vertex_areas.sum(), 10 * 8)
+    assert np.isclose(mesh.face_areas.sum(), 10 * 8)
+
+    values = 3 * mesh.vertices[:, 0] - 2 * mesh.vertices[:, 1] + 1
+    interior = ((mesh.vertices[:, 0] > 0) & (mesh.vertices[:, 0] < 10)
+                & (mesh.vertices[:, 1] > 0) & (mesh.vertices[:, 1] < 8))
+    assert np.allclose(mesh.laplacian(values)[interior], 0)
+    # Laplace-Beltrami of x^2 + y^2 is 4 everywhere
+    quadratic = mesh.vertices[:, 0]**2 + mesh.vertices[:, 1]**2
+    laplace_beltrami = mesh.laplacian(quadratic) / mesh.vertex_areas
+    assert np.allclose(laplace_beltrami[interior], 4)
+    assert np.allclose(mesh.gradient(values), [3, -2, 0])
+    both = mesh.gradient(np.stack([values, -values], axis=1))
+    assert np.allclose(both[:, 1], [-3, 2, 0])
+
+
+def test_mesh_cortical_magnification():
+    """Edge length per visual field distance is a constant for a scaling."""
+    mesh = bvbabel.srf.Mesh(grid_mesh())
+    prf_xy = mesh.vertices[:, :2] / 4 + 1
+    cmf = mesh.cortical_magnification(prf_xy, scale=0.5)
+    assert np.allclose(cmf, 2)
+
+
+# =============================================================================
+def test_geodesic_distance_reference():
+    """Dijkstra distances match all pairs shortest paths."""
+    mesh_data = grid_mesh()
+    reference = edge_graph_distances(mesh_data)
+    mesh = bvbabel.srf.Mesh(mesh_data)
+    for source in (0, 7, 29):
+        distance, nearest = mesh.geodesic_distance(source)
+        assert np.allclose(distance, reference[source])
+        assert np.all(nearest == 0)
+
+    sources = np.array([0, 29])
+    distance, nearest = mesh.geodesic_distance(sources)
+    assert np.allclose(distance, reference[sources].min(axis=0))
+    closer = reference[0] < reference[29] - 1e-9
+    assert np.all(nearest[closer] == 0)
+
+
+def test_geodesic_distance_max_distance():
+    """Vertices beyond max_distance are not reached."""
+    mesh_data = grid_mesh()
+    reference = edge_graph_distances(mesh_data)[12]
+    distance, nearest = bvbabel.srf.Mesh(mesh_data).geodesic_distance(
+        12, max_distance=1.5)
+    reached = reference <= 1.5
+    assert np.allclose(distance[reached], reference[reached])
+    assert np.all(np.isinf(distance[~reached]))
+    assert np.all(nearest[~reached] == -1)
+
+
+def test_geodesic_neighborhood():
+    """Reached vertices and source labels match the dense distances."""
+    mesh_data = grid_mesh()
+    reference = edge_graph_distances(mesh_data)
+    mesh = bvbabel.srf.Mesh(mesh_data)
+    sources = np.array([3, 26])
+    vertices, distance, nearest = mesh.geodesic_neighborhood(sources, 2.0)
+    dist = reference[sources]
+    reached = np.flatnonzero(dist.min(axis=0) <= 2.0)
+    assert np.array_equal(np.sort(vertices), reached)
+    assert np.all(np.diff(distance) >= 0)
+    assert np.allclose(distance, dist.min(axis=0)[vertices])
+    assert np.array_equal(nearest, np.argmin(dist[:, vertices], axis=0))
+
+
+def test_grow_pois_reference():
+    """POIs hold the vertices within their radius, or nearest to them."""
+    mesh_data = grid_mesh()
+    reference = edge_graph_distances(mesh_data)
+    mesh = bvbabel.srf.Mesh(mesh_data)
+    centers = np.array([6, 18])
+    header, pois = bvbabel.poi.grow_pois(mesh, centers, [1.0, 2.5],
+                                         names=["a", "b"])
+    assert header["NrOfPOIs"] == 2
+    assert pois[1]["NameOfPOI"] == '"b"'
+    for poi, c, r in zip(pois, centers, [1.0, 2.5]):
+        assert poi["LabelVertex"] == c
+        assert np.array_equal(poi["Vertices"],
+                              np.flatnonzero(reference[c] <= r))
+
+    _, pois = bvbabel.poi.grow_pois(mesh, centers, 2.5, exclusive=True)
+    dist = reference[centers]
+    within = dist.min(axis=0) <= 2.5
+    for i, poi in enumerate(pois):
+        expected = np.flatnonzero(within & (np.argmin(dist, axis=0) == i))
+        # Ties between the centers may go either way
+        ties = np.flatnonzero(within & np.isclose(dist[0], dist[1]))
+        assert np.array_equal(np.setdiff1d(poi["Vertices"], ties),
+                              np.setdiff1d(expected, ties))
+    assert sum(p["NrOfVertices"] for p in pois) == np.sum(within)
+
+
+def test_geodesic_results_not_cached():
+    """Only the adjacency is kept on the mesh, not per source results."""
+    mesh = bvbabel.srf.Mesh(grid_mesh())
+    nr_vertices = mesh.nr_vertices
+    bvbabel.poi.grow_pois(mesh, np.arange(nr_vertices), 2.0)
+    bvbabel.poi.grow_pois(mesh, np.arange(nr_vertices), 3.0)
+    assert "adjacency_lists" in mesh.cache
+    assert not [k for k in mesh.cache if isinstance(k, tuple)]
+    assert len(mesh.cache) < 10
+
+
+def test_grow_pois_colors():
+    """Default POI colors are the same on every call."""
+    mesh = bvbabel.srf.Mesh(grid_mesh())
+    _, pois1 = bvbabel.poi.grow_pois(mesh, [0, 12], 1.5)
+    _, pois2 = bvbabel.poi.grow_pois(mesh, [0, 12], 1.5)
+    assert [p["ColorOfPOI"] for p in pois1] == [p["ColorOfPOI"] for p in pois2]
+    assert pois1[0]["ColorOfPOI"] != pois1[1]["ColorOfPOI"]
@@ -0,0 +1,70 @@
+"""Test SSM reading, writing and resampling."""
+
+import os
+import numpy as np
+import pytest
+import bvbabel
+
+
+def test_ssm_roundtrip(test_data, tmp_path):
+    """SSM read and write, indices are 0-based as in BrainVoyager files."""
+    header1, data1 = bvbabel.ssm.read_ssm(test_data("sub-test09.ssm"))
+    assert data1.min() >= 0
+    assert data1.max() < header1["Nr vertices 2"]
+    outname = os.path.join(str(tmp_path), "out.ssm")
+    bvbabel.ssm.write_ssm(outname, header1, data1)
+    header2, data2 = bvbabel.ssm.read_ssm(outname)
+    assert header1 == header2
+    assert np.array_equal(data1, data2)
+
+
+def test_ssm_apply_identity():
+    """The created identity mapping leaves data unchanged."""
+    header, data_ssm = bvbabel.ssm.create_ssm(100)
+    data = np.arange(100.)
+    assert np.array_equal(bvbabel.ssm.apply(data, data_ssm), data)
+    assert np.array_equal(bvbabel.ssm.apply(data, data_ssm, chunk_size=7),
+                          data)
+
+
+def test_ssm_apply_mapping(test_data):
+    """Resampling picks the referenced vertex of each vertex."""
+    header, data_ssm = bvbabel.ssm.read_ssm(test_data("sub-test09.ssm"))
+    data = np.random.rand(header["Nr vertices 2"], 3).astype(np.float32)
+    assert np.array_equal(bvbabel.ssm.apply(data, data_ssm), data[data_ssm])
+
+
+def test_ssm_apply_out_of_range():
+    """1-based or foreign mappings are rejected instead of shifted."""
+    with pytest.raises(ValueError):
+        bvbabel.ssm.apply(np.arange(100.), np.arange(1, 101))
+
+
+def test_ssm_apply_mtc(test_data, tmp_path):
+    """MTC resampling in chunks matches in memory resampling."""
+    name_in = test_data("sub-test03_cube.mtc")
+    name_out = os.path.join(str(tmp_path), "out.mtc")
+    header, data = bvbabel.mtc.read_mtc(name_in)
+    data_ssm = np.random.randint(0, header["Nr vertices"], 300)
+    bvbabel.ssm.apply_mtc(name_in, name_out, data_ssm, chunk_size=64)
+    header_out, data_out = bvbabel.mtc.read_mtc(name_out)
+    assert header_out["Nr vertices"] == 300
+    assert np.allclose(data_out, data[data_ssm])
+
+
+def test_ssm_build_roundtrip(test_data, tmp_path):
+    """Build, write, read and apply a mapping between two meshes."""
+    header, mesh_2 = bvbabel.srf.read_srf(test_data("sub-test03_cube.srf"))
+    order = np.random.permutation(mesh_2["vertices"].shape[0])
+    shift = np.random.uniform(-0.01, 0.01, mesh_2["vertices"].shape)
+    mesh_1 = {"vertices": mesh_2["vertices"][order] + shift}
+
+    for method in ["vertex", "barycentric"]:
+        header1, data1, bary = bvbabel.ssm.build_from_srfs(mesh_1, mesh_2,
+                                                           method=method)
+        assert np.array_equal(data1, order)
+        outname = os.path.join(str(tmp_path), "out.ssm")
+        bvbabel.ssm.write_ssm(outname, header1, data1)
+        header2, data2 = bvbabel.ssm.read_ssm(outname)
+        values = np.arange(header2["Nr vertices 2"], dtype=np.float32)
+        assert np.array_equal(bvbabel.ssm.apply(values, data2), order)
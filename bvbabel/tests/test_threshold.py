@@ -0,0 +1,119 @@
+"""Test FDR and cluster thresholding against reference values."""
+
+import numpy as np
+import pytest
+import bvbabel
+from bvbabel import threshold
+
+
+def test_stat_to_p_closed_forms():
+    """P values against closed form distributions."""
+    t = np.array([0.5, 1., 3., 20.], dtype=np.float32)
+    # t with 1 degree of freedom is Cauchy distributed
+    p = threshold.stat_to_p(t, 1, 1)
+    assert p.dtype == np.float32
+    assert np.allclose(p, 1 - 2 / np.pi * np.arctan(t), rtol=1e-6)
+    # F with df1 = 2
+    f = np.array([0.5, 2., 10.])
+    assert np.allclose(threshold.stat_to_p(f, 4, 2, 12),
+                       (1 + 2 * f / 12) ** -6, rtol=1e-10)
+    # Correlation r is t = r sqrt(df / (1 - r^2)) distributed
+    r = np.array([0.1, 0.5, 0.9])
+    tr = r * np.sqrt(1 / (1 - r**2))
+    assert np.allclose(threshold.stat_to_p(r, 2, 1),
+                       1 - 2 / np.pi * np.arctan(tr), rtol=1e-8)
+    # z
+    assert np.allclose(threshold.stat_to_p(np.array([1.959964]), 5, 0),
+                       0.05, atol=1e-6)
+
+
+def _reference_fdr(values, map_type, df1, q):
+    """Brute force Benjamini-Hochberg and Yekutieli critical values."""
+    stat = np.abs(values[values != 0].astype(np.float64))
+    p = threshold.stat_to_p(stat, map_type, df1)
+    m = stat.size
+    order = np.argsort(p)
+    out = []
+    for level in [q, q / np.sum(1. / np.arange(1, m + 1))]:
+        k = np.flatnonzero(p[order] <= np.arange(1, m + 1) * level / m)
+        out.append(stat[order][k[-1]] if k.size > 0 else None)
+    return out
+
+
+@pytest.mark.parametrize("shift", [0., 2., 4.])
+def test_fdr_table_reference(shift):
+    """FDR critical values match a brute force computation."""
+    rng = np.random.default_rng(0)
+    values = rng.standard_normal((30, 20, 25)).astype(np.float32)
+    values[:10] += shift
+    values[0, 0, :5] = 0  # Outside of the analyzed volume
+    table, nr_used = threshold.fdr_table(values, 1, 40, chunk_size=1000)
+    assert nr_used == values.size - 5
+    for i, q in enumerate(threshold.FDR_Q_VALUES):
+        for j, crit in enumerate(_reference_fdr(values, 1, 40, q)):
+            if crit is None:  # Nothing survives
+                assert table[i, j + 1] > np.abs(values).max()
+            else:
+                assert table[i, j + 1] == np.float32(crit)
+
+
+def _flood_fill(mask, connectivity):
+    """Reference cluster sizes by breadth first search."""
+    offsets = [(a, b, c) for a in (-1, 0, 1) for b in (-1, 0, 1)
+               for c in (-1, 0, 1)
+               if 0 < abs(a) + abs(b) + abs(c) <= {6: 1, 18: 2, 26: 3}[
+                   connectivity]]
+    seen = np.zeros(mask.shape, dtype=bool)
+    sizes = []
+    for start in zip(*np.nonzero(mask)):
+        if seen[start]:
+            continue
+        seen[start] = True
+        todo, size = [start], 0
+        while todo:
+            p = todo.pop()
+            size += 1
+            for o in offsets:
+                q = tuple(np.add(p, o))
+                if all(0 <= q[k] < mask.shape[k] for k in range(3)) \
+                        and mask[q] and not seen[q]:
+                    seen[q] = True
+                    todo.append(q)
+        sizes.append(size)
+    return sorted(sizes)
+
+
+@pytest.mark.parametrize("connectivity", [6, 18, 26])
+def test_label_clusters_reference(connectivity):
+    """Cluster labels match a flood fill."""
+    mask = np.random.default_rng(1).random((12, 13, 14)) > 0.7
+    labels, sizes = threshold.label_clusters(mask, connectivity, chunk_size=5)
+    assert np.array_equal(labels > 0, mask)
+    assert sizes[0] == 0
+    assert sorted(sizes[1:].tolist()) == _flood_fill(mask, connectivity)
+    # Voxel counts of the labels agree with the sizes
+    assert np.array_equal(np.bincount(labels.ravel())[1:], sizes[1:])
+
+
+def test_threshold_vmp_clusters():
+    """Small clusters are removed, large ones kept."""
+    header, _ = bvbabel.vmp.create_vmp()
+    data = np.zeros((20, 20, 20), dtype=np.float32)
+    data[2:6, 2:6, 2:6] = 8.  # 64 voxels
+    data[15, 15, 15] = 9.  # Single voxel
+    data[10:12, 10:12, 10:12] = -8.  # 8 voxels, negative
+    header["DimX"] = header["DimY"] = header["DimZ"] = 20
+    header["XEnd"] = header["YEnd"] = header["ZEnd"] = 20
+    header["Map"][0]["DF1"] = 100
+    header, data_thr = threshold.threshold_vmp(header, data, cluster_size=8)
+    assert np.count_nonzero(data_thr > 0) == 64
+    assert np.count_nonzero(data_thr < 0) == 8
+    assert data_thr[15, 15, 15] == 0
+    assert header["Map"][0]["NrOfUsedVoxels"] == 73
+
+
+def test_harmonic_number():
+    """Asymptotic harmonic numbers of large maps match the exact sum."""
+    m = 2**21
+    assert np.isclose(threshold._harmonic(m),
+                      np.sum(1. / np.arange(1, m + 1)), rtol=1e-12)
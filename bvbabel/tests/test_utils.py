@@ -0,0 +1,29 @@
+"""Test shared interpolation helpers."""
+
+import numpy as np
+import bvbabel
+
+
+def test_trilinear_sample_linear():
+    """Linear functions are exact within the grid, up to its last voxel."""
+    shape = (4, 5, 6)
+    a, b, c = np.indices(shape)
+    data = (a + 2 * b + 3 * c).astype(np.float32)
+    coords = np.random.RandomState(0).uniform(-1, 6, (500, 3))
+    coords[:3] = [[0, 0, 0], [3, 4, 5], [3, 0.5, 5]]  # Grid corners, edge
+    values, inside = bvbabel.utils.trilinear_sample(data, coords, fill=-1)
+    expected = np.all((coords >= 0) & (coords <= np.array(shape) - 1), axis=1)
+    assert np.array_equal(inside, expected)
+    assert np.all(inside[:3])
+    assert np.allclose(values[inside], coords[inside] @ [1, 2, 3], atol=1e-5)
+    assert np.all(values[~inside] == -1)
+
+
+def test_trilinear_weights_outside_corners():
+    """Corners outside of the grid get zero weight, the rest sum up."""
+    coords = np.array([[1.25, 0.5, 2.], [-0.5, 1., 1.], [2.5, 2.5, 2.5]])
+    corners, weights = bvbabel.utils.trilinear_weights(coords, (3, 3, 3))
+    assert np.all((corners >= 0) & (corners <= 2))
+    assert np.allclose(weights.sum(axis=1), [1, 0.5, 0.125])
+    point = np.sum(weights[0, :, None] * corners[0], axis=0)
+    assert np.allclose(point, coords[0])
@@ -0,0 +1,175 @@
+"""Test VMR reading, writing and downsampling."""
+
+import os
+import numpy as np
+import pytest
+import bvbabel
+
+
+def to_file_axes(data):
+    """`read_vmr` axes back to file order (Z, Y, X)."""
+    return data[::-1, ::-1, ::-1].transpose(0, 2, 1)
+
+
+def block_mean(raw, factor):
+    """Reference block mean with edge padding of partial blocks."""
+    raw = np.pad(raw.astype(np.float64),
+                 [(0, -n % factor) for n in raw.shape], mode="edge")
+    nz, ny, nx = (n // factor for n in raw.shape)
+    blocks = raw.reshape(nz, factor, ny, factor, nx, factor)
+    return np.round(blocks.mean(axis=(1, 3, 5)))
+
+
+# =============================================================================
+@pytest.mark.parametrize("name", ["sub-test01_fileversion-2.vmr",
+                                  "sub-test03.vmr",
+                                  "sub-test07_partial_coverage.vmr"])
+def test_open_vmr(test_data, name):
+    """Memory mapped VMR equals read_vmr in header and data."""
+    header1, data1 = bvbabel.vmr.read_vmr(test_data(name))
+    header2, data2 = bvbabel.vmr.open_vmr(test_data(name))
+    assert header1 == header2
+    assert isinstance(data2, np.memmap)
+    assert np.array_equal(data1, data2)
+
+
+def test_open_vmr_modify(test_data, tmp_path):
+    """Writes into an r+ memory map reach the file at the read_vmr voxel."""
+    header, data = bvbabel.vmr.read_vmr(test_data("sub-test03.vmr"))
+    filename = os.path.join(str(tmp_path), "modify.vmr")
+    bvbabel.vmr.write_vmr(filename, header, data)
+    _, data_mmap = bvbabel.vmr.open_vmr(filename, mode="r+")
+    data_mmap[3, 5, 7] = 231
+    data_mmap.base.flush()
+    del data_mmap
+    data[3, 5, 7] = 231
+    assert np.array_equal(bvbabel.vmr.read_vmr(filename)[1], data)
+
+
+def test_open_v16(tmp_path):
+    """Memory mapped V16 equals read_v16, axes are (DimZ, DimX, DimY)."""
+    header = {"DimX": 12, "DimY": 10, "DimZ": 8}
+    data = np.random.RandomState(0).randint(0, 65535, (8, 12, 10),
+                                            dtype=np.uint16)
+    filename = os.path.join(str(tmp_path), "test.v16")
+    bvbabel.v16.write_v16(filename, header, data)
+    header1, data1 = bvbabel.v16.read_v16(filename)
+    header2, data2 = bvbabel.v16.open_v16(filename)
+    assert header1 == header2 == header
+    assert np.array_equal(data1, data)
+    assert np.array_equal(data2, data)
+
+
+# =============================================================================
+@pytest.mark.parametrize("name", ["sub-test01_fileversion-2.vmr",
+                                  "sub-test07_partial_coverage.vmr"])
+def test_read_vmr_bbox(test_data, tmp_path, name):
+    """Bounding box data keeps its place in the framing cube."""
+    header1, data1 = bvbabel.vmr.read_vmr(test_data(name))
+    header2, data2 = bvbabel.vmr.read_vmr_bbox(test_data(name), threshold=10)
+    assert header2["File version"] >= 3
+    assert data2.size <= data1.size
+    cube1 = np.asarray(bvbabel.vmr.FramingCube(header1, data1))
+    cube2 = np.asarray(bvbabel.vmr.FramingCube(header2, data2))
+    assert np.array_equal(np.where(cube1 > 10, cube1, 0),
+                          np.where(cube2 > 10, cube2, 0))
+
+    # Offsets survive writing
+    outname = os.path.join(str(tmp_path), "bbox.vmr")
+    bvbabel.vmr.write_vmr(outname, header2, data2)
+    header3, data3 = bvbabel.vmr.read_vmr(outname)
+    for key in ("DimX", "DimY", "DimZ", "OffsetX", "OffsetY", "OffsetZ",
+                "FramingCubeDim"):
+        assert header3[key] == header2[key]
+    assert np.array_equal(data3, data2)
+
+
+def test_read_vmr_bbox_synthetic(test_data, tmp_path):
+    """Offsets and dimensions of a known box, in file axes."""
+    header, data = bvbabel.vmr.read_vmr(test_data("sub-test03.vmr"))
+    raw = np.zeros(to_file_axes(data).shape, dtype=np.uint8)
+    raw[5:9, 20:31, 2:4] = 100  # (Z, Y, X)
+    data = raw.transpose(0, 2, 1)[::-1, ::-1, ::-1]
+    filename = os.path.join(str(tmp_path), "box.vmr")
+    bvbabel.vmr.write_vmr(filename, header, data)
+    header_bbox, data_bbox = bvbabel.vmr.read_vmr_bbox(filename, slab_size=3)
+    assert (header_bbox["OffsetZ"], header_bbox["OffsetY"],
+            header_bbox["OffsetX"]) == (5, 20, 2)
+    assert (header_bbox["DimZ"], header_bbox["DimY"],
+            header_bbox["DimX"]) == (4, 11, 2)
+    assert np.all(data_bbox == 100)
+
+
+def test_framing_cube_indexing(test_data):
+    """Lazy framing cube indexing equals indexing the full cube."""
+    header, data = bvbabel.vmr.read_vmr_bbox(
+        test_data("sub-test07_partial_coverage.vmr"), threshold=10)
+    view = bvbabel.vmr.FramingCube(header, data)
+    cube = np.asarray(view)
+    assert cube.shape == (header["FramingCubeDim"],) * 3
+    assert np.sum(cube) == np.sum(data, dtype=np.int64)
+    for key in [(slice(None), 60), (30, slice(10, 90, 3), 5),
+                (Ellipsis, 17), (slice(-20, None), Ellipsis),
+                (np.array([0, 50, 100]),)]:
+        assert np.array_equal(view[key], cube[key])
+
+
+# =============================================================================
+def test_build_pyramid_mean(test_data, tmp_path):
+    """Downsampled VMRs match block means of the input."""
+    filename = test_data("sub-test03.vmr")
+    header, data = bvbabel.vmr.read_vmr(filename)
+    outnames = [os.path.join(str(tmp_path), "pyramid{}.vmr".format(f))
+                for f in (2, 3)]
+    headers = bvbabel.vmr.build_pyramid(filename, factors=(2, 3),
+                                        outnames=outnames)
+    for f, h, outname in zip((2, 3), headers, outnames):
+        header_out, data_out = bvbabel.vmr.read_vmr(outname)
+        assert header_out["DimX"] == -(-header["DimX"] // f)
+        assert header_out["VoxelSizeX"] == pytest.approx(
+            header["VoxelSizeX"] * f)
+        assert header_out["FramingCubeDim"] == h["FramingCubeDim"]
+        reference = block_mean(to_file_axes(data), f)
+        assert np.array_equal(to_file_axes(data_out), reference)
+
+
+def test_build_pyramid_coprime_factors(test_data, tmp_path, monkeypatch):
+    """Coprime factors are reduced in slabs bounded by the largest factor."""
+    filename = test_data("sub-test03.vmr")
+    _, data = bvbabel.vmr.read_vmr(filename)
+    slab_sizes = list()
+    block_reduce = bvbabel.vmr._block_reduce
+
+    def recording(slab, factor, method):
+        slab_sizes.append(slab.shape[0])
+        return block_reduce(slab, factor, method)
+
+    monkeypatch.setattr(bvbabel.vmr, "_block_reduce", recording)
+    factors = (2, 3, 5, 7)
+    outnames = [os.path.join(str(tmp_path), "pyramid{}.vmr".format(f))
+                for f in factors]
+    bvbabel.vmr.build_pyramid(filename, factors=factors, outnames=outnames)
+    assert max(slab_sizes) < 2 * max(factors)
+    for f, outname in zip(factors, outnames):
+        _, data_out = bvbabel.vmr.read_vmr(outname)
+        assert np.array_equal(to_file_axes(data_out),
+                              block_mean(to_file_axes(data), f))
+
+
+def test_build_pyramid_offsets(test_data, tmp_path):
+    """Offsets are divided by the factor, unaligned offsets are rejected."""
+    header, data = bvbabel.vmr.read_vmr(test_data("sub-test03.vmr"))
+    filename = os.path.join(str(tmp_path), "offset.vmr")
+    header["OffsetX"], header["OffsetY"], header["OffsetZ"] = 8, 4, 12
+    header["FramingCubeDim"] = 256
+    bvbabel.vmr.write_vmr(filename, header, data)
+
+    outname = os.path.join(str(tmp_path), "pyramid.vmr")
+    h, = bvbabel.vmr.build_pyramid(filename, factors=(4,), outnames=[outname])
+    assert (h["OffsetX"], h["OffsetY"], h["OffsetZ"]) == (2, 1, 3)
+    assert bvbabel.vmr.read_vmr(outname)[0]["OffsetZ"] == 3
+
+    outname = os.path.join(str(tmp_path), "unaligned.vmr")
+    with pytest.raises(ValueError):
+        bvbabel.vmr.build_pyramid(filename, factors=(8,), outnames=[outname])
+    assert not os.path.exists(outname)
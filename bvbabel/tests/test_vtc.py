@@ -0,0 +1,155 @@
+"""Test VTC reading, writing and masked storage."""
+
+import os
+import numpy as np
+import pytest
+import bvbabel
+
+RES = "VTC resolution relative to VMR (1, 2, or 3)"
+
+
+def test_vtc_roundtrip(test_data, tmp_path):
+    """VTC read, write, memory mapped and allocated access."""
+    header1, data1 = bvbabel.vtc.read_vtc(test_data("sub-test03.vtc"))
+    outname = os.path.join(str(tmp_path), "out.vtc")
+    bvbabel.vtc.write_vtc(outname, header1, data1)
+    header2, data2 = bvbabel.vtc.read_vtc(outname)
+    assert header1 == header2
+    assert np.array_equal(data1, data2)
+    header3, data3 = bvbabel.vtc.open_vtc(outname)
+    assert header1 == header3
+    assert np.array_equal(data1, data3)
+
+    outname = os.path.join(str(tmp_path), "allocated.vtc")
+    data4 = bvbabel.vtc.allocate_vtc(outname, header1)
+    data4[:] = data1
+    data4.flush()
+    del data4
+    assert np.array_equal(bvbabel.vtc.read_vtc(outname)[1], data1)
+
+
+# =============================================================================
+@pytest.mark.parametrize("mmap", [False, True])
+def test_masked_vtc_roundtrip(test_data, tmp_path, mmap):
+    """Masked storage gives back the in-mask time courses."""
+    filename = test_data("sub-test03.vtc")
+    header, data = bvbabel.vtc.read_vtc(filename)
+
+    # MSK on the VTC grid, through a file
+    header_msk = {key: header[key] for key in (
+        RES, "XStart", "XEnd", "YStart", "YEnd", "ZStart", "ZEnd")}
+    mean = np.mean(data, axis=-1)
+    mask = (mean > np.percentile(mean, 60)).astype(np.uint8)
+    filename_msk = os.path.join(str(tmp_path), "test.msk")
+    bvbabel.msk.write_msk(filename_msk, header_msk, mask)
+    header_msk, data_msk = bvbabel.msk.read_msk(filename_msk)
+    assert np.array_equal(data_msk, mask)
+
+    data_in = bvbabel.vtc.open_vtc(filename)[1] if mmap else data
+    indices, data_masked = bvbabel.vtc.mask_vtc(header, data_in, data_msk,
+                                                slab_size=3)
+    assert indices.size == np.sum(mask)
+    assert np.all(np.diff(indices) > 0)
+    raw = np.transpose(data[::-1, ::-1, ::-1, :], (0, 2, 1, 3))
+    raw = raw.reshape(-1, data.shape[3])  # Flat (Z, Y, X) file order
+    assert np.array_equal(data_masked, raw[indices])
+
+    outname = os.path.join(str(tmp_path), "masked.vtc")
+    bvbabel.vtc.write_vtc_masked(outname, header, indices, data_masked)
+    header2, indices2, data_masked2 = bvbabel.vtc.read_vtc_masked(outname,
+                                                                  mmap=mmap)
+    assert header2 == header
+    assert np.array_equal(indices2, indices)
+    assert np.array_equal(data_masked2, data_masked)
+
+    reference = data * (mask > 0)[..., None]
+    assert np.array_equal(
+        bvbabel.vtc.unmask_vtc(header2, indices2, data_masked2), reference)
+    outname = os.path.join(str(tmp_path), "unmasked.vtc")
+    bvbabel.vtc.write_vtc_unmasked(outname, header, indices, data_masked)
+    assert np.array_equal(bvbabel.vtc.read_vtc(outname)[1], reference)
+
+
+def test_mask_vtc_dimension_mismatch(test_data):
+    """A mask of another grid is rejected."""
+    header, data = bvbabel.vtc.read_vtc(test_data("sub-test03.vtc"))
+    with pytest.raises(ValueError):
+        bvbabel.vtc.mask_vtc(header, data, np.ones((3, 4, 5)))
+
+
+# =============================================================================
+def fmr_run(dirname, dims, nr_volumes):
+    """FMR/STC pair whose values are a linear function of voxel position.
+
+    Voxel (column c, row r, slice s) of volume t holds c + 2 r + 3 s + 10 t.
+    """
+    header, _ = bvbabel.fmr.create_fmr()
+    header["Prefix"] = "run"
+    header["ResolutionX"], header["ResolutionY"] = dims[0], dims[1]
+    header["NrOfSlices"], header["NrOfVolumes"] = dims[2], nr_volumes
+    header["DataType"] = 2
+    t, s, r, c = np.indices((nr_volumes, dims[2], dims[1], dims[0]))
+    raw = c + 2. * r + 3. * s + 10. * t  # STC file order
+    data = np.transpose(raw, (2, 3, 1, 0))[:, ::-1]  # As in read_fmr
+    filename = os.path.join(dirname, "run.fmr")
+    bvbabel.fmr.write_fmr(filename, header, data.astype(np.float32))
+    return filename
+
+
+@pytest.mark.parametrize("method, tolerance", [("nearest", None),
+                                               ("trilinear", 1e-3),
+                                               ("sinc", 0.5)])
+def test_create_from_fmr(tmp_path, method, tolerance):
+    """VTC voxels sample the FMR where the transformation points them."""
+    dims, nr_volumes = np.array([20, 24, 10]), 7
+    filename_fmr = fmr_run(str(tmp_path), dims, nr_volumes)
+    header_vtc = bvbabel.vtc.create_vtc(rearrange_data_axes=False)[0]
+    header_vtc.update({RES: 2, "XStart": 100, "XEnd": 140, "YStart": 110,
+                       "YEnd": 150, "ZStart": 120, "ZEnd": 150})
+    angle = np.deg2rad(10)
+    matrix = np.eye(4)
+    matrix[:3, :3] = np.array([[np.cos(angle), -np.sin(angle), 0],
+                               [np.sin(angle), np.cos(angle), 0],
+                               [0, 0, 1]]) @ np.diag([0.4, 0.35, 0.3])
+    matrix[:3, 3] = [2, -1, 0.5]
+    trf_a, trf_b = np.eye(4), np.eye(4)
+    trf_a[:3, 3], trf_b[:3, :3] = matrix[:3, 3], matrix[:3, :3]
+    assert np.allclose(bvbabel.trf.compose_trfs(trf_a, {"Matrix": trf_b}),
+                       matrix)
+
+    outname = os.path.join(str(tmp_path), "run.vtc")
+    header, sampling_map = bvbabel.vtc.create_from_fmr(
+        filename_fmr, outname, header_vtc, matrix, method=method,
+        chunk_size=3)
+    assert header["Nr time points"] == nr_volumes
+    _, data_vtc = bvbabel.vtc.read_vtc(outname, rearrange_data_axes=False)
+
+    # Reference positions of the VTC voxel centers in FMR voxels
+    z, y, x = np.indices(data_vtc.shape[:3])
+    xyz = np.stack([x.ravel(), y.ravel(), z.ravel()], axis=1) * 2
+    xyz = xyz + [100, 110, 120] + 0.5 - 128
+    coords = xyz @ matrix[:3, :3].T + matrix[:3, 3] + dims / 2
+    if method == "nearest":
+        coords = np.round(coords)
+    margin = 0 if method != "sinc" else 3
+    inside = np.all((coords >= margin) & (coords <= dims - 1 - margin),
+                    axis=1)
+    assert np.sum(inside) > 100
+    reference = coords @ [1, 2, 3]
+    reference = reference[:, None] + 10. * np.arange(nr_volumes)
+    values = np.reshape(data_vtc, (-1, nr_volumes))
+    if tolerance is None:
+        assert np.array_equal(values[inside], reference[inside])
+    else:
+        assert np.allclose(values[inside], reference[inside], atol=tolerance)
+
+    # Voxels mapping outside of the FMR are empty
+    outside = np.any((coords < -0.5) | (coords > dims - 0.5), axis=1)
+    assert np.all(values[outside] == 0)
+
+    # Runs with the same geometry reuse the sampling map
+    outname2 = os.path.join(str(tmp_path), "run2.vtc")
+    bvbabel.vtc.create_from_fmr(filename_fmr, outname2, header_vtc, matrix,
+                                sampling_map=sampling_map)
+    assert np.array_equal(bvbabel.vtc.read_vtc(outname2)[1],
+                          bvbabel.vtc.read_vtc(outname)[1])
@@ -0,0 +1,581 @@
+"""FDR and cluster size thresholding for BrainVoyager VMP and SMP maps."""
+
+import math
+import numpy as np
+
+# Default q levels used to fill FDR tables (q, crit std, crit conservative)
+FDR_Q_VALUES = (0.1, 0.05, 0.04, 0.03, 0.02, 0.01, 0.005, 0.001)
+
+# NOTE: Voxels are clustered as runs along the last axis. Each entry lists the
+# neighboring rows (dz, dy) of a run that are searched, and how far (in voxels)
+# runs may be apart along the last axis to still touch. Only half of the
+# neighborhood is listed; the other half is covered by symmetry.
+_ROW_NEIGHBORS = {
+    6: [(0, 1, 0), (1, 0, 0)],
+    18: [(0, 1, 1), (1, -1, 0), (1, 0, 1), (1, 1, 0)],
+    26: [(0, 1, 1), (1, -1, 1), (1, 0, 1), (1, 1, 1)],
+    }
+
+
+# =============================================================================
+# Statistics
+# =============================================================================
+def _betacf(a, b, x, nr_iterations=300, eps=3e-14):
+    """Continued fraction of the incomplete beta function (modified Lentz).
+
+    Converged elements are dropped after each iteration, so that the cost
+    does not depend on the slowest element of the array.
+    """
+    tiny = 1e-300
+    qab, qap, qam = a + b, a + 1., a - 1.
+    out = np.empty_like(x)
+    idx = np.arange(x.size)
+    c = np.ones_like(x)
+    d = 1. - qab * x / qap
+    d[np.abs(d) < tiny] = tiny
+    d = 1. / d
+    h = d.copy()
+    for m in range(1, nr_iterations + 1):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1. + aa * d
+        d[np.abs(d) < tiny] = tiny
+        c = 1. + aa / c
+        c[np.abs(c) < tiny] = tiny
+        d = 1. / d
+        h *= d * c
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1. + aa * d
+        d[np.abs(d) < tiny] = tiny
+        c = 1. + aa / c
+        c[np.abs(c) < tiny] = tiny
+        d = 1. / d
+        delta = d * c
+        h *= delta
+        done = np.abs(delta - 1.) < eps
+        if np.any(done):
+            out[idx[done]] = h[done]
+            keep = ~done
+            idx, x, c, d, h = idx[keep], x[keep], c[keep], d[keep], h[keep]
+            if idx.size == 0:
+                break
+    out[idx] = h  # Not converged within nr_iterations
+    return out
+
+
+def _betainc(a, b, x):
+    """Regularized incomplete beta function I_x(a, b) for scalar a and b."""
+    x = np.clip(np.asarray(x, dtype=np.float64), 0., 1.)
+    out = np.zeros(x.shape)
+    lbeta = math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b)
+    with np.errstate(divide="ignore"):
+        bt = np.exp(lbeta + a * np.log(x) + b * np.log1p(-x))
+    front = x < (a + 1.) / (a + b + 2.)
+    if np.any(front):
+        out[front] = bt[front] * _betacf(a, b, x[front]) / a
+    back = ~front
+    if np.any(back):
+        out[back] = 1. - bt[back] * _betacf(b, a, 1. - x[back]) / b
+    return out
+
+
+def _erfc(x):
+    """Complementary error function (fractional error < 1.2e-7)."""
+    z = np.abs(x)
+    t = 1. / (1. + 0.5 * z)
+    r = t * np.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (
+        0.37409196 + t * (0.09678418 + t * (-0.18628806 + t * (
+            0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (
+                -0.82215223 + t * 0.17087277)))))))))
+    return np.where(x >= 0, r, 2. - r)
+
+
+def stat_to_p(values, map_type, df1, df2=0, chunk_size=2**20):
+    """Convert statistical map values to p values.
+
+    Parameters
+    ----------
+    values : numpy.array
+        Statistical values (any shape).
+    map_type : integer
+        BrainVoyager map code. 1: T-statistic, 2: Correlation,
+        3: Cross-correlation, 4: F-statistic, 5: Z-statistic.
+    df1 : integer
+        Degrees of freedom 1 (denominator of t and r, nominator of F).
+    df2 : integer
+        Degrees of freedom 2 (only used for F).
+    chunk_size : integer
+        Number of values converted at once. Limits temporary memory.
+
+    Returns
+    -------
+    p : numpy.array
+        Two-sided p values (one-sided for F), same shape as input. Float32
+        for float32 (or narrower) input, float64 otherwise. Computations are
+        done in float64, one chunk at a time.
+
+    """
+    values = np.asarray(values)
+    flat = values.ravel()
+    p = np.ones(flat.size, dtype=np.result_type(values.dtype, np.float32))
+    for i in range(0, flat.size, chunk_size):
+        v = flat[i:i + chunk_size].astype(np.float64)
+        if map_type == 1:  # t
+            p[i:i + chunk_size] = _betainc(df1 / 2., 0.5, df1 / (df1 + v**2))
+        elif map_type in (2, 3):  # r
+            r2 = np.minimum(v**2, 1. - 1e-12)
+            p[i:i + chunk_size] = _betainc(df1 / 2., 0.5, 1. - r2)
+        elif map_type == 4:  # F
+            f = np.maximum(v, 0.)
+            p[i:i + chunk_size] = _betainc(df2 / 2., df1 / 2.,
+                                           df2 / (df2 + df1 * f))
+        elif map_type == 5:  # z
+            p[i:i + chunk_size] = _erfc(np.abs(v) / math.sqrt(2.))
+        else:
+            raise ValueError("Map type {} has no known null distribution."
+                             .format(map_type))
+    return p.reshape(values.shape)
+
+
+def fdr_qvalues(p):
+    """Benjamini-Hochberg q values of a set of p values.
+
+    Parameters
+    ----------
+    p : numpy.array
+        P values (any shape).
+
+    Returns
+    -------
+    q : numpy.array
+        Adjusted p values, same shape as input.
+
+    """
+    p = np.asarray(p, dtype=np.float64)
+    flat = p.ravel()
+    m = flat.size
+    order = np.argsort(flat, kind="stable")
+    q_sorted = flat[order] * m / np.arange(1, m + 1)
+    q_sorted = np.minimum.accumulate(q_sorted[::-1])[::-1]
+    q = np.empty(m)
+    q[order] = np.minimum(q_sorted, 1.)
+    return q.reshape(p.shape)
+
+
+def _slabs(values, chunk_size):
+    """Flat chunks of an array along its first axis, without a full copy."""
+    if values.ndim == 0:
+        values = values.reshape(1)
+    row_size = max(int(np.prod(values.shape[1:])), 1)
+    step = max(chunk_size // row_size, 1)
+    for i in range(0, values.shape[0], step):
+        yield values[i:i + step].reshape(-1)
+
+
+def _harmonic(m):
+    """Harmonic number sum(1 / k) for k = 1..m."""
+    if m < 2**20:
+        return float(np.sum(1. / np.arange(1, m + 1)))
+    # Asymptotic expansion, exact to float64 precision for large m
+    return math.log(m) + 0.5772156649015329 + 1. / (2 * m) - 1. / (12 * m**2)
+
+
+def fdr_table(values, map_type, df1, df2=0, q_values=FDR_Q_VALUES,
+              chunk_size=2**22):
+    """Compute BrainVoyager FDR table of a statistical map.
+
+    Parameters
+    ----------
+    values : numpy.array
+        Statistical values. Zeros and non-finite values are treated as voxels
+        outside of the analyzed volume.
+    map_type : integer
+        BrainVoyager map code (see `stat_to_p`).
+    df1, df2 : integer
+        Degrees of freedom.
+    q_values : sequence of floats
+        False discovery rate levels.
+    chunk_size : integer
+        Number of values scanned at once. The map is never copied as a
+        whole; only values that can pass the largest q are kept (float32).
+
+    Returns
+    -------
+    table : 2D numpy.array, (nr q values, 3)
+        Columns are q, critical value assuming independence or positive
+        dependence (Benjamini-Hochberg) and critical value without assumptions
+        (conservative, Benjamini-Yekutieli). Critical values are in units of
+        the map statistic. If nothing survives, the critical value is set just
+        above the largest absolute value.
+    nr_used : integer
+        Number of voxels (vertices) used for the correction.
+
+    """
+    values = np.asarray(values)
+    lag_map = map_type == 3  # Only the correlation part of lag maps is tested
+    if lag_map:
+        map_type = 2
+    table = np.zeros((len(q_values), 3), dtype=np.float32)
+    table[:, 0] = q_values
+
+    # NOTE: p values above the largest q can never pass, and p decreases
+    # monotonically with the statistic. Finding the statistic at that p with
+    # a bisection avoids evaluating p values for most of the map.
+    q_max = max(q_values)
+    lo, hi = 0., 1.
+    while stat_to_p(np.array([hi]), map_type, df1, df2)[0] > q_max:
+        lo, hi = hi, hi * 2.
+    for _ in range(50):
+        mid = (lo + hi) / 2.
+        if stat_to_p(np.array([mid]), map_type, df1, df2)[0] > q_max:
+            lo = mid
+        else:
+            hi = mid
+
+    # Single pass over the map: count used values, keep the candidates
+    m, stat_max, candidates = 0, 0., list()
+    for chunk in _slabs(values, chunk_size):
+        chunk = chunk[(chunk != 0) & np.isfinite(chunk)]
+        stat = np.abs(chunk.astype(np.float32))
+        if lag_map:
+            stat %= 1
+        m += stat.size
+        if stat.size > 0:
+            stat_max = max(stat_max, float(stat.max()))
+        candidates.append(stat[stat >= lo])
+    if m == 0:
+        return table, 0
+
+    # Sorting by the statistic sorts the p values (ascending)
+    stat_sorted = np.concatenate(candidates)
+    del candidates
+    stat_sorted.sort()
+    stat_sorted = stat_sorted[::-1]
+    n = stat_sorted.size
+    c_m = _harmonic(m)
+    above_max = np.nextafter(np.float32(stat_max), np.float32(np.inf))
+
+    # NOTE: p values are only computed for the first candidate of each block
+    # of ranks. As p grows with the rank, a block cannot contain a surviving
+    # rank if its first p is above the bound of its last rank. Exact p values
+    # are computed only for blocks that are searched.
+    block = 1024
+    firsts = np.arange(0, n, block)
+    lasts = np.minimum(firsts + block, n)  # 1-based rank of the last entry
+    p_first = stat_to_p(stat_sorted[firsts].astype(np.float64), map_type,
+                        df1, df2)
+    p_blocks = dict()
+
+    def last_survivor(q_level):
+        possible = np.flatnonzero(p_first <= lasts * q_level / m)
+        for b in possible[::-1]:
+            if b not in p_blocks:
+                p_blocks[b] = stat_to_p(
+                    stat_sorted[firsts[b]:lasts[b]].astype(np.float64),
+                    map_type, df1, df2)
+            rank = np.arange(firsts[b] + 1, lasts[b] + 1)
+            survive = np.flatnonzero(p_blocks[b] <= rank * q_level / m)
+            if survive.size > 0:
+                return firsts[b] + survive[-1]
+        return -1
+
+    for i, q in enumerate(q_values):
+        for j, q_level in ((1, q), (2, q / c_m)):
+            k = last_survivor(q_level)
+            table[i, j] = above_max if k < 0 else stat_sorted[k]
+    return table, m
+
+
+# =============================================================================
+# Cluster labeling
+# =============================================================================
+def _find(parent, x):
+    """Roots of the nodes in x (pointer jumping on the whole subset)."""
+    r = parent[x]
+    while True:
+        rr = parent[r]
+        if np.array_equal(rr, r):
+            return r
+        r = rr
+
+
+def _union(parent, a, b):
+    """Merge the sets of each pair of nodes (a[i], b[i]) in place."""
+    while a.size > 0:
+        ra = _find(parent, a)
+        rb = _find(parent, b)
+        parent[a] = ra  # Path compression
+        parent[b] = rb
+        diff = ra != rb
+        if not np.any(diff):
+            break
+        a, b, ra, rb = a[diff], b[diff], ra[diff], rb[diff]
+        # NOTE: Roots always hook to a smaller root, so no cycles can form
+        np.minimum.at(parent, np.maximum(ra, rb), np.minimum(ra, rb))
+
+
+def _relabel(parent):
+    """Consecutive labels (starting at 1) from a union-find forest."""
+    roots = _find(parent, np.arange(parent.size))
+    _, labels = np.unique(roots, return_inverse=True)
+    return labels.astype(np.int32) + 1
+
+
+def _mask_runs(mask, chunk_size):
+    """Runs of nonzero voxels along the last axis of a 3D mask.
+
+    Returns row index (z * DimY + y), start and end (exclusive) of each run,
+    sorted by row and start.
+    """
+    dims = mask.shape
+    rows, starts, ends = [], [], []
+    for z0 in range(0, dims[0], chunk_size):
+        sub = mask[z0:z0 + chunk_size].reshape(-1, dims[2]).view(np.int8)
+        edges = np.diff(sub, prepend=0, append=0, axis=1)
+        r, s = np.nonzero(edges == 1)
+        _, e = np.nonzero(edges == -1)
+        rows.append(r + z0 * dims[1])
+        starts.append(s)
+        ends.append(e)
+    return np.concatenate(rows), np.concatenate(starts), np.concatenate(ends)
+
+
+def label_clusters(mask, connectivity=26, chunk_size=32):
+    """Label connected components of a 3D mask.
+
+    Parameters
+    ----------
+    mask : 3D numpy.array
+        Voxels to be clustered (nonzero).
+    connectivity : integer, 6, 18 or 26
+        Voxel neighborhood.
+    chunk_size : integer
+        Number of slices along the first axis processed at once. Temporary
+        memory scales with the chunk, not the volume.
+
+    Returns
+    -------
+    labels : 3D numpy.array, int32
+        Cluster labels. 0 is background, clusters start from 1.
+    sizes : 1D numpy.array
+        Number of voxels in each cluster (index with labels, sizes[0] = 0).
+
+    Notes
+    -----
+    Voxels are first merged into runs along the last axis. Runs of
+    neighboring rows are then joined with a vectorized union-find, so the
+    cost scales with the number of runs instead of the number of voxels.
+
+    """
+    if connectivity not in _ROW_NEIGHBORS:
+        raise ValueError("Connectivity must be 6, 18 or 26.")
+    mask = np.asarray(mask) != 0
+    dims = mask.shape
+    labels = np.zeros(dims, dtype=np.int32)
+    rows, starts, ends = _mask_runs(mask, chunk_size)
+    if rows.size == 0:
+        return labels, np.zeros(1, dtype=np.int64)
+
+    # Sorted keys allow finding all overlapping runs of a row with a search
+    width = dims[2] + 2
+    key_start = rows.astype(np.int64) * width + starts
+    key_end = rows.astype(np.int64) * width + ends
+    y = rows % dims[1]
+    z = rows // dims[1]
+    parent = np.arange(rows.size, dtype=np.int64)
+    runs_per_chunk = chunk_size * dims[1] * 8
+    for i0 in range(0, rows.size, runs_per_chunk):
+        i1 = min(i0 + runs_per_chunk, rows.size)
+        edges_a, edges_b = [], []
+        for dz, dy, ext in _ROW_NEIGHBORS[connectivity]:
+            valid = ((z[i0:i1] + dz < dims[0]) & (y[i0:i1] + dy >= 0)
+                     & (y[i0:i1] + dy < dims[1]))
+            run = np.flatnonzero(valid) + i0
+            target = (rows[run] + dz * dims[1] + dy).astype(np.int64) * width
+            lo = np.searchsorted(key_end, target + starts[run] - ext,
+                                 side="right")
+            hi = np.searchsorted(key_start, target + ends[run] + ext,
+                                 side="left")
+            count = np.maximum(hi - lo, 0)
+            a = np.repeat(run, count)
+            b = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count,
+                                                   count)
+            edges_a.append(a)
+            edges_b.append(np.repeat(lo, count) + b)
+        _union(parent, np.concatenate(edges_a), np.concatenate(edges_b))
+
+    run_labels = _relabel(parent)
+    lengths = ends - starts
+    labels[mask] = np.repeat(run_labels, lengths)
+    sizes = np.bincount(run_labels, weights=lengths).astype(np.int64)
+    return labels, sizes
+
+
+def label_clusters_mesh(mask, mesh_data):
+    """Label connected components of a vertex mask on a triangular mesh.
+
+    Parameters
+    ----------
+    mask : 1D numpy.array, (nr_vertices)
+        Vertices to be clustered (nonzero).
+    mesh_data : dictionary
+        Mesh data as returned by `bvbabel.srf.read_srf`. Vertex neighborhood
+        is derived from "faces".
+
+    Returns
+    -------
+    labels : 1D numpy.array, int32
+        Cluster labels. 0 is background, clusters start from 1.
+    sizes : 1D numpy.array
+        Number of vertices in each cluster (index with labels, sizes[0] = 0).
+
+    """
+    mask = np.asarray(mask) != 0
+    faces = np.asarray(mesh_data["faces"], dtype=np.int64)
+    index = np.full(mask.size, -1, dtype=np.int64)
+    index[mask] = np.arange(np.count_nonzero(mask))
+
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]],
+                            faces[:, [2, 0]]])
+    a, b = index[edges[:, 0]], index[edges[:, 1]]
+    keep = (a >= 0) & (b >= 0)
+    parent = np.arange(np.count_nonzero(mask), dtype=np.int64)
+    _union(parent, a[keep], b[keep])
+
+    labels = np.zeros(mask.size, dtype=np.int32)
+    labels[mask] = _relabel(parent)
+    return labels, np.bincount(labels[mask], minlength=1)
+
+
+def _cluster_filter(values, threshold, cluster_size, label_function):
+    """Zero values below threshold or in clusters smaller than cluster_size.
+
+    Positive and negative values are clustered separately.
+    """
+    out = np.where(np.abs(values) >= threshold, values, 0).astype(np.float32)
+    if cluster_size > 1:
+        for sign_mask in (out > 0, out < 0):
+            labels, sizes = label_function(sign_mask)
+            out[(sizes < cluster_size)[labels] & sign_mask] = 0
+    return out
+
+
+# =============================================================================
+# Map level thresholding
+# =============================================================================
+def threshold_vmp(header, data_img, q=0.05, cluster_size=0, connectivity=26,
+                  q_values=FDR_Q_VALUES):
+    """Compute FDR tables and cluster thresholds of VMP maps.
+
+    Parameters
+    ----------
+    header : dictionary
+        VMP header as returned by `bvbabel.vmp.read_vmp`. FDR table, used
+        voxel count, map threshold and cluster size entries of each map are
+        updated in place.
+    data_img : 3D or 4D numpy.array
+        VMP data. Maps are along the 4th axis if there are multiple maps.
+    q : float
+        FDR level used to set "MapThreshold". Must be one of `q_values`.
+    cluster_size : integer
+        Minimum number of voxels of a cluster. 0 disables cluster thresholds.
+    connectivity : integer, 6, 18 or 26
+        Voxel neighborhood used for clustering.
+    q_values : sequence of floats
+        FDR levels stored in the FDR table.
+
+    Returns
+    -------
+    header : dictionary
+        Updated VMP header.
+    data_thr : 3D or 4D numpy.array, float32
+        Maps with subthreshold voxels and small clusters set to zero.
+
+    """
+    q_index = list(q_values).index(q)
+    data_thr = np.zeros(data_img.shape, dtype=np.float32)
+
+    def label_function(mask):
+        return label_clusters(mask, connectivity)
+
+    for m in range(header["NrOfSubMaps"]):
+        info = header["Map"][m]
+        values = data_img[..., m] if data_img.ndim == 4 else data_img
+        if info["TypeOfMap"] == 3 and data_img.ndim == 4 \
+                and header["NrOfSubMaps"] == 1:
+            values = data_img[..., 0] + data_img[..., 1]  # lag + correlation
+        table, nr_used = fdr_table(values, info["TypeOfMap"], info["DF1"],
+                                   info["DF2"], q_values)
+        info["NrOfUsedVoxels"] = nr_used
+        info["SizeOfFDRTable"] = len(q_values)
+        info["FDRTableInfo"] = table
+        info["UseFDRTableIndex"] = q_index
+        info["MapThreshold"] = table[q_index, 1]
+        info["ClusterSizeThreshold"] = max(int(cluster_size), 1)
+        info["EnableClusterSizeThreshold"] = int(cluster_size > 1)
+
+        stat = values % 1 if info["TypeOfMap"] == 3 else values
+        thr = _cluster_filter(stat, table[q_index, 1], cluster_size,
+                              label_function)
+        if data_img.ndim == 4 and header["NrOfSubMaps"] > 1:
+            data_thr[..., m] = thr
+        elif data_img.ndim == 4:  # Lag map stored as (lag, correlation)
+            data_thr[..., 0] = np.where(thr != 0, data_img[..., 0], 0)
+            data_thr[..., 1] = thr
+        else:
+            data_thr[...] = thr
+    return header, data_thr
+
+
+def threshold_smp(header, data_smp, mesh_data, q=0.05, cluster_size=0,
+                  q_values=FDR_Q_VALUES):
+    """Compute FDR and cluster thresholds of SMP maps.
+
+    Parameters
+    ----------
+    header : dictionary
+        SMP header as returned by `bvbabel.smp.read_smp`. "Threshold min",
+        "Cluster size" and "Cluster checkbox" of each map are updated in
+        place.
+    data_smp : 2D numpy.array, (nr vertices, nr maps)
+        SMP data.
+    mesh_data : dictionary
+        Mesh data of the SRF the SMP belongs to (`bvbabel.srf.read_srf`).
+    q : float
+        FDR level (critical value assuming positive dependence).
+    cluster_size : integer
+        Minimum number of vertices of a cluster. 0 disables cluster
+        thresholds.
+    q_values : sequence of floats
+        FDR levels evaluated.
+
+    Returns
+    -------
+    header : dictionary
+        Updated SMP header.
+    data_thr : 2D numpy.array, float32
+        Maps with subthreshold vertices and small clusters set to zero.
+    fdr_tables : list of 2D numpy.arrays
+        FDR table of each map (see `fdr_table`). SMP files do not store them.
+
+    """
+    q_index = list(q_values).index(q)
+    data_thr = np.zeros(data_smp.shape, dtype=np.float32)
+    fdr_tables = []
+
+    def label_function(mask):
+        return label_clusters_mesh(mask, mesh_data)
+
+    for m in range(header["Nr maps"]):
+        info = header["Map"][m]
+        table, nr_used = fdr_table(data_smp[:, m], info["Map type"],
+                                   info["Degrees of freedom 1"],
+                                   info["Degrees of freedom 2"], q_values)
+        fdr_tables.append(table)
+        info["Threshold min"] = table[q_index, 1]
+        info["Cluster size"] = max(int(cluster_size), 1)
+        info["Cluster checkbox"] = int(cluster_size > 1)
+
+        data_thr[:, m] = _cluster_filter(data_smp[:, m], table[q_index, 1],
+                                         cluster_size, label_function)
+    return header, data_thr, fdr_tables
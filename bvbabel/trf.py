@@ -161,3 +161,33 @@ def write_trf(filename, header, data):
             f.write('ACPCVMRVoxelRes:' + '\t' +
                     str(header["ACPCVMRVoxelRes"]) + '\n\n')
         f.close()  # officially not required
+
+
+def compose_trfs(*data_trfs):
+    """Compose transformations of a processing chain into a single affine.
+
+    Parameters
+    ----------
+    data_trfs : TRF data dictionaries or 4x4 numpy.arrays
+        Transformations (see `read_trf`) in processing order, e.g. FMR-VMR
+        initial alignment, fine alignment, ACPC and MNI. Each "Matrix" maps
+        coordinates of its target space to its source space, the direction
+        BrainVoyager uses for resampling. An "ExtraVMRTransf" matrix is
+        applied before "Matrix".
+
+    Returns
+    -------
+    matrix : 2D numpy.array, (4, 4)
+        Maps coordinates of the last target space to the first source space.
+
+    """
+    matrix = np.eye(4)
+    for data in data_trfs:
+        if isinstance(data, dict):
+            step = np.asarray(data["Matrix"], dtype=float)
+            if "ExtraVMRTransf" in data:
+                step = step @ np.asarray(data["ExtraVMRTransf"], dtype=float)
+        else:
+            step = np.asarray(data, dtype=float)
+        matrix = matrix @ step
+    return matrix
@@ -41,6 +41,11 @@ def write_RGB_bytes(f, RGB):
         f.write(struct.pack('<B', RGB[i]))
 
 
+def label_color(value):
+    """Fixed pseudo-random RGB color of a label value, e.g. a VOI or POI."""
+    return np.random.RandomState(int(value) % 2**32).randint(0, 256, 3)
+
+
 def read_float_array(f, nr_floats):
     r"""Read multiple floats into 1D numpy array."""
     out_data = np.zeros(nr_floats, dtype=np.float)
@@ -48,3 +53,223 @@ def read_float_array(f, nr_floats):
         data, = struct.unpack('<f', f.read(4))
         out_data[i] = data
     return out_data
+
+
+def csr_from_triplets(rows, cols, values, shape):
+    """Build compressed sparse row arrays from (row, column, value) triplets.
+
+    Duplicate (row, column) entries are summed.
+
+    Parameters
+    ----------
+    rows : 1D numpy.array, int
+        Row index of each entry.
+    cols : 1D numpy.array, int
+        Column index of each entry.
+    values : 1D numpy.array
+        Value of each entry.
+    shape : tuple of two integers
+        Number of rows and columns.
+
+    Returns
+    -------
+    indptr : 1D numpy.array, int64, (nr rows + 1)
+        Row start offsets into `indices` and `data`.
+    indices : 1D numpy.array, int32
+        Column indices sorted within each row.
+    data : 1D numpy.array, float64
+        Entry values.
+
+    """
+    key = np.asarray(rows, dtype=np.int64) * shape[1] + np.asarray(cols)
+    key, inverse = np.unique(key, return_inverse=True)
+    data = np.bincount(inverse.ravel(), weights=np.ravel(values),
+                       minlength=key.size)
+    indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(key // shape[1], minlength=shape[0]),
+              out=indptr[1:])
+    return indptr, (key % shape[1]).astype(np.int32), data
+
+
+def csr_reduce(indptr, values, ufunc=np.add, fill=0):
+    """Reduce gathered per-entry values row by row.
+
+    Parameters
+    ----------
+    indptr : 1D numpy.array, int
+        Row start offsets of a compressed sparse row matrix.
+    values : numpy.array, (nr entries, ...)
+        One value (or row of values) per stored entry.
+    ufunc : numpy.ufunc
+        Reduction, e.g. numpy.add, numpy.maximum or numpy.minimum.
+    fill : float
+        Output value of rows without entries.
+
+    Returns
+    -------
+    out : numpy.array, (nr rows, ...)
+
+    """
+    nonempty = indptr[1:] > indptr[:-1]
+    out = np.full((indptr.size - 1,) + values.shape[1:], fill,
+                  dtype=values.dtype)
+    if values.shape[0] > 0:
+        out[nonempty] = ufunc.reduceat(values, indptr[:-1][nonempty], axis=0)
+    return out
+
+
+def csr_dot(indptr, indices, data, x, chunk_size=2**23):
+    """Multiply a compressed sparse row matrix with a dense array.
+
+    Parameters
+    ----------
+    indptr, indices, data : 1D numpy.arrays
+        Compressed sparse row matrix (see `csr_from_triplets`).
+    x : 1D or 2D numpy.array, (nr columns, ...)
+        Dense vector or matrix, e.g. all maps or time points at once.
+    chunk_size : integer
+        Upper limit of temporary elements. Rows are processed in blocks.
+
+    Returns
+    -------
+    out : 1D or 2D numpy.array, (nr rows, ...)
+        Result with the precision of `x` (at least float32).
+
+    """
+    dtype = np.result_type(x.dtype, np.float32)
+    nr_rows = indptr.size - 1
+    width = int(np.prod(x.shape[1:]))
+    lengths = np.diff(indptr)
+    max_length = int(lengths.max()) if nr_rows > 0 else 0
+    out = np.zeros((nr_rows,) + x.shape[1:], dtype=dtype)
+    data = data.astype(dtype, copy=False)
+    expand = (slice(None),) + (None,) * (x.ndim - 1)
+
+    if max_length * nr_rows <= 2 * indices.size:
+        # Nearly constant row lengths (e.g. mesh neighbors, interpolation
+        # weights): accumulate one entry per row at a time so that each step
+        # gathers whole contiguous rows of x.
+        slots = np.arange(indices.size) - np.repeat(indptr[:-1], lengths)
+        rows = np.repeat(np.arange(nr_rows), lengths)
+        cols = np.zeros((max_length, nr_rows), dtype=np.int64)
+        weights = np.zeros((max_length, nr_rows), dtype=dtype)
+        cols[slots, rows] = indices
+        weights[slots, rows] = data
+        step = max(chunk_size // max(width, 1), 1)
+        for i in range(0, nr_rows, step):
+            j = min(i + step, nr_rows)
+            for k in range(max_length):
+                temp = x[cols[k, i:j]].astype(dtype, copy=False)
+                temp *= weights[k, i:j][expand]
+                out[i:j] += temp
+        return out
+
+    step = max(chunk_size // max(width * max(max_length, 1), 1), 1)
+    for i in range(0, nr_rows, step):
+        j = min(i + step, nr_rows)
+        a, b = indptr[i], indptr[j]
+        temp = x[indices[a:b]].astype(dtype, copy=False)
+        temp *= data[a:b][expand]
+        out[i:j] = csr_reduce(indptr[i:j + 1] - a, temp)
+    return out
+
+
+def csr_submatrix(indptr, indices, data, idx):
+    """Restrict a square compressed sparse row matrix to a subset of rows.
+
+    Parameters
+    ----------
+    indptr, indices, data : 1D numpy.arrays
+        Compressed sparse row matrix (see `csr_from_triplets`).
+    idx : 1D numpy.array, int
+        Sorted unique row (and column) indices to keep.
+
+    Returns
+    -------
+    indptr, indices, data : 1D numpy.arrays
+        Submatrix in local indices, i.e. position within `idx`. Entries of
+        columns outside `idx` are dropped.
+
+    """
+    lengths = indptr[idx + 1] - indptr[idx]
+    offsets = np.cumsum(lengths) - lengths
+    pos = (np.arange(lengths.sum()) - np.repeat(offsets, lengths)
+           + np.repeat(indptr[idx], lengths))
+    local = np.full(indptr.size - 1, -1, dtype=np.int64)
+    local[idx] = np.arange(idx.size)
+    cols = local[indices[pos]]
+    keep = cols >= 0
+    rows = np.repeat(np.arange(idx.size), lengths)[keep]
+    sub_indptr = np.zeros(idx.size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=idx.size), out=sub_indptr[1:])
+    return sub_indptr, cols[keep].astype(np.int32), data[pos][keep]
+
+
+def trilinear_weights(coords, shape):
+    """Trilinear interpolation corners and weights of continuous coordinates.
+
+    Parameters
+    ----------
+    coords : 2D numpy.array, (nr points, 3)
+        Continuous voxel indices along the three axes of a grid.
+    shape : tuple of three integers
+        Grid dimensions.
+
+    Returns
+    -------
+    corners : 3D numpy.array, int64, (nr points, 8, 3)
+        Voxel indices of the eight surrounding grid points, clipped into the
+        grid.
+    weights : 2D numpy.array, (nr points, 8)
+        Interpolation weights. Corners outside of the grid get zero weight.
+
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    base = np.floor(coords).astype(np.int64)
+    frac = coords - base
+    corners = np.zeros((coords.shape[0], 8, 3), dtype=np.int64)
+    weights = np.ones((coords.shape[0], 8))
+    for c in range(8):
+        for a in range(3):
+            step = (c >> a) & 1
+            corners[:, c, a] = base[:, a] + step
+            weights[:, c] *= frac[:, a] if step else 1 - frac[:, a]
+    inside = np.all((corners >= 0) & (corners < np.asarray(shape)), axis=2)
+    weights[~inside] = 0
+    np.clip(corners, 0, np.asarray(shape) - 1, out=corners)
+    return corners, weights
+
+
+def trilinear_sample(data, coords, fill=0.):
+    """Sample a 3D array at continuous voxel coordinates.
+
+    Parameters
+    ----------
+    data : 3D numpy.array
+        Image.
+    coords : 2D numpy.array, (nr points, 3)
+        Continuous voxel indices along the three axes of `data`.
+    fill : float
+        Value of points outside of the grid.
+
+    Returns
+    -------
+    values : 1D numpy.array, float32 or float64, (nr points)
+        Interpolated values.
+    inside : 1D numpy.array, bool, (nr points)
+        Points within the grid.
+
+    """
+    shape = np.asarray(data.shape)
+    coords = np.asarray(coords, dtype=np.float64)
+    inside = np.all((coords >= 0) & (coords <= shape - 1), axis=1)
+    corners, weights = trilinear_weights(coords, shape)
+    strides = np.array([shape[1] * shape[2], shape[2], 1])
+
+    flat = np.ravel(data)
+    dtype = np.result_type(data.dtype, np.float32)
+    values = np.zeros(coords.shape[0], dtype=dtype)
+    for c in range(8):
+        values += weights[:, c].astype(dtype) * flat[corners[:, c] @ strides]
+    values[~inside] = fill
+    return values, inside
@@ -72,6 +72,45 @@ def read_v16(filename):
     return header, data_img
 
 
+# =============================================================================
+def open_v16(filename, mode="r"):
+    """Open BrainVoyager V16 file as a memory map.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    mode : string
+        numpy.memmap mode, "r" for reading, "r+" for modifying in place.
+
+    Returns
+    -------
+    header : dictionary
+        Pre-data header.
+    data : 3D numpy.memmap
+        Image data in the same orientation as `read_v16`. This is a strided
+        view on the file, only the accessed voxels are read from disk. Use
+        numpy.array(data) to load it into memory.
+
+    """
+    header = dict()
+    with open(filename, 'rb') as f:
+        # Expected binary data: unsigned short int (2 bytes)
+        data, = struct.unpack('<H', f.read(2))
+        header["DimX"] = data
+        data, = struct.unpack('<H', f.read(2))
+        header["DimY"] = data
+        data, = struct.unpack('<H', f.read(2))
+        header["DimZ"] = data
+
+    dims = (header["DimZ"], header["DimY"], header["DimX"])
+    data_img = np.memmap(filename, dtype='<H', mode=mode, offset=6,
+                         shape=dims)
+    data_img = np.transpose(data_img, (0, 2, 1))  # BV to Tal
+    data_img = data_img[::-1, ::-1, ::-1]  # Flip BV axes
+    return header, data_img
+
+
 # =============================================================================
 def write_v16(filename, header, data_img):
     """Protocol to write BrainVoyager V16 file.
@@ -1,9 +1,270 @@
 """Read, write, create BrainVoyager VMR file format."""
 
 import struct
+import contextlib
 import numpy as np
 from bvbabel.utils import (read_variable_length_string,
                            write_variable_length_string)
+from bvbabel.v16 import open_v16
+
+
+# =============================================================================
+def _read_vmr_post_header(f, header):
+    """Read VMR post-data header entries from an open file into header."""
+    if header["File version"] >= 3:
+        # NOTE(Developer Guide 2.6): These four entries have been added in
+        # file version "3" with BrainVoyager QX 1.7. All other entries are
+        # identical to file version "2".
+
+        # Expected binary data: short int (2 bytes)
+        data, = struct.unpack('<h', f.read(2))
+        header["OffsetX"] = data
+        data, = struct.unpack('<h', f.read(2))
+        header["OffsetY"] = data
+        data, = struct.unpack('<h', f.read(2))
+        header["OffsetZ"] = data
+        data, = struct.unpack('<h', f.read(2))
+        header["FramingCubeDim"] = data
+
+    # Expected binary data: int (4 bytes)
+    data, = struct.unpack('<i', f.read(4))
+    header["PosInfosVerified"] = data
+    data, = struct.unpack('<i', f.read(4))
+    header["CoordinateSystem"] = data
+
+    # Expected binary data: float (4 bytes)
+    data, = struct.unpack('<f', f.read(4))
+    header["Slice1CenterX"] = data  # First slice center X coordinate
+    data, = struct.unpack('<f', f.read(4))
+    header["Slice1CenterY"] = data  # First slice center Y coordinate
+    data, = struct.unpack('<f', f.read(4))
+    header["Slice1CenterZ"] = data  # First slice center Z coordinate
+    data, = struct.unpack('<f', f.read(4))
+    header["SliceNCenterX"] = data  # Last slice center X coordinate
+    data, = struct.unpack('<f', f.read(4))
+    header["SliceNCenterY"] = data  # Last slice center Y coordinate
+    data, = struct.unpack('<f', f.read(4))
+    header["SliceNCenterZ"] = data  # Last slice center Z coordinate
+    data, = struct.unpack('<f', f.read(4))
+    header["RowDirX"] = data  # Slice row direction vector X component
+    data, = struct.unpack('<f', f.read(4))
+    header["RowDirY"] = data  # Slice row direction vector Y component
+    data, = struct.unpack('<f', f.read(4))
+    header["RowDirZ"] = data  # Slice row direction vector Z component
+    data, = struct.unpack('<f', f.read(4))
+    header["ColDirX"] = data  # Slice column direction vector X component
+    data, = struct.unpack('<f', f.read(4))
+    header["ColDirY"] = data  # Slice column direction vector Y component
+    data, = struct.unpack('<f', f.read(4))
+    header["ColDirZ"] = data  # Slice column direction vector Z component
+
+    # Expected binary data: int (4 bytes)
+    data, = struct.unpack('<i', f.read(4))
+    header["NRows"] = data  # Nr of rows of slice image matrix
+    data, = struct.unpack('<i', f.read(4))
+    header["NCols"] = data  # Nr of columns of slice image matrix
+
+    # Expected binary data: float (4 bytes)
+    data, = struct.unpack('<f', f.read(4))
+    header["FoVRows"] = data  # Field of view extent in row direction [mm]
+    data, = struct.unpack('<f', f.read(4))
+    header["FoVCols"] = data  # Field of view extent in column dir. [mm]
+    data, = struct.unpack('<f', f.read(4))
+    header["SliceThickness"] = data  # Slice thickness [mm]
+    data, = struct.unpack('<f', f.read(4))
+    header["GapThickness"] = data  # Gap thickness [mm]
+
+    # Expected binary data: int (4 bytes)
+    data, = struct.unpack('<i', f.read(4))
+    header["NrOfPastSpatialTransformations"] = data
+
+    if header["NrOfPastSpatialTransformations"] != 0:
+        # NOTE(Developer Guide 2.6): For each past transformation, the
+        # information specified in the following table is stored. The
+        # "type of transformation" is a value determining how many
+        # subsequent values define the transformation:
+        #   "1": Rigid body+scale (3 translation, 3 rotation, 3 scale)
+        #   "2": Affine transformation (16 values, 4x4 matrix)
+        #   "4": Talairach transformation
+        #   "5": Un-Talairach transformation (1 - 5 -> BV axes)
+        header["PastTransformation"] = []
+        for i in range(header["NrOfPastSpatialTransformations"]):
+            header["PastTransformation"].append(dict())
+
+            # Expected binary data: variable-length string
+            data = read_variable_length_string(f)
+            header["PastTransformation"][i]["Name"] = data
+
+            # Expected binary data: int (4 bytes)
+            data, = struct.unpack('<i', f.read(4))
+            header["PastTransformation"][i]["Type"] = data
+
+            # Expected binary data: variable-length string
+            data = read_variable_length_string(f)
+            header["PastTransformation"][i]["SourceFileName"] = data
+
+            # Expected binary data: int (4 bytes)
+            data, = struct.unpack('<i', f.read(4))
+            header["PastTransformation"][i]["NrOfValues"] = data
+
+            # Store transformation values as a list
+            trans_values = []
+            for j in range(header["PastTransformation"][i]["NrOfValues"]):
+                # Expected binary data: float (4 bytes)
+                data, = struct.unpack('<f', f.read(4))
+                trans_values.append(data)
+            header["PastTransformation"][i]["Values"] = trans_values
+
+    # Expected binary data: char (1 byte)
+    data, = struct.unpack('<B', f.read(1))
+    header["LeftRightConvention"] = data  # modified in v4
+
+    if header["File version"] >= 4:
+        data, = struct.unpack('<B', f.read(1))
+        header["ReferenceSpaceVMR"] = data  # new in v4
+
+    # Expected binary data: float (4 bytes)
+    data, = struct.unpack('<f', f.read(4))
+    header["VoxelSizeX"] = data  # Voxel resolution along X axis
+    data, = struct.unpack('<f', f.read(4))
+    header["VoxelSizeY"] = data  # Voxel resolution along Y axis
+    data, = struct.unpack('<f', f.read(4))
+    header["VoxelSizeZ"] = data  # Voxel resolution along Z axis
+
+    # Expected binary data: char (1 byte)
+    data, = struct.unpack('<B', f.read(1))
+    header["VoxelResolutionVerified"] = data
+    data, = struct.unpack('<B', f.read(1))
+    header["VoxelResolutionInTALmm"] = data
+
+    # Expected binary data: int (4 bytes)
+    data, = struct.unpack('<i', f.read(4))
+    header["VMROrigV16MinValue"] = data  # 16-bit data min intensity
+    data, = struct.unpack('<i', f.read(4))
+    header["VMROrigV16MeanValue"] = data  # 16-bit data mean intensity
+    data, = struct.unpack('<i', f.read(4))
+    header["VMROrigV16MaxValue"] = data  # 16-bit data max intensity
+
+
+# =============================================================================
+def _write_vmr_post_header(f, header):
+    """Write VMR post-data header entries to an open file."""
+    if header["File version"] >= 3:
+        # Expected binary data: short int (2 bytes)
+        data = header["OffsetX"]
+        f.write(struct.pack('<h', data))
+        data = header["OffsetY"]
+        f.write(struct.pack('<h', data))
+        data = header["OffsetZ"]
+        f.write(struct.pack('<h', data))
+        data = header["FramingCubeDim"]
+        f.write(struct.pack('<h', data))
+
+    # Expected binary data: int (4 bytes)
+    data = header["PosInfosVerified"]
+    f.write(struct.pack('<i', data))
+    data = header["CoordinateSystem"]
+    f.write(struct.pack('<i', data))
+
+    # Expected binary data: float (4 bytes)
+    data = header["Slice1CenterX"]
+    f.write(struct.pack('<f', data))
+    data = header["Slice1CenterY"]
+    f.write(struct.pack('<f', data))
+    data = header["Slice1CenterZ"]
+    f.write(struct.pack('<f', data))
+    data = header["SliceNCenterX"]
+    f.write(struct.pack('<f', data))
+    data = header["SliceNCenterY"]
+    f.write(struct.pack('<f', data))
+    data = header["SliceNCenterZ"]
+    f.write(struct.pack('<f', data))
+    data = header["RowDirX"]
+    f.write(struct.pack('<f', data))
+    data = header["RowDirY"]
+    f.write(struct.pack('<f', data))
+    data = header["RowDirZ"]
+    f.write(struct.pack('<f', data))
+    data = header["ColDirX"]
+    f.write(struct.pack('<f', data))
+    data = header["ColDirY"]
+    f.write(struct.pack('<f', data))
+    data = header["ColDirZ"]
+    f.write(struct.pack('<f', data))
+
+    # Expected binary data: int (4 bytes)
+    data = header["NRows"]
+    f.write(struct.pack('<i', data))
+    data = header["NCols"]
+    f.write(struct.pack('<i', data))
+
+    # Expected binary data: float (4 bytes)
+    data = header["FoVRows"]
+    f.write(struct.pack('<f', data))
+    data = header["FoVCols"]
+    f.write(struct.pack('<f', data))
+    data = header["SliceThickness"]
+    f.write(struct.pack('<f', data))
+    data = header["GapThickness"]
+    f.write(struct.pack('<f', data))
+
+    # Expected binary data: int (4 bytes)
+    data = header["NrOfPastSpatialTransformations"]
+    f.write(struct.pack('<i', data))
+
+    if header["NrOfPastSpatialTransformations"] != 0:
+        for i in range(header["NrOfPastSpatialTransformations"]):
+            # Expected binary data: variable-length string
+            data = header["PastTransformation"][i]["Name"]
+            write_variable_length_string(f, data)
+
+            # Expected binary data: int (4 bytes)
+            data = header["PastTransformation"][i]["Type"]
+            f.write(struct.pack('<i', data))
+
+            # Expected binary data: variable-length string
+            data = header["PastTransformation"][i]["SourceFileName"]
+            write_variable_length_string(f, data)
+
+            # Expected binary data: int (4 bytes)
+            data = header["PastTransformation"][i]["NrOfValues"]
+            f.write(struct.pack('<i', data))
+
+            # Transformation values are stored as a list
+            trans_values = header["PastTransformation"][i]["Values"]
+            for j in range(header["PastTransformation"][i]["NrOfValues"]):
+                # Expected binary data: float (4 bytes)
+                f.write(struct.pack('<f', trans_values[j]))
+
+    # Expected binary data: char (1 byte)
+    data = header["LeftRightConvention"]
+    f.write(struct.pack('<B', data))
+
+    if header["File version"] >= 4:
+        data = header["ReferenceSpaceVMR"]
+        f.write(struct.pack('<B', data))
+
+    # Expected binary data: float (4 bytes)
+    data = header["VoxelSizeX"]
+    f.write(struct.pack('<f', data))
+    data = header["VoxelSizeY"]
+    f.write(struct.pack('<f', data))
+    data = header["VoxelSizeZ"]
+    f.write(struct.pack('<f', data))
+
+    # Expected binary data: char (1 byte)
+    data = header["VoxelResolutionVerified"]
+    f.write(struct.pack('<B', data))
+    data = header["VoxelResolutionInTALmm"]
+    f.write(struct.pack('<B', data))
+
+    # Expected binary data: int (4 bytes)
+    data = header["VMROrigV16MinValue"]
+    f.write(struct.pack('<i', data))
+    data = header["VMROrigV16MeanValue"]
+    f.write(struct.pack('<i', data))
+    data = header["VMROrigV16MaxValue"]
+    f.write(struct.pack('<i', data))
 
 
 # =============================================================================
@@ -104,143 +365,173 @@ def read_vmr(filename):
         # left-right convention, the reference space (e.g. Talairach after
         # normalization) and voxel resolution.
 
-        if header["File version"] >= 3:
-            # NOTE(Developer Guide 2.6): These four entries have been added in
-            # file version "3" with BrainVoyager QX 1.7. All other entries are
-            # identical to file version "2".
-
-            # Expected binary data: short int (2 bytes)
-            data, = struct.unpack('<h', f.read(2))
-            header["OffsetX"] = data
-            data, = struct.unpack('<h', f.read(2))
-            header["OffsetY"] = data
-            data, = struct.unpack('<h', f.read(2))
-            header["OffsetZ"] = data
-            data, = struct.unpack('<h', f.read(2))
-            header["FramingCubeDim"] = data
-
-        # Expected binary data: int (4 bytes)
-        data, = struct.unpack('<i', f.read(4))
-        header["PosInfosVerified"] = data
-        data, = struct.unpack('<i', f.read(4))
-        header["CoordinateSystem"] = data
-
-        # Expected binary data: float (4 bytes)
-        data, = struct.unpack('<f', f.read(4))
-        header["Slice1CenterX"] = data  # First slice center X coordinate
-        data, = struct.unpack('<f', f.read(4))
-        header["Slice1CenterY"] = data  # First slice center Y coordinate
-        data, = struct.unpack('<f', f.read(4))
-        header["Slice1CenterZ"] = data  # First slice center Z coordinate
-        data, = struct.unpack('<f', f.read(4))
-        header["SliceNCenterX"] = data  # Last slice center X coordinate
-        data, = struct.unpack('<f', f.read(4))
-        header["SliceNCenterY"] = data  # Last slice center Y coordinate
-        data, = struct.unpack('<f', f.read(4))
-        header["SliceNCenterZ"] = data  # Last slice center Z coordinate
-        data, = struct.unpack('<f', f.read(4))
-        header["RowDirX"] = data  # Slice row direction vector X component
-        data, = struct.unpack('<f', f.read(4))
-        header["RowDirY"] = data  # Slice row direction vector Y component
-        data, = struct.unpack('<f', f.read(4))
-        header["RowDirZ"] = data  # Slice row direction vector Z component
-        data, = struct.unpack('<f', f.read(4))
-        header["ColDirX"] = data  # Slice column direction vector X component
-        data, = struct.unpack('<f', f.read(4))
-        header["ColDirY"] = data  # Slice column direction vector Y component
-        data, = struct.unpack('<f', f.read(4))
-        header["ColDirZ"] = data  # Slice column direction vector Z component
-
-        # Expected binary data: int (4 bytes)
-        data, = struct.unpack('<i', f.read(4))
-        header["NRows"] = data  # Nr of rows of slice image matrix
-        data, = struct.unpack('<i', f.read(4))
-        header["NCols"] = data  # Nr of columns of slice image matrix
-
-        # Expected binary data: float (4 bytes)
-        data, = struct.unpack('<f', f.read(4))
-        header["FoVRows"] = data  # Field of view extent in row direction [mm]
-        data, = struct.unpack('<f', f.read(4))
-        header["FoVCols"] = data  # Field of view extent in column dir. [mm]
-        data, = struct.unpack('<f', f.read(4))
-        header["SliceThickness"] = data  # Slice thickness [mm]
-        data, = struct.unpack('<f', f.read(4))
-        header["GapThickness"] = data  # Gap thickness [mm]
-
-        # Expected binary data: int (4 bytes)
-        data, = struct.unpack('<i', f.read(4))
-        header["NrOfPastSpatialTransformations"] = data
-
-        if header["NrOfPastSpatialTransformations"] != 0:
-            # NOTE(Developer Guide 2.6): For each past transformation, the
-            # information specified in the following table is stored. The
-            # "type of transformation" is a value determining how many
-            # subsequent values define the transformation:
-            #   "1": Rigid body+scale (3 translation, 3 rotation, 3 scale)
-            #   "2": Affine transformation (16 values, 4x4 matrix)
-            #   "4": Talairach transformation
-            #   "5": Un-Talairach transformation (1 - 5 -> BV axes)
-            header["PastTransformation"] = []
-            for i in range(header["NrOfPastSpatialTransformations"]):
-                header["PastTransformation"].append(dict())
-
-                # Expected binary data: variable-length string
-                data = read_variable_length_string(f)
-                header["PastTransformation"][i]["Name"] = data
-
-                # Expected binary data: int (4 bytes)
-                data, = struct.unpack('<i', f.read(4))
-                header["PastTransformation"][i]["Type"] = data
-
-                # Expected binary data: variable-length string
-                data = read_variable_length_string(f)
-                header["PastTransformation"][i]["SourceFileName"] = data
-
-                # Expected binary data: int (4 bytes)
-                data, = struct.unpack('<i', f.read(4))
-                header["PastTransformation"][i]["NrOfValues"] = data
-
-                # Store transformation values as a list
-                trans_values = []
-                for j in range(header["PastTransformation"][i]["NrOfValues"]):
-                    # Expected binary data: float (4 bytes)
-                    data, = struct.unpack('<f', f.read(4))
-                    trans_values.append(data)
-                header["PastTransformation"][i]["Values"] = trans_values
-
-        # Expected binary data: char (1 byte)
-        data, = struct.unpack('<B', f.read(1))
-        header["LeftRightConvention"] = data  # modified in v4
+        _read_vmr_post_header(f, header)
 
-        if header["File version"] >= 4:
-            data, = struct.unpack('<B', f.read(1))
-            header["ReferenceSpaceVMR"] = data  # new in v4
+    return header, data_img
 
-        # Expected binary data: float (4 bytes)
-        data, = struct.unpack('<f', f.read(4))
-        header["VoxelSizeX"] = data  # Voxel resolution along X axis
-        data, = struct.unpack('<f', f.read(4))
-        header["VoxelSizeY"] = data  # Voxel resolution along Y axis
-        data, = struct.unpack('<f', f.read(4))
-        header["VoxelSizeZ"] = data  # Voxel resolution along Z axis
 
-        # Expected binary data: char (1 byte)
-        data, = struct.unpack('<B', f.read(1))
-        header["VoxelResolutionVerified"] = data
-        data, = struct.unpack('<B', f.read(1))
-        header["VoxelResolutionInTALmm"] = data
+# =============================================================================
+def open_vmr(filename, mode="r"):
+    """Open BrainVoyager VMR file as a memory map.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    mode : string
+        numpy.memmap mode, "r" for reading, "r+" for modifying in place.
+
+    Returns
+    -------
+    header : dictionary
+        Pre-data and post-data headers.
+    data : 3D numpy.memmap
+        Image data in the same orientation as `read_vmr`. This is a strided
+        view on the file, only the accessed voxels are read from disk. Use
+        numpy.array(data) to load it into memory.
+
+    """
+    header = dict()
+    with open(filename, 'rb') as f:
+        # Expected binary data: unsigned short int (2 bytes)
+        data, = struct.unpack('<H', f.read(2))
+        header["File version"] = data
+        data, = struct.unpack('<H', f.read(2))
+        header["DimX"] = data
+        data, = struct.unpack('<H', f.read(2))
+        header["DimY"] = data
+        data, = struct.unpack('<H', f.read(2))
+        header["DimZ"] = data
+
+        # Skip the data to reach the post-data header
+        dims = (header["DimZ"], header["DimY"], header["DimX"])
+        f.seek(8 + int(np.prod(dims)))
+        _read_vmr_post_header(f, header)
+
+    data_img = np.memmap(filename, dtype='<B', mode=mode, offset=8,
+                         shape=dims)
+    data_img = np.transpose(data_img, (0, 2, 1))  # BV to Tal
+    data_img = data_img[::-1, ::-1, ::-1]  # Flip BV axes
+    return header, data_img
+
+
+# =============================================================================
+def read_vmr_bbox(filename, threshold=0, slab_size=32):
+    """Read the bounding box of non-zero voxels of a VMR file.
+
+    Partial coverage data (e.g. 7T slabs) is read without the surrounding
+    zeros. The VMR offsets are updated, so the result still places into the
+    same framing cube (see `FramingCube`) and can be written with
+    `write_vmr`.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    threshold : integer
+        Voxels above this value are kept in the bounding box.
+    slab_size : integer
+        Number of slices read at once while searching the bounding box.
 
-        # Expected binary data: int (4 bytes)
-        data, = struct.unpack('<i', f.read(4))
-        header["VMROrigV16MinValue"] = data  # 16-bit data min intensity
-        data, = struct.unpack('<i', f.read(4))
-        header["VMROrigV16MeanValue"] = data  # 16-bit data mean intensity
-        data, = struct.unpack('<i', f.read(4))
-        header["VMROrigV16MaxValue"] = data  # 16-bit data max intensity
+    Returns
+    -------
+    header : dictionary
+        Pre-data and post-data headers. "DimX/Y/Z" and "OffsetX/Y/Z" describe
+        the bounding box. Files older than version 3 are upgraded to version
+        3 to store the offsets.
+    data : 3D numpy.array
+        Image data within the bounding box, oriented as in `read_vmr`.
 
+    """
+    header, data_img = open_vmr(filename)
+    raw = data_img[::-1, ::-1, ::-1].transpose(0, 2, 1)  # Back to (Z, Y, X)
+
+    any_z = np.zeros(raw.shape[0], dtype=bool)
+    any_y = np.zeros(raw.shape[1], dtype=bool)
+    any_x = np.zeros(raw.shape[2], dtype=bool)
+    for z in range(0, raw.shape[0], slab_size):
+        slab = np.asarray(raw[z:z + slab_size]) > threshold
+        any_z[z:z + slab_size] = np.any(slab, axis=(1, 2))
+        any_y |= np.any(slab, axis=(0, 2))
+        any_x |= np.any(slab, axis=(0, 1))
+
+    if header["File version"] < 3:
+        header["File version"] = 3
+        header["OffsetX"], header["OffsetY"], header["OffsetZ"] = 0, 0, 0
+        header["FramingCubeDim"] = max(raw.shape)
+
+    bbox = []
+    for mask, a in zip((any_z, any_y, any_x), ("Z", "Y", "X")):
+        nonzero = np.flatnonzero(mask)
+        start, end = (nonzero[0], nonzero[-1] + 1) if nonzero.size else (0, 0)
+        header["Dim" + a] = int(end - start)
+        header["Offset" + a] += int(start)
+        bbox.append(slice(start, end))
+
+    data_img = np.array(raw[tuple(bbox)])
+    data_img = np.transpose(data_img, (0, 2, 1))  # BV to Tal
+    data_img = data_img[::-1, ::-1, ::-1]  # Flip BV axes
     return header, data_img
 
 
+class FramingCube:
+    """Lazy view of VMR data placed into its framing cube.
+
+    Indexing returns numpy arrays in the orientation of `read_vmr`, filled
+    with zeros outside of the data. Only the requested region is allocated,
+    so e.g. single slices of partial coverage data stay cheap.
+
+    Parameters
+    ----------
+    header : dictionary
+        VMR header with "DimX/Y/Z", "OffsetX/Y/Z" and "FramingCubeDim".
+        Without offsets (file version < 3) the data fills the cube.
+    data_img : 3D numpy.array
+        Image data as returned by `read_vmr`, `open_vmr` or `read_vmr_bbox`.
+
+    """
+
+    def __init__(self, header, data_img):
+        self.data = data_img
+        # Files older than version 3 have no offsets
+        size = header.get("FramingCubeDim", max(data_img.shape))
+        offset = [header.get("Offset" + a, 0) for a in ("X", "Y", "Z")]
+        self.shape = (size, size, size)
+        self.dtype = data_img.dtype
+        self.ndim = 3
+        # Data position along each axis, after BV to Tal transpose and flip
+        self.start = (size - offset[2] - header["DimZ"],
+                      size - offset[0] - header["DimX"],
+                      size - offset[1] - header["DimY"])
+
+    def __getitem__(self, key):
+        key = np.index_exp[key]
+        # Compare by identity, index arrays do not support `in`
+        ellipsis = [i for i, k in enumerate(key) if k is Ellipsis]
+        if ellipsis:
+            i = ellipsis[0]
+            key = key[:i] + (slice(None),) * (4 - len(key)) + key[i + 1:]
+        key = key + (slice(None),) * (3 - len(key))
+
+        indices, inside = [], []
+        for k, n, s, d in zip(key, self.shape, self.start, self.data.shape):
+            idx = np.atleast_1d(np.arange(n)[k]) - s
+            indices.append(idx)
+            inside.append((idx >= 0) & (idx < d))
+
+        out = np.zeros([i.size for i in indices], dtype=self.dtype)
+        if all(np.any(m) for m in inside):
+            src = np.ix_(*[i[m] for i, m in zip(indices, inside)])
+            out[np.ix_(*inside)] = self.data[src]
+        drop = tuple(0 if isinstance(k, (int, np.integer)) else slice(None)
+                     for k in key)
+        return out[drop]
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[...]
+        return out if dtype is None else out.astype(dtype)
+
+
 # =============================================================================
 def write_vmr(filename, header, data_img):
     """Protocol to write BrainVoyager VMR file.
@@ -282,124 +573,135 @@ def write_vmr(filename, header, data_img):
         # ---------------------------------------------------------------------
         # VMR Post-Data Header
         # ---------------------------------------------------------------------
-        if header["File version"] >= 3:
-            # Expected binary data: short int (2 bytes)
-            data = header["OffsetX"]
-            f.write(struct.pack('<h', data))
-            data = header["OffsetY"]
-            f.write(struct.pack('<h', data))
-            data = header["OffsetZ"]
-            f.write(struct.pack('<h', data))
-            data = header["FramingCubeDim"]
-            f.write(struct.pack('<h', data))
-
-        # Expected binary data: int (4 bytes)
-        data = header["PosInfosVerified"]
-        f.write(struct.pack('<i', data))
-        data = header["CoordinateSystem"]
-        f.write(struct.pack('<i', data))
-
-        # Expected binary data: float (4 bytes)
-        data = header["Slice1CenterX"]
-        f.write(struct.pack('<f', data))
-        data = header["Slice1CenterY"]
-        f.write(struct.pack('<f', data))
-        data = header["Slice1CenterZ"]
-        f.write(struct.pack('<f', data))
-        data = header["SliceNCenterX"]
-        f.write(struct.pack('<f', data))
-        data = header["SliceNCenterY"]
-        f.write(struct.pack('<f', data))
-        data = header["SliceNCenterZ"]
-        f.write(struct.pack('<f', data))
-        data = header["RowDirX"]
-        f.write(struct.pack('<f', data))
-        data = header["RowDirY"]
-        f.write(struct.pack('<f', data))
-        data = header["RowDirZ"]
-        f.write(struct.pack('<f', data))
-        data = header["ColDirX"]
-        f.write(struct.pack('<f', data))
-        data = header["ColDirY"]
-        f.write(struct.pack('<f', data))
-        data = header["ColDirZ"]
-        f.write(struct.pack('<f', data))
-
-        # Expected binary data: int (4 bytes)
-        data = header["NRows"]
-        f.write(struct.pack('<i', data))
-        data = header["NCols"]
-        f.write(struct.pack('<i', data))
-
-        # Expected binary data: float (4 bytes)
-        data = header["FoVRows"]
-        f.write(struct.pack('<f', data))
-        data = header["FoVCols"]
-        f.write(struct.pack('<f', data))
-        data = header["SliceThickness"]
-        f.write(struct.pack('<f', data))
-        data = header["GapThickness"]
-        f.write(struct.pack('<f', data))
-
-        # Expected binary data: int (4 bytes)
-        data = header["NrOfPastSpatialTransformations"]
-        f.write(struct.pack('<i', data))
-
-        if header["NrOfPastSpatialTransformations"] != 0:
-            for i in range(header["NrOfPastSpatialTransformations"]):
-                # Expected binary data: variable-length string
-                data = header["PastTransformation"][i]["Name"]
-                write_variable_length_string(f, data)
-
-                # Expected binary data: int (4 bytes)
-                data = header["PastTransformation"][i]["Type"]
-                f.write(struct.pack('<i', data))
-
-                # Expected binary data: variable-length string
-                data = header["PastTransformation"][i]["SourceFileName"]
-                write_variable_length_string(f, data)
-
-                # Expected binary data: int (4 bytes)
-                data = header["PastTransformation"][i]["NrOfValues"]
-                f.write(struct.pack('<i', data))
-
-                # Transformation values are stored as a list
-                trans_values = header["PastTransformation"][i]["Values"]
-                for j in range(header["PastTransformation"][i]["NrOfValues"]):
-                    # Expected binary data: float (4 bytes)
-                    f.write(struct.pack('<f', trans_values[j]))
-
-        # Expected binary data: char (1 byte)
-        data = header["LeftRightConvention"]
-        f.write(struct.pack('<B', data))
+        _write_vmr_post_header(f, header)
 
-        if header["File version"] >= 4:
-            data = header["ReferenceSpaceVMR"]
-            f.write(struct.pack('<B', data))
+    return print("VMR saved.")
 
-        # Expected binary data: float (4 bytes)
-        data = header["VoxelSizeX"]
-        f.write(struct.pack('<f', data))
-        data = header["VoxelSizeY"]
-        f.write(struct.pack('<f', data))
-        data = header["VoxelSizeZ"]
-        f.write(struct.pack('<f', data))
 
-        # Expected binary data: char (1 byte)
-        data = header["VoxelResolutionVerified"]
-        f.write(struct.pack('<B', data))
-        data = header["VoxelResolutionInTALmm"]
-        f.write(struct.pack('<B', data))
+# =============================================================================
+def _block_reduce(slab, factor, method):
+    """Reduce (Z, Y, X) array blocks of factor^3 voxels to single voxels."""
+    pad = [(0, -n % factor) for n in slab.shape]
+    if any(p[1] for p in pad):
+        slab = np.pad(slab, pad, mode="edge")
+    nz, ny, nx = (n // factor for n in slab.shape)
+    blocks = slab.reshape(nz, factor, ny, factor, nx, factor)
+    blocks = blocks.transpose(0, 2, 4, 1, 3, 5).reshape(nz, ny, nx, -1)
+    if method == "mean":
+        out = np.round(np.mean(blocks, axis=-1, dtype=np.float32))
+    elif method == "max":
+        out = np.max(blocks, axis=-1)
+    elif method == "mode":
+        # Longest run of equal values in each sorted block
+        blocks = np.sort(blocks, axis=-1)
+        idx = np.arange(blocks.shape[-1])
+        start = np.zeros(blocks.shape, dtype=np.int64)
+        start[..., 1:] = np.where(blocks[..., 1:] != blocks[..., :-1],
+                                  idx[1:], 0)
+        run = idx - np.maximum.accumulate(start, axis=-1)
+        best = np.argmax(run, axis=-1)[..., None]
+        out = np.take_along_axis(blocks, best, axis=-1)[..., 0]
+    else:
+        raise ValueError("Unknown method: {}".format(method))
+    return out.astype(slab.dtype)
+
+
+def build_pyramid(filename, factors=(2, 4, 8), method="mean",
+                  outnames=None):
+    """Write downsampled copies of a VMR or V16 file.
+
+    The input is memory mapped and processed in slabs of the largest factor
+    in slices, so memory use does not depend on the volume size.
 
-        # Expected binary data: int (4 bytes)
-        data = header["VMROrigV16MinValue"]
-        f.write(struct.pack('<i', data))
-        data = header["VMROrigV16MeanValue"]
-        f.write(struct.pack('<i', data))
-        data = header["VMROrigV16MaxValue"]
-        f.write(struct.pack('<i', data))
+    Parameters
+    ----------
+    filename : string
+        Path to VMR or V16 file.
+    factors : sequence of integers
+        Downsampling factors. Each output voxel summarizes factor^3 input
+        voxels. Partial blocks at the volume borders are padded by edge
+        values.
+    method : string, "mean", "max" or "mode"
+        Block average for anatomical images, block maximum, or most frequent
+        value for segmentations.
+    outnames : list of strings
+        Output paths, one per factor. Defaults to the input name with a
+        "_bvbabel-pyramid<factor>x" suffix.
 
-    return print("VMR saved.")
+    Returns
+    -------
+    headers : list of dictionaries
+        Headers of the written files. Dimensions, voxel sizes, offsets and
+        framing cube dimensions are divided by the factor.
+
+    Raises
+    ------
+    ValueError
+        If an offset is not a multiple of a factor, as the blocks would then
+        not be aligned with the downsampled framing cube grid.
+
+    """
+    is_v16 = filename.lower().endswith(".v16")
+    if is_v16:
+        header, data_img = open_v16(filename)
+    else:
+        header, data_img = open_vmr(filename)
+    raw = data_img[::-1, ::-1, ::-1].transpose(0, 2, 1)  # Back to (Z, Y, X)
+    dtype = '<H' if is_v16 else '<B'
+
+    basename, ext = filename.rsplit(".", 1)
+    if outnames is None:
+        outnames = ["{}_bvbabel-pyramid{}x.{}".format(basename, f, ext)
+                    for f in factors]
+
+    for f in factors:
+        for a in ("X", "Y", "Z"):
+            if header.get("Offset" + a, 0) % f != 0:
+                raise ValueError(
+                    "Offset{} = {} is not a multiple of factor {}.".format(
+                        a, header["Offset" + a], f))
+
+    headers = []
+    for f in factors:
+        h = dict(header)
+        for a in ("X", "Y", "Z"):
+            h["Dim" + a] = -(-header["Dim" + a] // f)
+            if "VoxelSize" + a in header:
+                h["VoxelSize" + a] = header["VoxelSize" + a] * f
+            if "Offset" + a in header:
+                h["Offset" + a] = header["Offset" + a] // f
+        if "FramingCubeDim" in header:
+            h["FramingCubeDim"] = -(-header["FramingCubeDim"] // f)
+        headers.append(h)
+
+    with contextlib.ExitStack() as stack:
+        files = [stack.enter_context(open(outname, 'wb'))
+                 for outname in outnames[:len(factors)]]
+        for h, out in zip(headers, files):
+            if not is_v16:
+                out.write(struct.pack('<H', h["File version"]))
+            for a in ("X", "Y", "Z"):
+                out.write(struct.pack('<H', h["Dim" + a]))
+
+        # Slabs of the largest factor. Slices that do not fill a whole block
+        # of a factor are carried over to the next slab of that factor.
+        step = max(factors)
+        carry = [raw[:0] for _ in factors]
+        for z in range(0, raw.shape[0], step):
+            slab = np.asarray(raw[z:z + step])
+            last = z + step >= raw.shape[0]
+            for i, (f, out) in enumerate(zip(factors, files)):
+                slices = np.concatenate([carry[i], slab], axis=0)
+                n = slices.shape[0] if last else slices.shape[0] // f * f
+                if n > 0:
+                    _block_reduce(slices[:n], f,
+                                  method).astype(dtype).tofile(out)
+                carry[i] = slices[n:]
+
+        for h, out in zip(headers, files):
+            if not is_v16:
+                _write_vmr_post_header(out, h)
+    return headers
 
 
 def create_vmr():
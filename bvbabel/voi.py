@@ -151,9 +151,9 @@ def write_voi(filename, header, data_voi):
             data = v["NrOfVoxels"]
             f.write("NrOfVoxels: {}\n".format(data))
 
-            data = v["Coordinates"]
-            for d in data:
-                f.write("{} {} {}\n".format(d[0], d[1], d[2]))
+            data = np.asarray(v["Coordinates"], dtype=int).reshape(-1, 3)
+            f.write(("{} {} {}\n" * data.shape[0]).format(*data.ravel()
+                                                           .tolist()))
             f.write("\n")
 
         # ---------------------------------------------------------------------
@@ -4,6 +4,121 @@ import struct
 import numpy as np
 from bvbabel.utils import read_variable_length_string
 from bvbabel.utils import write_variable_length_string
+from bvbabel.utils import trilinear_weights
+from bvbabel.fmr import open_fmr
+
+
+# =============================================================================
+def _read_vtc_header(f):
+    """Read VTC header from an open file, leaving it at the data start."""
+    header = dict()
+    # Expected binary data: short int (2 bytes)
+    data, = struct.unpack('<h', f.read(2))
+    header["File version"] = data
+
+    # Expected binary data: variable-length string
+    data = read_variable_length_string(f)
+    header["Source FMR name"] = data
+
+    # Expected binary data: short int (2 bytes)
+    data, = struct.unpack('<h', f.read(2))
+    header["Protocol attached"] = data
+
+    if header["Protocol attached"] > 0:
+        # Expected binary data: variable-length string
+        data = read_variable_length_string(f)
+        header["Protocol name"] = data
+    else:
+        header["Protocol name"] = ""
+
+    # Expected binary data: short int (2 bytes)
+    data, = struct.unpack('<h', f.read(2))
+    header["Current protocol index"] = data
+    data, = struct.unpack('<h', f.read(2))
+    header["Data type (1:short int, 2:float)"] = data
+    data, = struct.unpack('<h', f.read(2))
+    header["Nr time points"] = data
+    data, = struct.unpack('<h', f.read(2))
+    header["VTC resolution relative to VMR (1, 2, or 3)"] = data
+
+    data, = struct.unpack('<h', f.read(2))
+    header["XStart"] = data
+    data, = struct.unpack('<h', f.read(2))
+    header["XEnd"] = data
+    data, = struct.unpack('<h', f.read(2))
+    header["YStart"] = data
+    data, = struct.unpack('<h', f.read(2))
+    header["YEnd"] = data
+    data, = struct.unpack('<h', f.read(2))
+    header["ZStart"] = data
+    data, = struct.unpack('<h', f.read(2))
+    header["ZEnd"] = data
+
+    # Expected binary data: char (1 byte)
+    data, = struct.unpack('<B', f.read(1))
+    header["L-R convention (0:unknown, 1:radiological, 2:neurological)"] = data
+    data, = struct.unpack('<B', f.read(1))
+    header["Reference space (0:unknown, 1:native, 2:ACPC, 3:Tal, 4:MNI)"] = data
+
+    # Expected binary data: char (4 bytes)
+    data, = struct.unpack('<f', f.read(4))
+    header["TR (ms)"] = data
+
+    return header
+
+
+# =============================================================================
+def _write_vtc_header(f, header):
+    """Write VTC header to an open file, data follows right after."""
+    # Expected binary data: short int (2 bytes)
+    data = header["File version"]
+    f.write(struct.pack('<h', data))
+
+    # Expected binary data: variable-length string
+    data = header["Source FMR name"]
+    write_variable_length_string(f, data)
+
+    # Expected binary data: short int (2 bytes)
+    data = header["Protocol attached"]
+    f.write(struct.pack('<h', data))
+
+    if header["Protocol attached"] > 0:
+        # Expected binary data: variable-length string
+        data = header["Protocol name"]
+        write_variable_length_string(f, data)
+
+    # Expected binary data: short int (2 bytes)
+    data = header["Current protocol index"]
+    f.write(struct.pack('<h', data))
+    data = header["Data type (1:short int, 2:float)"]
+    f.write(struct.pack('<h', data))
+    data = header["Nr time points"]
+    f.write(struct.pack('<h', data))
+    data = header["VTC resolution relative to VMR (1, 2, or 3)"]
+    f.write(struct.pack('<h', data))
+
+    data = header["XStart"]
+    f.write(struct.pack('<h', data))
+    data = header["XEnd"]
+    f.write(struct.pack('<h', data))
+    data = header["YStart"]
+    f.write(struct.pack('<h', data))
+    data = header["YEnd"]
+    f.write(struct.pack('<h', data))
+    data = header["ZStart"]
+    f.write(struct.pack('<h', data))
+    data = header["ZEnd"]
+    f.write(struct.pack('<h', data))
+
+    # Expected binary data: char (1 byte)
+    data = header["L-R convention (0:unknown, 1:radiological, 2:neurological)"]
+    f.write(struct.pack('<B', data))
+    data = header["Reference space (0:unknown, 1:native, 2:ACPC, 3:Tal, 4:MNI)"]
+    f.write(struct.pack('<B', data))
+
+    # Expected binary data: char (4 bytes)
+    data = header["TR (ms)"]
+    f.write(struct.pack('<f', data))
 
 
 # =============================================================================
@@ -45,59 +160,8 @@ def read_vtc(filename, rearrange_data_axes=True):
 
 
     """
-    header = dict()
     with open(filename, 'rb') as f:
-        # Expected binary data: short int (2 bytes)
-        data, = struct.unpack('<h', f.read(2))
-        header["File version"] = data
-
-        # Expected binary data: variable-length string
-        data = read_variable_length_string(f)
-        header["Source FMR name"] = data
-
-        # Expected binary data: short int (2 bytes)
-        data, = struct.unpack('<h', f.read(2))
-        header["Protocol attached"] = data
-
-        if header["Protocol attached"] > 0:
-            # Expected binary data: variable-length string
-            data = read_variable_length_string(f)
-            header["Protocol name"] = data
-        else:
-            header["Protocol name"] = ""
-
-        # Expected binary data: short int (2 bytes)
-        data, = struct.unpack('<h', f.read(2))
-        header["Current protocol index"] = data
-        data, = struct.unpack('<h', f.read(2))
-        header["Data type (1:short int, 2:float)"] = data
-        data, = struct.unpack('<h', f.read(2))
-        header["Nr time points"] = data
-        data, = struct.unpack('<h', f.read(2))
-        header["VTC resolution relative to VMR (1, 2, or 3)"] = data
-
-        data, = struct.unpack('<h', f.read(2))
-        header["XStart"] = data
-        data, = struct.unpack('<h', f.read(2))
-        header["XEnd"] = data
-        data, = struct.unpack('<h', f.read(2))
-        header["YStart"] = data
-        data, = struct.unpack('<h', f.read(2))
-        header["YEnd"] = data
-        data, = struct.unpack('<h', f.read(2))
-        header["ZStart"] = data
-        data, = struct.unpack('<h', f.read(2))
-        header["ZEnd"] = data
-
-        # Expected binary data: char (1 byte)
-        data, = struct.unpack('<B', f.read(1))
-        header["L-R convention (0:unknown, 1:radiological, 2:neurological)"] = data
-        data, = struct.unpack('<B', f.read(1))
-        header["Reference space (0:unknown, 1:native, 2:ACPC, 3:Tal, 4:MNI)"] = data
-
-        # Expected binary data: char (4 bytes)
-        data, = struct.unpack('<f', f.read(4))
-        header["TR (ms)"] = data
+        header = _read_vtc_header(f)
 
         # ---------------------------------------------------------------------
         # Read VTC data
@@ -170,55 +234,7 @@ def write_vtc(filename, header, data_img, rearrange_data_axes=True):
 
     """
     with open(filename, 'wb') as f:
-        # Expected binary data: short int (2 bytes)
-        data = header["File version"]
-        f.write(struct.pack('<h', data))
-
-        # Expected binary data: variable-length string
-        data = header["Source FMR name"]
-        write_variable_length_string(f, data)
-
-        # Expected binary data: short int (2 bytes)
-        data = header["Protocol attached"]
-        f.write(struct.pack('<h', data))
-
-        if header["Protocol attached"] > 0:
-            # Expected binary data: variable-length string
-            data = header["Protocol name"]
-            write_variable_length_string(f, data)
-
-        # Expected binary data: short int (2 bytes)
-        data = header["Current protocol index"]
-        f.write(struct.pack('<h', data))
-        data = header["Data type (1:short int, 2:float)"]
-        f.write(struct.pack('<h', data))
-        data = header["Nr time points"]
-        f.write(struct.pack('<h', data))
-        data = header["VTC resolution relative to VMR (1, 2, or 3)"]
-        f.write(struct.pack('<h', data))
-
-        data = header["XStart"]
-        f.write(struct.pack('<h', data))
-        data = header["XEnd"]
-        f.write(struct.pack('<h', data))
-        data = header["YStart"]
-        f.write(struct.pack('<h', data))
-        data = header["YEnd"]
-        f.write(struct.pack('<h', data))
-        data = header["ZStart"]
-        f.write(struct.pack('<h', data))
-        data = header["ZEnd"]
-        f.write(struct.pack('<h', data))
-
-        # Expected binary data: char (1 byte)
-        data = header["L-R convention (0:unknown, 1:radiological, 2:neurological)"]
-        f.write(struct.pack('<B', data))
-        data = header["Reference space (0:unknown, 1:native, 2:ACPC, 3:Tal, 4:MNI)"]
-        f.write(struct.pack('<B', data))
-
-        # Expected binary data: char (4 bytes)
-        data = header["TR (ms)"]
-        f.write(struct.pack('<f', data))
+        _write_vtc_header(f, header)
 
         # ---------------------------------------------------------------------
         # Write VTC data
@@ -239,6 +255,448 @@ def write_vtc(filename, header, data_img, rearrange_data_axes=True):
         data_img.astype(dtype, copy=False).ravel(order="C").tofile(f)
 
 
+# =============================================================================
+def _vtc_dims(header):
+    """Return VTC data dimensions in file order (Z, Y, X, T) and dtype."""
+    VTC_resolution = header["VTC resolution relative to VMR (1, 2, or 3)"]
+    DimX = (header["XEnd"] - header["XStart"]) // VTC_resolution
+    DimY = (header["YEnd"] - header["YStart"]) // VTC_resolution
+    DimZ = (header["ZEnd"] - header["ZStart"]) // VTC_resolution
+    DimT = header["Nr time points"]
+    if header["Data type (1:short int, 2:float)"] == 1:
+        dtype = np.dtype("<h")
+    elif header["Data type (1:short int, 2:float)"] == 2:
+        dtype = np.dtype("<f")
+    else:
+        raise ValueError("Unrecognized VTC data_img type.")
+    return (DimZ, DimY, DimX, DimT), dtype
+
+
+def open_vtc(filename, mode="r", rearrange_data_axes=True):
+    """Open BrainVoyager VTC file data as a memory map.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    mode : string
+        numpy.memmap mode, "r" for reading, "r+" for modifying in place.
+    rearrange_data_axes : bool
+        Axes convention, same as in `read_vtc`.
+
+    Returns
+    -------
+    header : dictionary
+        Pre-data and post-data headers.
+    data : 4D numpy.memmap
+        Image data as in `read_vtc`, as a view on the file.
+
+    """
+    with open(filename, 'rb') as f:
+        header = _read_vtc_header(f)
+        offset = f.tell()
+    dims, dtype = _vtc_dims(header)
+    data_img = np.memmap(filename, dtype=dtype, mode=mode, offset=offset,
+                         shape=dims)
+    if rearrange_data_axes is True:
+        data_img = np.transpose(data_img, (0, 2, 1, 3))
+        data_img = data_img[::-1, ::-1, ::-1, :]
+    return header, data_img
+
+
+def allocate_vtc(filename, header, rearrange_data_axes=True):
+    """Write a VTC header and reserve its data, for chunked writing.
+
+    Parameters
+    ----------
+    filename : string
+        Output filename.
+    header : dictionary
+        VTC header, determines the data dimensions and type.
+    rearrange_data_axes : bool
+        Axes convention of the returned map, same as in `read_vtc`.
+
+    Returns
+    -------
+    data : 4D numpy.memmap
+        Zero initialized data, writing into it writes into the file.
+
+    """
+    dims, dtype = _vtc_dims(header)
+    with open(filename, 'wb') as f:
+        _write_vtc_header(f, header)
+        f.truncate(f.tell() + int(np.prod(dims)) * dtype.itemsize)
+    return open_vtc(filename, mode="r+",
+                    rearrange_data_axes=rearrange_data_axes)[1]
+
+
+# =============================================================================
+def _mask_indices(header, data_msk):
+    """Flat (Z, Y, X) VTC voxel indices inside of a MSK (read_msk) mask."""
+    data_msk = data_msk[::-1, ::-1, ::-1]  # Flip BV axes
+    data_msk = np.transpose(data_msk, (0, 2, 1))  # Tal to BV
+    if data_msk.shape != _vtc_dims(header)[0][:3]:
+        raise ValueError("MSK dimensions {} do not match the VTC.".format(
+            data_msk.shape))
+    return np.flatnonzero(data_msk).astype(np.int32)
+
+
+def mask_vtc(header, data_img, data_msk, rearrange_data_axes=True,
+             slab_size=8):
+    """Extract the time courses of voxels inside of a mask.
+
+    Parameters
+    ----------
+    header : dictionary
+        VTC header.
+    data_img : 4D numpy.array
+        VTC data (`read_vtc` or `open_vtc`). Read in slabs of slices, so a
+        memory map is never loaded as a whole.
+    data_msk : 3D numpy.array
+        Mask on the VTC grid (`bvbabel.msk.read_msk`).
+    rearrange_data_axes : bool
+        Axes convention of `data_img`, same as in `read_vtc`.
+    slab_size : integer
+        Number of slices read at once.
+
+    Returns
+    -------
+    indices : 1D numpy.array, int32, (nr voxels)
+        Flat voxel indices in BrainVoyager (Z, Y, X) file order.
+    data_masked : 2D numpy.array, (nr voxels, time points)
+        Time courses of the in-mask voxels.
+
+    """
+    indices = _mask_indices(header, data_msk)
+    if rearrange_data_axes is True:
+        data_img = data_img[::-1, ::-1, ::-1, :]
+        data_img = np.transpose(data_img, (0, 2, 1, 3))
+    dims = data_img.shape
+    slice_size = dims[1] * dims[2]
+
+    data_masked = np.zeros((indices.size, dims[3]), dtype=data_img.dtype)
+    bounds = np.searchsorted(indices, np.arange(0, dims[0] + slab_size,
+                                                slab_size) * slice_size)
+    for n, z in enumerate(range(0, dims[0], slab_size)):
+        a, b = bounds[n], bounds[n + 1]
+        if a == b:
+            continue
+        slab = np.asarray(data_img[z:z + slab_size]).reshape(-1, dims[3])
+        data_masked[a:b] = slab[indices[a:b] - z * slice_size]
+    return indices, data_masked
+
+
+def unmask_vtc(header, indices, data_masked, rearrange_data_axes=True):
+    """Scatter masked time courses back into a full VTC data array.
+
+    Parameters
+    ----------
+    header : dictionary
+        VTC header.
+    indices : 1D numpy.array, int
+        Flat voxel indices in BrainVoyager (Z, Y, X) file order.
+    data_masked : 2D numpy.array, (nr voxels, time points)
+        Time courses of the in-mask voxels.
+    rearrange_data_axes : bool
+        Axes convention of the output, same as in `read_vtc`.
+
+    Returns
+    -------
+    data_img : 4D numpy.array
+        VTC data, zero outside of the mask.
+
+    """
+    dims = _vtc_dims(header)[0]
+    data_img = np.zeros((dims[0] * dims[1] * dims[2], data_masked.shape[1]),
+                        dtype=data_masked.dtype)
+    data_img[indices] = data_masked
+    data_img = np.reshape(data_img, dims[:3] + (data_masked.shape[1],))
+    if rearrange_data_axes is True:
+        data_img = np.transpose(data_img, (0, 2, 1, 3))
+        data_img = data_img[::-1, ::-1, ::-1, :]
+    return data_img
+
+
+def write_vtc_masked(filename, header, indices, data_masked):
+    """Write masked VTC time courses.
+
+    The file holds the VTC header followed by the number of in-mask voxels
+    (int32), their flat (Z, Y, X) indices (int32) and the (voxels, time
+    points) data in the VTC data type.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    header : dictionary
+        VTC header.
+    indices : 1D numpy.array, int
+        Flat voxel indices, see `mask_vtc`.
+    data_masked : 2D numpy.array, (nr voxels, time points)
+        Time courses of the in-mask voxels.
+
+    """
+    dtype = _vtc_dims(header)[1]
+    with open(filename, 'wb') as f:
+        _write_vtc_header(f, header)
+
+        # Expected binary data: int (4 bytes)
+        f.write(struct.pack('<i', len(indices)))
+        np.asarray(indices, dtype='<i4').tofile(f)
+        np.asarray(data_masked, dtype=dtype).tofile(f)
+
+
+def write_vtc_unmasked(filename, header, indices, data_masked):
+    """Write masked time courses as a full VTC file.
+
+    Out of mask voxels are zero. Slices are scattered and written one at a
+    time, so the full VTC data is never held in memory.
+
+    Parameters
+    ----------
+    filename : string
+        Output filename.
+    header : dictionary
+        VTC header.
+    indices : 1D numpy.array, int
+        Flat voxel indices, see `mask_vtc`.
+    data_masked : 2D numpy.array, (nr voxels, time points)
+        Time courses of the in-mask voxels.
+
+    """
+    dims, dtype = _vtc_dims(header)
+    slice_size = dims[1] * dims[2]
+    bounds = np.searchsorted(indices, np.arange(dims[0] + 1) * slice_size)
+    with open(filename, 'wb') as f:
+        _write_vtc_header(f, header)
+        data_slice = np.zeros((slice_size, dims[3]), dtype=dtype)
+        for z in range(dims[0]):
+            a, b = bounds[z], bounds[z + 1]
+            data_slice[:] = 0
+            data_slice[indices[a:b] - z * slice_size] = data_masked[a:b]
+            data_slice.tofile(f)
+
+
+def read_vtc_masked(filename, mmap=False):
+    """Read masked VTC time courses written by `write_vtc_masked`.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file.
+    mmap : bool
+        Memory map the time courses instead of reading them.
+
+    Returns
+    -------
+    header : dictionary
+        VTC header.
+    indices : 1D numpy.array, int32, (nr voxels)
+        Flat voxel indices in BrainVoyager (Z, Y, X) file order.
+    data_masked : 2D numpy.array, (nr voxels, time points)
+        Time courses of the in-mask voxels. Use `unmask_vtc` to get the full
+        VTC data.
+
+    """
+    with open(filename, 'rb') as f:
+        header = _read_vtc_header(f)
+        dims, dtype = _vtc_dims(header)
+
+        # Expected binary data: int (4 bytes)
+        nr_voxels, = struct.unpack('<i', f.read(4))
+        indices = np.fromfile(f, dtype='<i4', count=nr_voxels)
+        shape = (nr_voxels, dims[3])
+        if mmap:
+            data_masked = np.memmap(filename, dtype=dtype, mode="r",
+                                    offset=f.tell(), shape=shape)
+        else:
+            data_masked = np.fromfile(f, dtype=dtype, count=shape[0] * shape[1])
+            data_masked = np.reshape(data_masked, shape)
+    return header, indices, data_masked
+
+
+# =============================================================================
+def _lanczos(x, a=3):
+    """Lanczos (windowed sinc) kernel."""
+    return np.where(np.abs(x) < a, np.sinc(x) * np.sinc(x / a), 0.)
+
+
+def _separable_taps(coords, offsets, support, method, dims_fmr, strides):
+    """Nearest neighbour or Lanczos taps, (points, taps) indices and weights.
+
+    Per axis weights are normalized over the taps within the FMR.
+    """
+    if method == "nearest":
+        base = np.round(coords).astype(int)
+    else:
+        base = np.floor(coords).astype(int)
+    frac = coords - base
+
+    axis_weights = list()
+    for a in range(3):
+        taps = np.arange(support) + offsets[:, a].min()
+        if method == "nearest":
+            w = np.ones((coords.shape[0], 1))
+        else:
+            w = _lanczos(frac[:, a:a + 1] - taps)
+        inside = ((base[:, a:a + 1] + taps >= 0)
+                  & (base[:, a:a + 1] + taps < dims_fmr[a]))
+        w = np.where(inside, w, 0)
+        total = np.sum(w, axis=1, keepdims=True)
+        axis_weights.append(np.divide(w, total, out=np.zeros_like(w),
+                                      where=total > 0))
+
+    corners = np.zeros((coords.shape[0], offsets.shape[0]), dtype=np.int64)
+    weights = np.zeros((coords.shape[0], offsets.shape[0]))
+    for k, offset in enumerate(offsets):
+        tap = offset - offsets.min(axis=0)
+        weights[:, k] = (axis_weights[0][:, tap[0]]
+                         * axis_weights[1][:, tap[1]]
+                         * axis_weights[2][:, tap[2]])
+        corners[:, k] = np.clip(base + offset, 0, dims_fmr - 1) @ strides
+    return corners, weights
+
+
+def fmr_sampling_map(header_fmr, header_vtc, matrix, method="trilinear",
+                     framing_cube=256, chunk_size=65536):
+    """Precompute where each VTC voxel samples an FMR volume.
+
+    Parameters
+    ----------
+    header_fmr : dictionary
+        FMR header (`bvbabel.fmr.read_fmr`).
+    header_vtc : dictionary
+        VTC header giving the bounding box and resolution.
+    matrix : 2D numpy.array, (4, 4)
+        Maps VMR coordinates to FMR coordinates, e.g. the output of
+        `bvbabel.trf.compose_trfs`. VMR coordinates are BrainVoyager
+        internal (X, Y, Z) voxel coordinates relative to the framing cube
+        center. FMR coordinates are (column, row, slice) voxel coordinates
+        relative to the FMR volume center.
+    method : string
+        "nearest", "trilinear" or "sinc" (3 lobe Lanczos windowed sinc).
+    framing_cube : integer
+        VMR framing cube dimension.
+    chunk_size : integer
+        Number of VTC voxels processed at once.
+
+    Returns
+    -------
+    sampling_map : tuple of two 2D numpy.arrays, (taps, VTC voxels)
+        FMR voxel indices (int32, flat within a volume) and weights
+        (float32). Voxels mapping outside of the FMR get zero weights.
+
+    """
+    dims_vtc = _vtc_dims(header_vtc)[0][:3]
+    res = header_vtc["VTC resolution relative to VMR (1, 2, or 3)"]
+    start = np.array([header_vtc["XStart"], header_vtc["YStart"],
+                      header_vtc["ZStart"]])
+    dims_fmr = np.array([header_fmr["ResolutionX"], header_fmr["ResolutionY"],
+                         header_fmr["NrOfSlices"]])
+    strides = np.array([1, dims_fmr[0], dims_fmr[0] * dims_fmr[1]])
+    matrix = np.asarray(matrix, dtype=float)
+
+    if method == "nearest":
+        offsets, support = np.zeros((1, 3), dtype=int), 1
+    elif method == "trilinear":
+        offsets, support = None, 2  # Corners from `trilinear_weights`
+    elif method == "sinc":
+        offsets, support = np.indices((6, 6, 6)).reshape(3, -1).T - 2, 6
+    else:
+        raise ValueError("Unknown sampling method '{}'.".format(method))
+
+    nr_voxels = int(np.prod(dims_vtc))
+    indices = np.zeros((support**3, nr_voxels), dtype=np.int32)
+    weights = np.zeros((support**3, nr_voxels), dtype=np.float32)
+    for i in range(0, nr_voxels, chunk_size):
+        idx = np.arange(i, min(i + chunk_size, nr_voxels))
+        # VTC (Z, Y, X) voxel index to VMR (X, Y, Z) coordinates
+        xyz = np.stack([idx % dims_vtc[2], (idx // dims_vtc[2]) % dims_vtc[1],
+                        idx // (dims_vtc[2] * dims_vtc[1])], axis=1)
+        xyz = xyz * res + start + (res - 1) / 2 - framing_cube / 2
+        coords = xyz @ matrix[:3, :3].T + matrix[:3, 3] + dims_fmr / 2
+        # Points outside of the FMR get no weight at all
+        outside = np.any((coords < -0.5) | (coords > dims_fmr - 0.5), axis=1)
+
+        if method == "trilinear":
+            corners, w = trilinear_weights(coords, dims_fmr)
+            corners = corners @ strides
+            # Corners within the FMR share all weight at its edges
+            total = np.sum(w, axis=1, keepdims=True)
+            np.divide(w, total, out=w, where=total > 0)
+        else:
+            corners, w = _separable_taps(coords, offsets, support, method,
+                                         dims_fmr, strides)
+        w[outside] = 0
+        indices[:, idx] = corners.T
+        weights[:, idx] = w.T
+    return indices, weights
+
+
+def create_from_fmr(filename_fmr, filename_vtc, header_vtc, matrix,
+                    method="trilinear", sampling_map=None, chunk_size=32,
+                    framing_cube=256):
+    """Create a VTC file from an FMR file and a coordinate transformation.
+
+    Parameters
+    ----------
+    filename_fmr : string
+        Path to FMR file, its STC file is memory mapped.
+    filename_vtc : string
+        Output VTC file, written in chunks of time points.
+    header_vtc : dictionary
+        VTC header giving the bounding box, resolution, reference space etc.
+        (e.g. from `create_vtc` or another VTC of the session). Number of
+        time points, TR and source FMR name are taken from the FMR. Data is
+        stored as float.
+    matrix : 2D numpy.array, (4, 4)
+        VMR to FMR coordinates, see `fmr_sampling_map` and
+        `bvbabel.trf.compose_trfs`.
+    method : string
+        "nearest", "trilinear" or "sinc".
+    sampling_map : tuple
+        Output of `fmr_sampling_map` or of a previous call. Runs sharing
+        the FMR geometry, transformation and bounding box can reuse it.
+    chunk_size : integer
+        Number of volumes resampled at once.
+    framing_cube : integer
+        VMR framing cube dimension.
+
+    Returns
+    -------
+    header : dictionary
+        VTC header.
+    sampling_map : tuple
+        Sampling map, to be passed to the next call.
+
+    """
+    header_fmr, data_fmr = open_fmr(filename_fmr, rearrange_data_axes=False)
+
+    header = dict(header_vtc)
+    header["Source FMR name"] = filename_fmr
+    header["Nr time points"] = header_fmr["NrOfVolumes"]
+    header["TR (ms)"] = int(float(header_fmr["TR"]))
+    header["Data type (1:short int, 2:float)"] = 2
+
+    if sampling_map is None:
+        sampling_map = fmr_sampling_map(header_fmr, header, matrix, method,
+                                        framing_cube)
+    indices, weights = sampling_map
+
+    nr_volumes = header["Nr time points"]
+    data_vtc = allocate_vtc(filename_vtc, header, rearrange_data_axes=False)
+    data_vtc = np.reshape(data_vtc, (-1, nr_volumes))
+    data_fmr = np.reshape(data_fmr, (nr_volumes, -1))
+    for t in range(0, nr_volumes, chunk_size):
+        volumes = np.asarray(data_fmr[t:t + chunk_size], dtype=np.float32).T
+        out = np.zeros((indices.shape[1], volumes.shape[1]), dtype=np.float32)
+        for k in range(indices.shape[0]):
+            out += weights[k][:, None] * volumes[indices[k]]
+        data_vtc[:, t:t + chunk_size] = out
+    data_vtc.flush()
+    return header, sampling_map
+
+
 def create_vtc(rearrange_data_axes=True):
     """Create BrainVoyager VTC file with default values.
 
@@ -0,0 +1,24 @@
+"""Read and write BrainVoyager MAP (FMR based statistical map) file."""
+
+import os
+import bvbabel
+from pprint import pprint
+
+FILE = "/home/faruk/Documents/test_bvbabel/map/map_test.map"
+
+# =============================================================================
+# Load map
+header, data = bvbabel.map.read_map(FILE)
+
+# See header information
+pprint(header)
+
+# Invert the statistical values
+data = data * -1
+
+# Write MAP
+basename = FILE.split(os.extsep, 1)[0]
+outname = "{}_bvbabel.map".format(basename)
+bvbabel.map.write_map(outname, header, data)
+
+print("Finished.")
@@ -18,10 +18,8 @@ VMR_VOXEL_DIMS = 0.4  # Stands for e.g 0.4 x 0.4 x 0.4 mm^3 ot 1 x 1 x 1 mm^3
 header_srf, data_srf = bvbabel.srf.read_srf(FILE_SRF)
 header_smp, data_smp = bvbabel.smp.read_smp(FILE_SMP)
 
-# Get vertex coordinates (2D numpy array)
-vtx = data_srf["vertices"]
-# Get vertex neighbors (python list)
-nbr = data_srf["vertex neighbors"]
+# Sparse mesh operators (adjacency, edge lengths) are cached in the mesh
+mesh = bvbabel.srf.Mesh(data_srf)
 # Get PRF mapping visual field c & y coordinates
 print(header_smp["Map"][1]["Name"])
 print(header_smp["Map"][2]["Name"])
@@ -29,38 +27,10 @@ prf_xy = data_smp[:, 1:3]
 
 # -----------------------------------------------------------------------------
 print("Computing cortical magnification factors...")
-# Prepare useful variables
-nr_vtx = header_srf["Nr vertices"]
-map_cmf = np.zeros(nr_vtx)
-
-# Compute cortical magnification for each vertex
-for v in range(nr_vtx):
-    if prf_xy[v, 0] != 0 and prf_xy[v, 1] != 0:
-        cmf_sum = 0
-        n_count = 0
-        for n in nbr[v][1:]:  # Loop over neighbor vertices
-            # Compute vertex to vertex mesh distance
-            dist_cortex = np.linalg.norm(vtx[v, :] - vtx[n, :])
-            # Convert vertex to vertex mesh distance to millimeters
-            dist_cortex *= (VMR_IMAGE_DIMS / 256) * VMR_VOXEL_DIMS
-
-            # Compute vertex to vertex PRF xy coordinates distance
-            dist_vfield = np.linalg.norm(prf_xy[v, :] - prf_xy[n, :])
-
-            # Compute cortical magnification factor (CMF)
-            # NOTE: CMF = "mm of cortical surface" / "degree of visual angle"
-            if dist_vfield > 0:
-                cmf_sum += dist_cortex / dist_vfield
-                n_count += 1
-
-        # Normalize cumulative CMF with the number of non-zero neighbours
-        if cmf_sum > 0:
-            cmf = cmf_sum / n_count
-
-        # Put the vertex-wise average CMF into smp map format
-        map_cmf[v] = cmf
-    else:
-        map_cmf[v] = 0
+# NOTE: CMF = "mm of cortical surface" / "degree of visual angle", averaged
+# over the neighbors of each vertex.
+map_cmf = mesh.cortical_magnification(
+    prf_xy, scale=(VMR_IMAGE_DIMS / 256) * VMR_VOXEL_DIMS)
 
 # -----------------------------------------------------------------------------
 # Prepare new SMP map